@@ -0,0 +1,204 @@
+"""
+Unusual lines and recurring purchases, found by an incremental job.
+
+detect() reads the expenses added since its last run (ids above
+anomaly_progress.last_expense_id, in id order) and checks each line against
+one anomaly_stats row per (product, unit) instead of the product's history:
+
+  price      the unit price (line total after discount / quantity) is at
+             least PRICE_RATIO times the usual one and Z_LIMIT spreads above
+             it; needs MIN_HISTORY earlier lines of the product
+  duplicate  an earlier line of the same receipt has the same product, price,
+             quantity and discount (a line entered or scanned twice)
+
+Flagged lines get an expense_flags row, shown on /cheltuieli. The usual price
+is a rolling mean and variance of log(unit price), weighted towards the newest
+lines (ALPHA) so that a price that stays higher stops being flagged after a
+few purchases. The same row keeps the rolling mean and variance of the days
+between purchases: a product bought on at least RECURRING_MIN_INTERVALS
+intervals that vary little (RECURRING_MAX_CV) is recurring, and recurring()
+lists those with the day the next purchase is due.
+
+A line costs a primary-key read and write of its state row; the duplicate
+check reads the earlier lines of a receipt once per receipt. Nothing rescans
+history, so the job is cheap to run on every /cheltuieli view and after every
+import (schema.ensure_anomalies processes the existing lines once). The state
+follows the lines as they were added: editing or deleting an old line does
+not re-check it or take it out of the statistics (the flags of a deleted line
+go with it), and lines imported with dates older than the newest purchase of
+their product count for prices but not for the intervals.
+"""
+
+import math
+
+import dates
+import money
+
+ALPHA = 0.2                   # weight of the newest line in the rolling statistics
+MIN_HISTORY = 4               # earlier lines of a product before its prices are judged
+PRICE_RATIO = 1.5
+Z_LIMIT = 3.0
+MIN_SPREAD = 0.05             # floor of the log-price spread (products with one fixed price)
+RECURRING_MIN_INTERVALS = 4
+RECURRING_MAX_CV = 0.35       # spread of the intervals / their mean
+RECURRING_MIN_DAYS = 3        # daily staples are not "recurring purchases"
+BATCH = 20000
+
+_STATE_COLUMNS = ('line_count', 'mean_log', 'var_log', 'last_day', 'interval_count', 'interval_mean',
+                  'interval_var')
+
+
+def _rolling(count, mean, var, x):
+    """(mean, var) after adding x: exact for the first 1/ALPHA values, then exponentially weighted."""
+    if count == 0:
+        return x, 0.0
+    weight = max(ALPHA, 1.0 / (count + 1))
+    diff = x - mean
+    mean += weight * diff
+    var = (1 - weight) * (var + weight * diff * diff)
+    return mean, var
+
+
+def is_recurring(interval_count, interval_mean, interval_var):
+    return (interval_count >= RECURRING_MIN_INTERVALS and interval_mean >= RECURRING_MIN_DAYS
+            and math.sqrt(interval_var) <= RECURRING_MAX_CV * interval_mean)
+
+
+def _receipt_lines(cursor, receipt_nr, up_to_id):
+    cursor.execute("""
+        SELECT product_id, price_bani, quantity_milli, discount_bani, MIN(id) FROM expenses
+        WHERE receipt_nr = ? AND id <= ? GROUP BY product_id, price_bani, quantity_milli, discount_bani
+    """, (receipt_nr, up_to_id))
+    return {row[:4]: row[4] for row in cursor.fetchall()}
+
+
+def _process(cursor, lines, last_id):
+    states = {}
+    receipts = {}
+    flags = []
+    for expense_id, product_id, receipt_nr, quantity_type, price_bani, quantity_milli, discount_bani, total_bani, \
+            day in lines:
+        if receipt_nr is not None:
+            seen = receipts.get(receipt_nr)
+            if seen is None:
+                # lines of this receipt from earlier runs, read once per receipt
+                seen = receipts[receipt_nr] = _receipt_lines(cursor, receipt_nr, last_id) if last_id else {}
+            key = (product_id, price_bani, quantity_milli, discount_bani)
+            first = seen.setdefault(key, expense_id)
+            if first != expense_id and product_id is not None:
+                flags.append((expense_id, 'duplicate', None, None, first))
+        if product_id is None:
+            continue
+        state_key = (product_id, quantity_type)
+        state = states.get(state_key)
+        if state is None:
+            cursor.execute(f"SELECT {', '.join(_STATE_COLUMNS)} FROM anomaly_stats "
+                           f"WHERE product_id = ? AND quantity_type = ?", state_key)
+            row = cursor.fetchone()
+            state = states[state_key] = list(row) if row else [0, 0.0, 0.0, None, 0, 0.0, 0.0]
+        count, mean, var, last_day, interval_count, interval_mean, interval_var = state
+        if quantity_milli and total_bani and total_bani > 0 and quantity_milli > 0:
+            x = math.log(total_bani * money.MILLI / quantity_milli)
+            if count >= MIN_HISTORY:
+                spread = max(math.sqrt(var), MIN_SPREAD)
+                if x - mean >= math.log(PRICE_RATIO) and (x - mean) / spread >= Z_LIMIT:
+                    usual = round(math.exp(mean))
+                    flags.append((expense_id, 'price', usual, round(math.exp(x - mean), 2), None))
+            mean, var = _rolling(count, mean, var, x)
+            count += 1
+        if day is not None:
+            if last_day is not None and day > last_day:
+                interval_mean, interval_var = _rolling(interval_count, interval_mean, interval_var, day - last_day)
+                interval_count += 1
+            if last_day is None or day > last_day:
+                last_day = day
+        state[:] = count, mean, var, last_day, interval_count, interval_mean, interval_var
+    cursor.executemany(f"""
+        INSERT INTO anomaly_stats (product_id, quantity_type, {', '.join(_STATE_COLUMNS)})
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (product_id, quantity_type) DO UPDATE SET
+            {', '.join(f'{c} = excluded.{c}' for c in _STATE_COLUMNS)}
+    """, (key + tuple(state) for key, state in states.items()))
+    cursor.executemany("""
+        INSERT INTO expense_flags (expense_id, kind, usual_bani, ratio, other_expense_id)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (expense_id, kind) DO NOTHING
+    """, flags)
+    return len(flags)
+
+
+def detect(conn, batch=BATCH):
+    """Write operation: check the expenses added since the last run and advance
+    anomaly_progress. Returns (lines checked, flags added)."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT last_expense_id FROM anomaly_progress WHERE id = 1")
+    last_id = cursor.fetchone()[0]
+    checked = flagged = 0
+    while True:
+        cursor.execute("""
+            SELECT id, product_id, receipt_nr, IFNULL(quantity_type, 'buc'), price_bani, quantity_milli,
+                   discount_bani, line_total_bani, day
+            FROM expenses WHERE id > ? ORDER BY id LIMIT ?
+        """, (last_id, batch))
+        lines = cursor.fetchall()
+        if not lines:
+            break
+        flagged += _process(cursor, lines, last_id)
+        checked += len(lines)
+        last_id = lines[-1][0]
+    cursor.execute("UPDATE anomaly_progress SET last_expense_id = ? WHERE id = 1", (last_id,))
+    return checked, flagged
+
+
+def pending(cursor):
+    """True when expenses were added since the last detect()."""
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM expenses WHERE id > "
+                   "(SELECT last_expense_id FROM anomaly_progress WHERE id = 1))")
+    # fetchall: the finished statement holds no lock while the caller runs detect()
+    return bool(cursor.fetchall()[0][0])
+
+
+def reset(conn):
+    """Write operation: forget the state and flags; the next detect() checks every line again."""
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM anomaly_stats")
+    cursor.execute("DELETE FROM expense_flags")
+    cursor.execute("UPDATE anomaly_progress SET last_expense_id = 0 WHERE id = 1")
+
+
+def flags(cursor, expense_ids=None):
+    """{expense_id: [flag dict, ...]} for the given lines, or for every flagged line."""
+    sql = "SELECT expense_id, kind, usual_bani, ratio, other_expense_id FROM expense_flags"
+    params = ()
+    if expense_ids is not None:
+        expense_ids = list(expense_ids)
+        if not expense_ids:
+            return {}
+        sql += f" WHERE expense_id IN ({', '.join('?' * len(expense_ids))})"
+        params = expense_ids
+    cursor.execute(sql + " ORDER BY expense_id, kind", params)
+    result = {}
+    for expense_id, kind, usual_bani, ratio, other_id in cursor.fetchall():
+        result.setdefault(expense_id, []).append({'kind': kind, 'usual': money.lei(usual_bani), 'ratio': ratio,
+                                                  'other_expense_id': other_id})
+    return result
+
+
+def recurring(cursor):
+    """Recurring purchases, the next one due first: [{product_id, name, quantity_type,
+    interval_days, last_date, next_date, next_day, purchases}, ...]."""
+    cursor.execute("""
+        SELECT a.product_id, p.name, a.quantity_type, a.interval_count, a.interval_mean, a.interval_var, a.last_day
+        FROM anomaly_stats a JOIN products p ON p.id = a.product_id
+        WHERE a.interval_count >= ? AND a.interval_mean >= ?
+    """, (RECURRING_MIN_INTERVALS, RECURRING_MIN_DAYS))
+    result = []
+    for product_id, name, quantity_type, count, mean, var, last_day in cursor.fetchall():
+        if not is_recurring(count, mean, var):
+            continue
+        result.append({'product_id': product_id, 'name': name, 'quantity_type': quantity_type,
+                       'interval_days': round(mean, 1), 'last_date': dates.iso(last_day),
+                       'next_date': dates.iso(last_day + round(mean)), 'next_day': last_day + round(mean),
+                       'purchases': count + 1})
+    result.sort(key=lambda r: (r['next_day'], r['name']))
+    return result
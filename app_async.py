@@ -0,0 +1,179 @@
+"""
+ASGI entry point with async variants of the JSON endpoints used by record_expense.html.
+
+GET /products/search, /products/suggestion, /products/bought_with, /budgets/status and POST
+/create_receipt, /add_line_item, /update_expense, /delete_expense are answered on the event loop. Their SQLite work (the same
+handle_* functions the Flask routes in app_web.py use) runs on a bounded thread
+pool, so many concurrent typeahead and line-item requests overlap instead of
+each holding a server thread while it waits on the database. Every other path
+(HTML pages, reports, static files) is passed to the Flask app unchanged.
+
+Run:
+  python serve.py --async [--workers N] [--db-threads M]
+  uvicorn app_async:app --host 0.0.0.0 --port 5000
+
+Environment:
+  EXPENSES_DB_THREADS      executor threads doing SQLite work (default 8)
+  EXPENSES_DB_MAX_PENDING  requests allowed to queue for the executor before
+                           new ones wait on the event loop (default 8 x threads)
+  EXPENSES_WSGI_THREADS    threads for the pass-through Flask pages (default 8)
+"""
+
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import format_datetime
+from time import perf_counter
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+from werkzeug.http import parse_etags
+
+import metrics
+from app_web import (app as flask_app, current_month_vary, data_cache_validators, ensure_schema,
+                     handle_add_line_item, handle_bought_with, handle_budget_status, handle_create_receipt,
+                     handle_delete_expense, handle_price_suggestion, handle_products_search, handle_update_expense)
+from report_snapshot import report_snapshot
+
+DB_THREADS = int(os.environ.get('EXPENSES_DB_THREADS', '8'))
+MAX_PENDING = int(os.environ.get('EXPENSES_DB_MAX_PENDING', str(DB_THREADS * 8)))
+WSGI_THREADS = int(os.environ.get('EXPENSES_WSGI_THREADS', '8'))
+
+# (method, path) -> (metrics endpoint name, handler); names match the Flask endpoints
+ROUTES = {
+    ('GET', '/products/search'): ('products_search', handle_products_search),
+    ('GET', '/products/suggestion'): ('products_suggestion', handle_price_suggestion),
+    ('GET', '/products/bought_with'): ('products_bought_with', handle_bought_with),
+    ('GET', '/budgets/status'): ('budget_status', handle_budget_status),
+    ('POST', '/create_receipt'): ('create_receipt_route', handle_create_receipt),
+    ('POST', '/add_line_item'): ('add_line_item_route', handle_add_line_item),
+    ('POST', '/update_expense'): ('update_expense_route', handle_update_expense),
+    ('POST', '/delete_expense'): ('delete_expense_route', handle_delete_expense),
+}
+# endpoint -> vary(args) of its Flask route's cached_by_data_version
+VARY = {'budget_status': current_month_vary}
+
+_db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix='expenses-db')
+_pending = None  # asyncio.Semaphore, created on the running loop
+_flask = WSGIMiddleware(flask_app, workers=WSGI_THREADS)
+
+
+def _call_handler(handler, args):
+    """Runs on an executor thread; returns the handler result plus its SQLite time."""
+    # what app_web's before/after_request hooks do for the Flask routes (no-op once the schema was checked)
+    ensure_schema()
+    report_snapshot.reset()
+    metrics.take_db_time()
+    try:
+        payload, status = handler(args)
+    finally:
+        report_snapshot.release_stale()
+    return payload, status, metrics.take_db_time()
+
+
+async def run_db(fn, *args):
+    """Run blocking database work on the bounded executor."""
+    global _pending
+    if _pending is None:
+        _pending = asyncio.Semaphore(MAX_PENDING)
+    async with _pending:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_db_executor, fn, *args)
+
+
+async def _read_body(receive):
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        more_body = message.get('more_body', False)
+    return b''.join(chunks)
+
+
+def _parse_qs(raw):
+    # same semantics as request.form/request.args .get(): first value wins
+    return {k: v[0] for k, v in parse_qs(raw, keep_blank_values=True).items()}
+
+
+async def _send_json(send, payload, status, extra_headers=()):
+    body = json.dumps(payload).encode('utf-8') if status != 304 else b''
+    headers = [(b'content-type', b'application/json'),
+               (b'content-length', str(len(body)).encode('ascii'))]
+    headers.extend(extra_headers)
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _header(scope, name):
+    for key, value in scope.get('headers', ()):
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def _cache_headers(scope, vary=''):
+    """Validators for GET routes (same as app_web.cached_by_data_version) and whether the client copy is current."""
+    etag, last_modified = data_cache_validators(vary=vary)
+    # parsed like Flask's request.if_none_match, so "*", lists and W/ tags match the same way
+    not_modified = parse_etags(_header(scope, b'if-none-match')).contains(etag)
+    headers = [(b'etag', f'"{etag}"'.encode('ascii')),
+               (b'last-modified', format_datetime(last_modified, usegmt=True).encode('ascii')),
+               (b'cache-control', b'no-cache')]
+    return not_modified, headers
+
+
+def _is_urlencoded(scope):
+    content_type = _header(scope, b'content-type') or ''
+    return content_type.split(';')[0].strip() == 'application/x-www-form-urlencoded'
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # schema checks before the first request rather than inside it
+            await run_db(ensure_schema)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            _db_executor.shutdown(wait=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+
+    route = ROUTES.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+    # multipart posts (not sent by record_expense.html) are left to Flask's form parser
+    if route is None or (scope['method'] == 'POST' and not _is_urlencoded(scope)):
+        await _flask(scope, receive, send)
+        return
+
+    endpoint, handler = route
+    start = perf_counter()
+    extra_headers = ()
+    if scope['method'] == 'POST':
+        args = _parse_qs((await _read_body(receive)).decode('utf-8'))
+    else:
+        args = _parse_qs(scope.get('query_string', b'').decode('utf-8'))
+        vary = VARY.get(endpoint)
+        not_modified, extra_headers = _cache_headers(scope, vary(args) if vary else '')
+        if not_modified:
+            await _send_json(send, None, 304, extra_headers)
+            metrics.record_request(endpoint, 'GET', 304, perf_counter() - start)
+            return
+
+    db_time = 0.0
+    try:
+        payload, status, db_time = await run_db(_call_handler, handler, args)
+    except Exception as e:
+        # logged with the traceback like Flask's log_exception; the 500 is counted in
+        # expenses_http_request_errors_total by metrics.record_request below
+        flask_app.logger.exception('Exception on %s [%s]', scope['path'], scope['method'])
+        payload, status = {'success': False, 'error': 'internal_error', 'details': str(e)}, 500
+    await _send_json(send, payload, status, extra_headers if status == 200 else ())
+    metrics.record_request(endpoint, scope['method'], status, perf_counter() - start, db_time)
@@ -1,19 +1,75 @@
-from flask import Flask, render_template, request, redirect, make_response, jsonify
-import sqlite3
+from flask import Flask, abort, render_template, request, redirect, make_response, jsonify, send_file
+from flask import before_render_template, template_rendered
+from markupsafe import Markup, escape
 import os
 import csv
+import re
+import functools
+import io
 from io import StringIO
-from datetime import datetime
+from datetime import datetime, timezone
+
+import anomalies
+import basket_rules
+import budgets
+import dates
+import image_store
+import metrics
+import money
+import price_analytics
+import schema
+from db import BASE_DIR, data_version, get_db
+from db_writer import run_write
+from price_analytics import price_history
+from importer import ImportFormatError, Importer, detect_format, import_stream
+from report_cache import report_cache
+from report_snapshot import report_snapshot
 
 app = Flask(__name__)
 
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 PRODUCTS_DB = os.path.join(BASE_DIR, "products.db")
-EXPENSES_DB = os.path.join(BASE_DIR, "expenses.db")
+
+
+# --- Metrici (Prometheus) ---
+@app.before_request
+def _metrics_start_request():
+    metrics.start_request()
+    report_snapshot.reset()
+
+
+@app.after_request
+def _metrics_finish_request(response):
+    metrics.finish_request(request.endpoint or 'unmatched', request.method, response.status_code)
+    # don't let an idle worker keep an old WAL snapshot open (see report_snapshot.py)
+    report_snapshot.release_stale()
+    return response
+
+
+def _metrics_before_render(sender, template, context, **extra):
+    metrics.start_render()
+
+
+def _metrics_after_render(sender, template, context, **extra):
+    metrics.end_render()
+
+
+before_render_template.connect(_metrics_before_render, app)
+template_rendered.connect(_metrics_after_render, app)
+
+
+@app.route('/metrics')
+def metrics_route():
+    """Prometheus text exposition; only answered for local scrapers."""
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        return 'Forbidden', 403
+    response = make_response(metrics.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
 
 # --- Funcții produse ---
 def get_categories():
-    conn = sqlite3.connect('expenses.db')
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("SELECT id, categorie FROM categorii ORDER BY categorie")
     categories = cursor.fetchall()
@@ -21,7 +77,7 @@ def get_categories():
     return categories
 
 def get_products():
-    conn = sqlite3.connect('expenses.db')
+    conn = get_db()
     cursor = conn.cursor()
     # Return product id, name and category name (if available)
     cursor.execute("""
@@ -35,7 +91,7 @@ def get_products():
     return products
 
 def get_product_by_name(name):
-    conn = sqlite3.connect('expenses.db')
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("SELECT id FROM products WHERE UPPER(name) = UPPER(?)", (name,))
     row = cursor.fetchone()
@@ -43,84 +99,59 @@ def get_product_by_name(name):
     return row[0] if row else None
 
 
-def add_product(name, category_id):
-    """Ensure a product exists with given name and category_id. Return product id."""
-    existing_id = get_product_by_name(name)
-    if existing_id:
-        return existing_id
-
-    conn = sqlite3.connect('expenses.db')
+# All writes go through the single writer (db_writer.py): the *_op functions
+# receive the writer's connection and must not commit themselves.
+def _add_product_op(conn, name, category_id):
     cursor = conn.cursor()
+    cursor.execute("SELECT id FROM products WHERE UPPER(name) = UPPER(?)", (name,))
+    row = cursor.fetchone()
+    if row:
+        return row[0]
     cursor.execute("INSERT INTO products (name, category_id) VALUES (?, ?)", (name, category_id))
-    conn.commit()
-    new_id = cursor.lastrowid
-    conn.close()
-    return new_id
+    return cursor.lastrowid
 
 
-def ensure_receipts_schema():
-    """Ensure receipts table exists and expenses has receipt_id column."""
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
-    # Create receipts table if missing. New schema uses nr_bon as primary key (TEXT).
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS receipts (
-            nr_bon TEXT PRIMARY KEY,
-            store_id INTEGER,
-            date TEXT
-        )
-    """)
-    # Ensure expenses has receipt_nr (TEXT) column for linking to receipts.nr_bon
-    cursor.execute("PRAGMA table_info(expenses)")
-    cols = [r[1] for r in cursor.fetchall()]
-    if 'receipt_nr' not in cols:
-        try:
-            cursor.execute("ALTER TABLE expenses ADD COLUMN receipt_nr TEXT")
-        except Exception:
-            pass
-    conn.commit()
-    conn.close()
+def add_product(name, category_id):
+    """Ensure a product exists with given name and category_id. Return product id."""
+    return run_write(_add_product_op, name, category_id)
 
 
-def ensure_expense_discount_column():
-    """Ensure the expenses table has a discount column (REAL)."""
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
-    cursor.execute("PRAGMA table_info(expenses)")
-    cols = [r[1] for r in cursor.fetchall()]
-    if 'discount' not in cols:
-        try:
-            cursor.execute("ALTER TABLE expenses ADD COLUMN discount REAL DEFAULT 0.0")
-        except Exception:
-            # best-effort; if it fails we'll still proceed
-            pass
-    conn.commit()
-    conn.close()
+_schema_checked = False
+
 
+@app.before_request
+def ensure_schema():
+    """Run the best-effort schema checks (schema.py) once per process."""
+    global _schema_checked
+    if not _schema_checked:
+        run_write(schema.ensure_all)
+        _schema_checked = True
 
-def create_receipt(store_id, nr_bon, date_value):
-    ensure_receipts_schema()
-    conn = sqlite3.connect('expenses.db')
+
+def _create_receipt_op(conn, store_id, nr_bon, date_value, ocr_text=None):
     cursor = conn.cursor()
     # ensure nr_bon non-empty; generate fallback if empty
     if not nr_bon or str(nr_bon).strip() == '':
         nr_bon = f"AUTO-{int(datetime.utcnow().timestamp())}"
+    day = dates.to_day(date_value) if date_value else None
     try:
-        cursor.execute("INSERT INTO receipts (nr_bon, store_id, date) VALUES (?, ?, ?)",
-                       (nr_bon, store_id, date_value))
-        conn.commit()
+        cursor.execute("INSERT INTO receipts (nr_bon, store_id, date, day, ocr_text) VALUES (?, ?, ?, ?, ?)",
+                       (nr_bon, store_id, date_value, day, ocr_text))
     except Exception:
         # if insertion fails because nr_bon exists, append suffix
         nr_bon = f"{nr_bon}-{int(datetime.utcnow().timestamp())}"
-        cursor.execute("INSERT INTO receipts (nr_bon, store_id, date) VALUES (?, ?, ?)",
-                       (nr_bon, store_id, date_value))
-        conn.commit()
-    conn.close()
+        cursor.execute("INSERT INTO receipts (nr_bon, store_id, date, day, ocr_text) VALUES (?, ?, ?, ?, ?)",
+                       (nr_bon, store_id, date_value, day, ocr_text))
     return nr_bon
 
+
+def create_receipt(store_id, nr_bon, date_value, ocr_text=None):
+    ensure_schema()
+    return run_write(_create_receipt_op, store_id, nr_bon, date_value, ocr_text)
+
 # --- Funcții magazine ---
 def get_stores():
-    conn = sqlite3.connect('expenses.db')
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("SELECT id, name, store_type FROM stores ORDER BY name")
     stores = cursor.fetchall()
@@ -129,68 +160,87 @@ def get_stores():
 
 def store_exists(name):
     """Check if a store with this name already exists (case insensitive)."""
-    conn = sqlite3.connect('expenses.db')
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("SELECT 1 FROM stores WHERE UPPER(name) = UPPER(?)", (name,))
     exists = cursor.fetchone() is not None
     conn.close()
     return exists
 
+def _add_store_op(conn, name, store_type=None):
+    """Insert the store unless the name exists (case insensitive). Returns True if inserted."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM stores WHERE UPPER(name) = UPPER(?)", (name,))
+    if cursor.fetchone():
+        return False
+    cursor.execute("INSERT INTO stores (name, store_type) VALUES (?, ?)", (name, store_type))
+    return True
+
+
 def add_store(name):
     """Add a new store if it doesn't already exist.
     Returns: (bool, str) - (success, message)"""
-    if store_exists(name):
-        return False, f"Magazinul '{name.upper()}' există deja!"
-    
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
     # Convert to upper case before saving
     name = name.upper()
-    cursor.execute("INSERT INTO stores (name) VALUES (?)", (name,))
-    conn.commit()
-    conn.close()
+    if not run_write(_add_store_op, name):
+        return False, f"Magazinul '{name}' există deja!"
     return True, f"Magazinul '{name}' a fost adăugat cu succes!"
 
+
+def _update_store_op(conn, store_id, new_name, store_type):
+    cursor = conn.cursor()
+    cursor.execute("UPDATE stores SET name = ?, store_type = ? WHERE id = ?",
+                   (new_name, store_type, store_id))
+
+
+def _update_store_name_op(conn, store_id, new_name):
+    cursor = conn.cursor()
+    cursor.execute("UPDATE stores SET name = ? WHERE id = ?", (new_name, store_id))
+
+
 def update_store_name(store_id, new_name):
     """Update a store's name."""
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
     # Convert to upper case before saving
-    new_name = new_name.upper()
-    cursor.execute("UPDATE stores SET name = ? WHERE id = ?", (new_name, store_id))
-    conn.commit()
-    conn.close()
+    run_write(_update_store_name_op, store_id, new_name.upper())
 
 # --- Funcții cheltuieli ---
-def add_expense(product_id, store_id, price, quantity, date_value, receipt_id=None, discount=0.0):
-    # ensure discount and receipt_nr column exists (best-effort)
-    ensure_expense_discount_column()
-    ensure_receipts_schema()
-    conn = sqlite3.connect('expenses.db')
+# one line's amount in lei for display (expenses.line_total_bani, see schema.ensure_line_total)
+LINE_TOTAL_LEI = "(e.line_total_bani / 100.0)"
+
+def _add_expense_op(conn, product_id, store_id, price_bani, quantity_milli, date_value, receipt_id=None,
+                    discount_bani=0):
     cursor = conn.cursor()
+    line_total = money.line_total_bani(price_bani, quantity_milli, discount_bani)
+    day = dates.to_day(date_value) if date_value else None
     # receipt_id here is actually the receipt_nr (string) when provided
     if receipt_id is not None:
         receipt_nr = str(receipt_id)
         cursor.execute(
-            "INSERT INTO expenses (product_id, store_id, price, quantity, date, receipt_nr, discount) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (product_id, store_id, price, quantity, date_value, receipt_nr, discount)
+            "INSERT INTO expenses (product_id, store_id, price_bani, quantity_milli, date, receipt_nr, discount_bani, line_total_bani, day) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (product_id, store_id, price_bani, quantity_milli, date_value, receipt_nr, discount_bani, line_total, day)
         )
     else:
         cursor.execute(
-            "INSERT INTO expenses (product_id, store_id, price, quantity, date, discount) VALUES (?, ?, ?, ?, ?, ?)",
-            (product_id, store_id, price, quantity, date_value, discount)
+            "INSERT INTO expenses (product_id, store_id, price_bani, quantity_milli, date, discount_bani, line_total_bani, day) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (product_id, store_id, price_bani, quantity_milli, date_value, discount_bani, line_total, day)
         )
-    conn.commit()
-    new_id = cursor.lastrowid
-    conn.close()
-    return new_id
+    return cursor.lastrowid
+
+
+def add_expense(product_id, store_id, price_bani, quantity_milli, date_value, receipt_id=None, discount_bani=0):
+    """Insert one expense; amounts are integer bani / milli-units (see money.py),
+    date_value is 'YYYY-MM-DD' (dates.to_iso) or None."""
+    # ensure discount and receipt_nr column exists (best-effort)
+    ensure_schema()
+    return run_write(_add_expense_op, product_id, store_id, price_bani, quantity_milli, date_value,
+                     receipt_id, discount_bani)
 
 def get_expenses():
-    conn = sqlite3.connect('expenses.db')
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute("""
-     SELECT e.id, p.name, s.name, e.price, e.quantity, IFNULL(e.discount, 0) as discount,
-         (e.price * e.quantity - IFNULL(e.discount,0)) AS total,
+    cursor.execute(f"""
+     SELECT e.id, p.name, s.name, e.price, e.quantity, e.discount,
+         {LINE_TOTAL_LEI} AS total,
          e.date, r.nr_bon
      FROM expenses e
      LEFT JOIN products p ON e.product_id = p.id
@@ -204,13 +254,81 @@ def get_expenses():
 
 # --- Funcții auxiliare ---
 def query_db(db_name, query, params=()):
-    conn = sqlite3.connect(db_name)
+    conn = get_db(db_name)
     cursor = conn.cursor()
     cursor.execute(query, params)
     results = cursor.fetchall()
     conn.close()
     return results
 
+# --- Cache HTTP (ETag / Last-Modified) ---
+def _code_version():
+    """Newest mtime of the app and its templates, so a deploy also changes the ETag."""
+    template_dir = os.path.join(BASE_DIR, 'templates')
+    paths = [os.path.abspath(__file__)] + [os.path.join(template_dir, f) for f in os.listdir(template_dir)]
+    return max(int(os.stat(p).st_mtime) for p in paths)
+
+
+CODE_VERSION = _code_version()
+
+
+def data_cache_validators(version=None, vary=''):
+    """(etag, last_modified) for the current data version (or `version`); costs one stat(), no database access.
+    `vary` goes into the etag of answers that also depend on something besides the data (see current_month_vary)."""
+    if version is None:
+        version = data_version()
+    etag = f"{CODE_VERSION:x}-{version:x}" + (f"-{vary}" if vary else '')
+    last_modified = datetime.fromtimestamp(max(version // 1_000_000_000, CODE_VERSION), tz=timezone.utc)
+    return etag, last_modified
+
+
+def current_month_vary(args):
+    """The current month when the month argument is omitted: the answer for "this month"
+    changes when the month does, with or without a write."""
+    return '' if (args.get('month') or '').strip() else datetime.now().strftime('%Y-%m')
+
+
+def cached_by_data_version(view=None, *, vary=None):
+    """Answer conditional GETs with 304 while the data version is unchanged.
+
+    The validators are taken before the view runs, so a write that lands
+    while the page is being built only makes the next request miss. A page
+    read from a report snapshot that is behind gets the snapshot's validators.
+    vary(request.args), when given, is added to the etag; such answers are
+    only revalidated by ETag.
+    """
+    if view is None:
+        return functools.partial(cached_by_data_version, vary=vary)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = vary(request.args) if vary else ''
+        etag, last_modified = data_cache_validators(vary=key)
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
+        elif key:
+            # Last-Modified cannot tell the variants apart
+            not_modified = False
+        else:
+            # second resolution only; ETag is preferred whenever the client sends one
+            since = request.if_modified_since
+            not_modified = since is not None and last_modified <= since
+        if not_modified:
+            response = make_response('', 304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            read_version = report_snapshot.version()
+            if read_version is not None and read_version != data_version():
+                # built from a report snapshot that is behind: label it with the snapshot's version
+                etag, last_modified = data_cache_validators(read_version, key)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        # let browsers keep the copy but always revalidate
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return wrapper
+
+
 # --- Rute web ---
 @app.route('/')
 def index():
@@ -229,68 +347,78 @@ def add_product_route():
 def add_store_route():
     name = request.form.get('name', '').strip()
     store_type = request.form.get('store_type', '').strip()
-    
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT 1 FROM stores WHERE UPPER(name) = UPPER(?)", (name,))
-    if cursor.fetchone():
-        conn.close()
+
+    name = name.upper()
+    if not run_write(_add_store_op, name, store_type if store_type else None):
         return render_template('add_store.html', 
                              stores=get_stores(),
-                             message=f"Magazinul '{name.upper()}' există deja!",
+                             message=f"Magazinul '{name}' există deja!",
                              success=False)
-    
-    name = name.upper()
-    cursor.execute("INSERT INTO stores (name, store_type) VALUES (?, ?)", (name, store_type if store_type else None))
-    conn.commit()
-    conn.close()
     return render_template('add_store.html',
                          stores=get_stores(),
                          message=f"Magazinul '{name}' a fost adăugat cu succes!",
                          success=True)
 
 
-def delete_store(store_id):
-    """Delete a store and any related expenses."""
-    conn = sqlite3.connect('expenses.db')
+def _delete_store_op(conn, store_id):
+    """Delete a store with its receipts and expense lines (set-based, one savepoint).
+
+    With the declared ON DELETE CASCADE keys (scripts/migrate_0006_foreign_keys.py)
+    deleting the store alone would do; the explicit child deletes keep the
+    counts exact and also clean up databases that are not migrated yet.
+    Returns the number of deleted rows per table.
+    """
     cursor = conn.cursor()
-    # Remove expenses referencing this store first to keep DB consistent
-    cursor.execute("DELETE FROM expenses WHERE store_id = ?", (store_id,))
+    cursor.execute("""
+        DELETE FROM expenses
+        WHERE store_id = ? OR receipt_nr IN (SELECT nr_bon FROM receipts WHERE store_id = ?)
+    """, (store_id, store_id))
+    expenses = cursor.rowcount
+    cursor.execute("DELETE FROM receipts WHERE store_id = ?", (store_id,))
+    receipts = cursor.rowcount
     cursor.execute("DELETE FROM stores WHERE id = ?", (store_id,))
-    conn.commit()
-    conn.close()
+    return {'stores': cursor.rowcount, 'receipts': receipts, 'expenses': expenses}
 
 
-def delete_receipt(receipt_id):
-    """Delete a receipt and any related expenses. receipt_id is the nr_bon string."""
-    receipt_nr = str(receipt_id)
-    conn = sqlite3.connect('expenses.db')
+def delete_store(store_id):
+    """Delete a store and its receipts and expenses. Returns deleted row counts per table."""
+    return run_write(_delete_store_op, store_id)
+
+
+def _delete_receipt_op(conn, receipt_nr):
     cursor = conn.cursor()
     cursor.execute("DELETE FROM expenses WHERE receipt_nr = ?", (receipt_nr,))
+    expenses = cursor.rowcount
     cursor.execute("DELETE FROM receipts WHERE nr_bon = ?", (receipt_nr,))
-    conn.commit()
-    conn.close()
+    return {'receipts': cursor.rowcount, 'expenses': expenses}
+
+
+def delete_receipt(receipt_id):
+    """Delete a receipt and its expense lines. receipt_id is the nr_bon string.
+    Returns deleted row counts per table."""
+    return run_write(_delete_receipt_op, str(receipt_id))
 
 
 @app.route('/stores/delete', methods=['POST'])
 def delete_store_route():
     store_id = int(request.form['store_id'])
-    delete_store(store_id)
-    return redirect('/stores/new')
+    deleted = delete_store(store_id)
+    if not deleted['stores']:
+        return render_template('add_store.html', stores=get_stores(),
+                               message="Magazinul nu există.", success=False)
+    return render_template('add_store.html', stores=get_stores(),
+                           message=f"Magazin șters, împreună cu {deleted['receipts']} bonuri "
+                                   f"și {deleted['expenses']} cheltuieli.",
+                           success=True)
 
 @app.route('/stores/update', methods=['POST'])
 def update_store_route():
     store_id = int(request.form['store_id'])
     new_name = request.form['name'].strip()
     store_type = request.form.get('store_type', '').strip()
-    
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
+
     new_name = new_name.upper()
-    cursor.execute("UPDATE stores SET name = ?, store_type = ? WHERE id = ?",
-                   (new_name, store_type if store_type else None, store_id))
-    conn.commit()
-    conn.close()
+    run_write(_update_store_op, store_id, new_name, store_type if store_type else None)
     return redirect('/stores/new')
 
 @app.route('/stores/new')
@@ -299,6 +427,84 @@ def new_store_page():
     return render_template('add_store.html', stores=stores)
 
 
+STORE_RECEIPTS_PAGE = 25
+STORE_TOP_PRODUCTS = 10
+
+
+@app.route('/stores/<int:store_id>')
+def store_receipts(store_id):
+    """Store page: summary from store_stats (maintained by triggers, see schema.py),
+    top products and the receipt history, newest first, paginated by (IFNULL(date, ''), nr_bon) keyset."""
+    before_date = request.args.get('before_date')
+    before_nr = request.args.get('before_nr')
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, name, store_type FROM stores WHERE id = ?", (store_id,))
+    store = cursor.fetchone()
+    if not store:
+        conn.close()
+        return "Magazinul nu există", 404
+
+    cursor.execute("""
+        SELECT receipt_count, line_count, spend_bani / 100.0, first_visit, last_visit
+        FROM store_stats WHERE store_id = ?
+    """, (store_id,))
+    stats = cursor.fetchone() or (0, 0, 0.0, None, None)
+
+    cursor.execute("""
+        SELECT p.name, sp.line_count, sp.quantity_milli / 1000.0, sp.spend_bani / 100.0
+        FROM store_product_stats sp
+        JOIN products p ON p.id = sp.product_id
+        WHERE sp.store_id = ?
+        ORDER BY sp.spend_bani DESC
+        LIMIT ?
+    """, (store_id, STORE_TOP_PRODUCTS))
+    top_products = cursor.fetchall()
+
+    # one extra row tells whether there is a next page; (IFNULL(date, ''), nr_bon)
+    # is the idx_receipts_store_day_key index order, so every page is a single range
+    # scan, and undated receipts ('' sorts below every date) come last instead of
+    # falling out of the row-value comparison
+    if before_date is not None and before_nr is not None:
+        cursor.execute("""
+            SELECT nr_bon, date, total_bani, line_count FROM receipts
+            WHERE store_id = ? AND (IFNULL(date, ''), nr_bon) < (?, ?)
+            ORDER BY IFNULL(date, '') DESC, nr_bon DESC
+            LIMIT ?
+        """, (store_id, before_date, before_nr, STORE_RECEIPTS_PAGE + 1))
+    else:
+        cursor.execute("""
+            SELECT nr_bon, date, total_bani, line_count FROM receipts
+            WHERE store_id = ?
+            ORDER BY IFNULL(date, '') DESC, nr_bon DESC
+            LIMIT ?
+        """, (store_id, STORE_RECEIPTS_PAGE + 1))
+    rows = cursor.fetchall()
+    next_page = None
+    if len(rows) > STORE_RECEIPTS_PAGE:
+        rows = rows[:STORE_RECEIPTS_PAGE]
+        next_page = {'before_date': rows[-1][1] or '', 'before_nr': rows[-1][0]}
+
+    # totals come from the receipt headers (maintained by triggers, see schema.ensure_receipt_totals)
+    receipts = [{'nr_bon': nr_bon, 'date': rdate, 'lines': [], 'total': money.lei(total_bani), 'line_count': line_count}
+                for nr_bon, rdate, total_bani, line_count in rows]
+    if receipts:
+        by_nr = {r['nr_bon']: r for r in receipts}
+        cursor.execute(f"""
+            SELECT e.receipt_nr, e.id, p.name, e.price, e.quantity, e.discount,
+                   {LINE_TOTAL_LEI} AS total, IFNULL(e.quantity_type,'buc') as quantity_type
+            FROM expenses e
+            LEFT JOIN products p ON e.product_id = p.id
+            WHERE e.receipt_nr IN ({','.join('?' * len(by_nr))})
+            ORDER BY e.id
+        """, list(by_nr))
+        for line in cursor.fetchall():
+            by_nr[line[0]]['lines'].append(line[1:])
+    conn.close()
+    return render_template('store_receipts.html', store=store, stats=stats, top_products=top_products,
+                           receipts=receipts, next_page=next_page, first_page=before_date is None)
+
+
 @app.route('/record_expense')
 def record_expense():
     products = get_products()
@@ -307,10 +513,55 @@ def record_expense():
     return render_template('record_expense.html', products=products, stores=stores, categories=categories)
 
 
-@app.route('/products/search')
-def products_search():
-    q = request.args.get('q', '').strip()
-    conn = sqlite3.connect('expenses.db')
+# --- Endpoint-uri JSON (AJAX) ---
+# Each handle_* function takes the request arguments (a dict-like: request.form,
+# request.args or the parsed body in app_async.py) and returns (payload, status),
+# so the same logic serves the Flask routes below and the async variants.
+def price_suggestions(cursor, product_ids, store_id=None):
+    """{product_id: suggestion} from product_prices (primary key seeks): the last price,
+    unit and typical quantity at store_id, or at the store the product was last bought
+    in when it was never bought there. Products never bought are left out."""
+    product_ids = list(product_ids)
+    if not product_ids:
+        return {}
+    cursor.execute(f"""
+        SELECT product_id, store_id, last_date, last_expense_id, price_bani, quantity_type,
+               line_count, quantity_sum_milli
+        FROM product_prices WHERE product_id IN ({', '.join('?' * len(product_ids))})
+    """, product_ids)
+    best = {}
+    for row in cursor.fetchall():
+        product_id = row[0]
+        # this store first, then the newest line anywhere
+        key = (row[1] == store_id, row[2] or '', row[3])
+        if product_id not in best or key > best[product_id][0]:
+            best[product_id] = (key, row)
+    suggestions = {}
+    for product_id, (_, row) in best.items():
+        _, sid, last_date, _, price_bani, quantity_type, line_count, quantity_sum = row
+        typical = round(quantity_sum / line_count) if line_count else money.MILLI
+        if quantity_type != 'kg':
+            # pieces: the average rounded to whole pieces, at least one
+            typical = max(money.MILLI, round(typical / money.MILLI) * money.MILLI)
+        suggestions[product_id] = {'price': money.lei(price_bani), 'quantity': money.units(typical),
+                                   'quantity_type': quantity_type or 'buc', 'last_date': last_date,
+                                   'store_id': sid, 'same_store': sid == store_id, 'line_count': line_count}
+    return suggestions
+
+
+def _store_id_arg(args):
+    """Optional integer store_id argument; raises ValueError for anything else."""
+    value = args.get('store_id')
+    return int(value) if value not in (None, '') else None
+
+
+def handle_products_search(args):
+    q = (args.get('q') or '').strip()
+    try:
+        store_id = _store_id_arg(args)
+    except ValueError:
+        return {'success': False, 'error': 'invalid_store_id'}, 400
+    conn = get_db()
     cursor = conn.cursor()
     if q:
         cursor.execute("""
@@ -330,50 +581,148 @@ def products_search():
             LIMIT 10
         """)
     rows = cursor.fetchall()
+    suggestions = price_suggestions(cursor, [r[0] for r in rows], store_id)
     conn.close()
     results = []
     for r in rows:
-        results.append({'id': r[0], 'name': r[1], 'category': r[2]})
-    return jsonify(results)
+        results.append({'id': r[0], 'name': r[1], 'category': r[2], 'suggestion': suggestions.get(r[0])})
+    return results, 200
 
 
-@app.route('/create_receipt', methods=['POST'])
-def create_receipt_route():
+def handle_price_suggestion(args):
+    """Suggested price / unit / quantity for one line: product_id and optional store_id."""
+    try:
+        product_id = int(args.get('product_id') or '')
+        store_id = _store_id_arg(args)
+    except ValueError:
+        return {'success': False, 'error': 'invalid_parameter'}, 400
+    conn = get_db()
+    cursor = conn.cursor()
+    suggestion = price_suggestions(cursor, [product_id], store_id).get(product_id)
+    conn.close()
+    return {'success': True, 'product_id': product_id, 'suggestion': suggestion}, 200
+
+
+def handle_bought_with(args):
+    """Products usually bought with the receipt's lines (receipt_id = nr_bon) and / or
+    product_id, from the mined basket_rules, each with its price suggestion at store_id."""
+    receipt_id = (args.get('receipt_id') or '').strip()
+    try:
+        product_id = int(args['product_id']) if args.get('product_id') else None
+        store_id = _store_id_arg(args)
+    except ValueError:
+        return {'success': False, 'error': 'invalid_parameter'}, 400
+    conn = get_db()
+    cursor = conn.cursor()
+    product_ids = set()
+    if receipt_id:
+        cursor.execute("SELECT DISTINCT product_id FROM expenses WHERE receipt_nr = ? AND product_id IS NOT NULL",
+                       (receipt_id,))
+        product_ids.update(r[0] for r in cursor.fetchall())
+    if product_id is not None:
+        product_ids.add(product_id)
+    rows = basket_rules.suggestions(cursor, product_ids)
+    prices = price_suggestions(cursor, [r[0] for r in rows], store_id)
+    conn.close()
+    results = [{'id': pid, 'name': name, 'confidence': confidence, 'lift': lift, 'suggestion': prices.get(pid)}
+               for pid, name, confidence, lift in rows]
+    return {'success': True, 'products': results}, 200
+
+
+def _month_arg(args):
+    """'YYYY-MM' from the month argument, the current month by default; raises ValueError."""
+    month = (args.get('month') or '').strip() or datetime.now().strftime('%Y-%m')
+    if len(month) != 7:
+        raise ValueError(month)
+    return dates.to_iso(month + '-01')[:7]
+
+
+def handle_budget_status(args):
+    """Budgets in force in a month with their spend, read from the per-month counters."""
+    try:
+        month = _month_arg(args)
+    except ValueError:
+        return {'success': False, 'error': 'invalid_month'}, 400
+    conn = get_db()
+    rows = budgets.status(conn.cursor(), month)
+    conn.close()
+    return {'success': True, 'month': month, 'budgets': rows,
+            'alerts': [b for b in rows if b['level'] != 'ok']}, 200
+
+
+def handle_create_receipt(form):
     # create a receipt header and return its id
     # log incoming request for debugging
     try:
-        print('create_receipt called with form:', dict(request.form))
+        print('create_receipt called with form:', dict(form))
     except Exception:
         pass
-    store_id = request.form.get('store_id')
-    nr_bon = request.form.get('nr_bon', '').strip()
-    date_value = request.form.get('date')
+    store_id = form.get('store_id')
+    nr_bon = (form.get('nr_bon') or '').strip()
+    date_value = form.get('date')
+    # raw text of a scanned receipt, kept for /search
+    ocr_text = form.get('ocr_text') or None
     if not store_id:
-        return jsonify({'success': False, 'error': 'store_id_required'}), 400
+        return {'success': False, 'error': 'store_id_required'}, 400
     try:
         store_id = int(store_id)
     except ValueError:
-        return jsonify({'success': False, 'error': 'invalid_store_id'}), 400
+        return {'success': False, 'error': 'invalid_store_id'}, 400
+    # dd.mm.yyyy (as printed on receipts) is accepted and stored as YYYY-MM-DD
     try:
-        rid = create_receipt(store_id, nr_bon, date_value)
+        date_value = dates.to_iso(date_value or datetime.now().date())
+    except ValueError:
+        return {'success': False, 'error': 'invalid_date'}, 400
+    try:
+        rid = create_receipt(store_id, nr_bon, date_value, ocr_text)
         print('created receipt id:', rid)
-        return jsonify({'success': True, 'receipt_id': rid})
+        return {'success': True, 'receipt_id': rid}, 200
     except Exception as e:
         print('create_receipt error:', e)
-        return jsonify({'success': False, 'error': 'internal_error', 'details': str(e)}), 500
+        return {'success': False, 'error': 'internal_error', 'details': str(e)}, 500
 
 
-@app.route('/add_line_item', methods=['POST'])
-def add_line_item_route():
+def _add_line_item_op(conn, receipt_nr, product_id, new_product, price_bani, qty_milli, date_value, discount_bani,
+                      quantity_type):
+    """Insert one receipt line. Returns (expense_id, product_name, budget alerts) or None if the
+    receipt is missing; the alerts read the counters the insert just updated."""
+    cursor = conn.cursor()
+    # retrieve store_id from receipts table for this receipt (to populate expense.store_id)
+    cursor.execute("SELECT store_id, date FROM receipts WHERE nr_bon = ?", (receipt_nr,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    store_id = row[0]
+    # if date not provided for line, fallback to receipt date
+    if not date_value:
+        date_value = row[1]
+    if new_product is not None:
+        product_id = _add_product_op(conn, *new_product)
+
+    # Insert with quantity_type
+    cursor.execute(
+        "INSERT INTO expenses (product_id, store_id, price_bani, quantity_milli, date, receipt_nr, discount_bani, quantity_type, line_total_bani, day) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (product_id, store_id, price_bani, qty_milli, date_value, receipt_nr, discount_bani, quantity_type,
+         money.line_total_bani(price_bani, qty_milli, discount_bani), dates.to_day(date_value) if date_value else None)
+    )
+    expense_id = cursor.lastrowid
+
+    # return a small representation for UI
+    cursor.execute("SELECT p.name FROM products p WHERE p.id = ?", (product_id,))
+    r = cursor.fetchone()
+    return expense_id, (r[0] if r else ''), budgets.line_alerts(cursor, expense_id)
+
+
+def handle_add_line_item(form):
     # Add an expense line associated with a receipt (AJAX)
-    receipt_id = request.form.get('receipt_id')
+    receipt_id = form.get('receipt_id')
     if not receipt_id:
-        return jsonify({'success': False, 'error': 'receipt_id_required'}), 400
+        return {'success': False, 'error': 'receipt_id_required'}, 400
     # receipt_id is a receipt_nr (string) referring to receipts.nr_bon
     receipt_nr = str(receipt_id)
 
     # product may be provided as id or as new product_name + category_id
-    prod_id_raw = request.form.get('product_id')
+    prod_id_raw = form.get('product_id')
     product_id = None
     if prod_id_raw:
         try:
@@ -381,172 +730,222 @@ def add_line_item_route():
         except ValueError:
             product_id = None
 
+    new_product = None
     if not product_id:
-        product_name = request.form.get('product_name', '').strip()
-        category_id = request.form.get('category_id')
+        product_name = (form.get('product_name') or '').strip()
+        category_id = form.get('category_id')
         if not product_name:
-            return jsonify({'success': False, 'error': 'product_name_required'}), 400
+            return {'success': False, 'error': 'product_name_required'}, 400
         try:
             category_id = int(category_id) if category_id else None
         except ValueError:
             category_id = None
-        product_id = add_product(product_name, category_id)
-
-    price = request.form.get('price')
-    qty = request.form.get('quantity')
-    quantity_type = request.form.get('quantity_type', 'buc')  # default to 'buc'
-    discount = request.form.get('discount')
-    date_value = request.form.get('date')
-    # retrieve store_id from receipts table for this receipt (to populate expense.store_id)
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT store_id, date FROM receipts WHERE nr_bon = ?", (receipt_nr,))
-    row = cursor.fetchone()
-    conn.close()
-    if not row:
-        return jsonify({'success': False, 'error': 'receipt_not_found'}), 400
-    store_id = row[0]
-    # if date not provided for line, fallback to receipt date or today's date
-    if not date_value:
-        date_value = row[1]
+        new_product = (product_name, category_id)
+
+    price = form.get('price')
+    qty = form.get('quantity')
+    quantity_type = form.get('quantity_type') or 'buc'  # default to 'buc'
+    discount = form.get('discount')
+    date_value = form.get('date')
+    if date_value:
+        try:
+            date_value = dates.to_iso(date_value)
+        except ValueError:
+            return {'success': False, 'error': 'invalid_date'}, 400
 
+    # amounts are converted from the submitted text, so "0.1" is exactly 10 bani
     try:
-        price = float(price)
+        price_bani = money.to_bani(price)
     except Exception:
-        price = 0.0
+        price_bani = 0
     try:
-        qty = float(qty)
+        qty_milli = money.to_milli(qty)
     except Exception:
-        qty = 1.0
+        qty_milli = money.MILLI
     try:
-        discount = float(discount) if discount not in (None, '') else 0.0
+        discount_bani = money.to_bani(discount) if discount not in (None, '') else 0
     except Exception:
-        discount = 0.0
-
-    # Insert with quantity_type
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO expenses (product_id, store_id, price, quantity, date, receipt_nr, discount, quantity_type) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-        (product_id, store_id, price, qty, date_value, receipt_nr, discount, quantity_type)
-    )
-    conn.commit()
-    expense_id = cursor.lastrowid
-    conn.close()
+        discount_bani = 0
 
-    # return a small representation for UI
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT p.name FROM products p WHERE p.id = ?", (product_id,))
-    r = cursor.fetchone()
-    pname = r[0] if r else ''
-    conn.close()
+    result = run_write(_add_line_item_op, receipt_nr, product_id, new_product,
+                       price_bani, qty_milli, date_value, discount_bani, quantity_type)
+    if result is None:
+        return {'success': False, 'error': 'receipt_not_found'}, 400
+    expense_id, pname, budget_alerts = result
 
-    return jsonify({'success': True, 'expense_id': expense_id, 'product_name': pname, 'price': price, 'quantity': qty, 'quantity_type': quantity_type, 'discount': discount})
+    return {'success': True, 'expense_id': expense_id, 'product_name': pname, 'price': money.lei(price_bani),
+            'quantity': money.units(qty_milli), 'quantity_type': quantity_type,
+            'discount': money.lei(discount_bani),
+            'total': money.lei(money.line_total_bani(price_bani, qty_milli, discount_bani)),
+            'budget_alerts': budget_alerts}, 200
 
 
-@app.route('/complete_receipt', methods=['POST'])
-def complete_receipt_route():
-    # For now, just acknowledge and redirect client to expenses list
-    receipt_id = request.form.get('receipt_id')
-    if not receipt_id:
-        return jsonify({'success': False, 'error': 'receipt_id_required'}), 400
-    return jsonify({'success': True, 'redirect': '/cheltuieli'})
-
-
-@app.route('/delete_receipt', methods=['POST'])
-def delete_receipt_route():
-    receipt_id = request.form.get('receipt_id')
-    if not receipt_id:
-        return jsonify({'success': False, 'error': 'receipt_id_required'}), 400
-    # treat as receipt_nr (nr_bon)
-    delete_receipt(receipt_id)
-    return jsonify({'success': True})
+def _delete_expense_op(conn, eid):
+    """Delete one line; returns the deleted row (for client-side undo) or None."""
+    cursor = conn.cursor()
+    # fetch row for possible client-side undo
+    cursor.execute('SELECT product_id, store_id, price, quantity, date, receipt_nr, discount FROM expenses WHERE id = ?', (eid,))
+    row = cursor.fetchone()
+    if row:
+        cursor.execute('DELETE FROM expenses WHERE id = ?', (eid,))
+    return row
 
 
-@app.route('/delete_expense', methods=['POST'])
-def delete_expense_route():
-    eid = request.form.get('expense_id')
+def handle_delete_expense(form):
+    eid = form.get('expense_id')
     if not eid:
-        return jsonify({'success': False, 'error': 'expense_id_required'}), 400
+        return {'success': False, 'error': 'expense_id_required'}, 400
     try:
         eid = int(eid)
     except Exception:
-        return jsonify({'success': False, 'error': 'invalid_expense_id'}), 400
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
-    # fetch row for possible client-side undo
-    cursor.execute('SELECT product_id, store_id, price, quantity, date, receipt_id, IFNULL(discount,0) FROM expenses WHERE id = ?', (eid,))
-    row = cursor.fetchone()
+        return {'success': False, 'error': 'invalid_expense_id'}, 400
+    row = run_write(_delete_expense_op, eid)
     if not row:
-        conn.close()
-        return jsonify({'success': False, 'error': 'not_found'}), 404
-    cursor.execute('DELETE FROM expenses WHERE id = ?', (eid,))
-    conn.commit()
-    conn.close()
+        return {'success': False, 'error': 'not_found'}, 404
     # return deleted row details for undo on client
-    return jsonify({'success': True, 'deleted': {'product_id': row[0], 'store_id': row[1], 'price': row[2], 'quantity': row[3], 'date': row[4], 'receipt_id': row[5], 'discount': row[6]}})
+    return {'success': True, 'deleted': {'product_id': row[0], 'store_id': row[1], 'price': row[2], 'quantity': row[3], 'date': row[4], 'receipt_id': row[5], 'discount': row[6]}}, 200
 
 
-@app.route('/update_expense', methods=['POST'])
-def update_expense_route():
-    eid = request.form.get('expense_id')
+def _update_expense_op(conn, updates, params):
+    cursor = conn.cursor()
+    sql = f"UPDATE expenses SET {', '.join(updates)} WHERE id = ?"
+    cursor.execute(sql, params)
+    # fetch updated row to return new totals
+    # line_total_bani was brought up to date by the expenses_line_total_update trigger
+    cursor.execute('SELECT price_bani, quantity_milli, discount_bani, line_total_bani FROM expenses WHERE id = ?',
+                   (params[-1],))
+    return cursor.fetchone()
+
+
+def handle_update_expense(form):
+    eid = form.get('expense_id')
     if not eid:
-        return jsonify({'success': False, 'error': 'expense_id_required'}), 400
+        return {'success': False, 'error': 'expense_id_required'}, 400
     try:
         eid = int(eid)
     except Exception:
-        return jsonify({'success': False, 'error': 'invalid_expense_id'}), 400
+        return {'success': False, 'error': 'invalid_expense_id'}, 400
     # allowed fields: price, quantity, discount
-    price = request.form.get('price')
-    quantity = request.form.get('quantity')
-    discount = request.form.get('discount')
+    price = form.get('price')
+    quantity = form.get('quantity')
+    discount = form.get('discount')
     updates = []
     params = []
     if price is not None:
         try:
-            price_val = float(price)
+            price_val = money.to_bani(price)
         except Exception:
-            return jsonify({'success': False, 'error': 'invalid_price'}), 400
-        updates.append('price = ?')
+            return {'success': False, 'error': 'invalid_price'}, 400
+        updates.append('price_bani = ?')
         params.append(price_val)
     if quantity is not None:
         try:
-            qty_val = float(quantity)
+            qty_val = money.to_milli(quantity)
         except Exception:
-            return jsonify({'success': False, 'error': 'invalid_quantity'}), 400
-        updates.append('quantity = ?')
+            return {'success': False, 'error': 'invalid_quantity'}, 400
+        updates.append('quantity_milli = ?')
         params.append(qty_val)
     if discount is not None:
         try:
-            disc_val = float(discount)
+            disc_val = money.to_bani(discount)
         except Exception:
-            return jsonify({'success': False, 'error': 'invalid_discount'}), 400
-        updates.append('discount = ?')
+            return {'success': False, 'error': 'invalid_discount'}, 400
+        updates.append('discount_bani = ?')
         params.append(disc_val)
     if not updates:
-        return jsonify({'success': False, 'error': 'no_fields'}), 400
+        return {'success': False, 'error': 'no_fields'}, 400
     params.append(eid)
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
-    sql = f"UPDATE expenses SET {', '.join(updates)} WHERE id = ?"
-    cursor.execute(sql, params)
-    conn.commit()
-    # fetch updated row to return new totals
-    cursor.execute('SELECT price, quantity, IFNULL(discount,0) FROM expenses WHERE id = ?', (eid,))
-    r = cursor.fetchone()
-    conn.close()
+    r = run_write(_update_expense_op, updates, params)
     if not r:
-        return jsonify({'success': False, 'error': 'not_found_after_update'}), 500
-    price, quantity, discount = r
-    total = price * quantity - (discount or 0.0)
-    # Round total to 2 decimal places for consistent display
-    total = round(total, 2)
-    # Also round returned price/quantity/discount for consistency (keep numeric types)
-    price = round(price, 2) if isinstance(price, (int, float)) else price
-    quantity = round(quantity, 2) if isinstance(quantity, (int, float)) else quantity
-    discount = round(discount, 2) if isinstance(discount, (int, float)) else discount
-    return jsonify({'success': True, 'price': price, 'quantity': quantity, 'discount': discount, 'total': total})
+        return {'success': False, 'error': 'not_found_after_update'}, 500
+    price_bani, quantity_milli, discount_bani, total = r
+    return {'success': True, 'price': money.lei(price_bani), 'quantity': money.units(quantity_milli),
+            'discount': money.lei(discount_bani), 'total': money.lei(total)}, 200
+
+
+@app.route('/products/search')
+@cached_by_data_version
+def products_search():
+    payload, status = handle_products_search(request.args)
+    return jsonify(payload), status
+
+
+@app.route('/products/suggestion')
+@cached_by_data_version
+def products_suggestion():
+    payload, status = handle_price_suggestion(request.args)
+    return jsonify(payload), status
+
+
+@app.route('/products/bought_with')
+@cached_by_data_version
+def products_bought_with():
+    payload, status = handle_bought_with(request.args)
+    return jsonify(payload), status
+
+
+@app.route('/create_receipt', methods=['POST'])
+def create_receipt_route():
+    payload, status = handle_create_receipt(request.form)
+    return jsonify(payload), status
+
+
+@app.route('/add_line_item', methods=['POST'])
+def add_line_item_route():
+    payload, status = handle_add_line_item(request.form)
+    return jsonify(payload), status
+
+
+@app.route('/delete_expense', methods=['POST'])
+def delete_expense_route():
+    payload, status = handle_delete_expense(request.form)
+    return jsonify(payload), status
+
+
+@app.route('/update_expense', methods=['POST'])
+def update_expense_route():
+    payload, status = handle_update_expense(request.form)
+    return jsonify(payload), status
+
+
+def _complete_receipt_op(conn, receipt_nr):
+    """Recompute the header totals from the lines and stamp completed_at; None if the receipt is missing."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM receipts WHERE nr_bon = ?", (receipt_nr,))
+    if not cursor.fetchone():
+        return None
+    # the triggers keep the totals current; this pins them to the lines as they are now
+    schema.recompute_receipt_totals(conn, receipt_nr)
+    cursor.execute("UPDATE receipts SET completed_at = ? WHERE nr_bon = ?",
+                   (datetime.now().isoformat(timespec='seconds'), receipt_nr))
+    cursor.execute("SELECT total_bani, line_count, discount_total_bani, completed_at FROM receipts WHERE nr_bon = ?",
+                   (receipt_nr,))
+    return cursor.fetchone()
+
+
+@app.route('/complete_receipt', methods=['POST'])
+def complete_receipt_route():
+    # Finalize the header totals, then send the client to the expenses list
+    receipt_id = request.form.get('receipt_id')
+    if not receipt_id:
+        return jsonify({'success': False, 'error': 'receipt_id_required'}), 400
+    header = run_write(_complete_receipt_op, str(receipt_id))
+    if header is None:
+        return jsonify({'success': False, 'error': 'receipt_not_found'}), 404
+    total_bani, line_count, discount_total_bani, completed_at = header
+    return jsonify({'success': True, 'redirect': '/cheltuieli', 'total': money.lei(total_bani),
+                    'line_count': line_count, 'discount_total': money.lei(discount_total_bani),
+                    'completed_at': completed_at})
+
+
+@app.route('/delete_receipt', methods=['POST'])
+def delete_receipt_route():
+    receipt_id = request.form.get('receipt_id')
+    if not receipt_id:
+        return jsonify({'success': False, 'error': 'receipt_id_required'}), 400
+    # treat as receipt_nr (nr_bon)
+    deleted = delete_receipt(receipt_id)
+    return jsonify({'success': True, 'deleted': deleted})
 
 @app.route('/add_expense', methods=['POST'])
 def add_expense_route():
@@ -575,53 +974,99 @@ def add_expense_route():
         product_id = add_product(product_name, category_id)
 
     store_id = int(request.form['store_id'])
-    price = float(request.form['price'])
-    quantity = float(request.form['quantity'])
-    date_value = request.form['date']
+    price_bani = money.to_bani(request.form['price'])
+    quantity_milli = money.to_milli(request.form['quantity'])
+    try:
+        date_value = dates.to_iso(request.form['date'])
+    except ValueError:
+        return "Data nu este validă (AAAA-LL-ZZ sau ZZ.LL.AAAA)", 400
     # optional discount field
     discount = request.form.get('discount')
     try:
-        discount = float(discount) if discount not in (None, '') else 0.0
+        discount_bani = money.to_bani(discount) if discount not in (None, '') else 0
     except Exception:
-        discount = 0.0
-    add_expense(product_id, store_id, price, quantity, date_value, discount=discount)
+        discount_bani = 0
+    add_expense(product_id, store_id, price_bani, quantity_milli, date_value, discount_bani=discount_bani)
     # After adding an expense show the expenses page
     return redirect('/cheltuieli')
 
 
+# --- Import în bloc (CSV / JSON) ---
+@app.route('/import', methods=['GET', 'POST'])
+def import_route():
+    if request.method == 'GET':
+        return render_template('import_expenses.html')
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        return render_template('import_expenses.html', error='Alegeți un fișier CSV sau JSON.'), 400
+    dry_run = request.form.get('dry_run') == '1'
+    conn = get_db()
+    try:
+        importer = Importer(conn)
+    finally:
+        conn.close()
+    # each chunk is one operation (one transaction) of the single writer
+    write_chunk = None if dry_run else functools.partial(run_write, importer.import_chunk)
+    stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+    finish = None
+    if not dry_run:
+        # the report indexes are built once after the last chunk (schema.drop_import_indexes)
+        run_write(schema.drop_import_indexes)
+        finish = functools.partial(run_write, schema.create_import_indexes)
+    try:
+        summary = import_stream(stream, detect_format(upload.filename), importer, write_chunk, finish=finish)
+    except (ImportFormatError, UnicodeDecodeError) as e:
+        summary, error = None, f'Fișier invalid: {e}'
+    else:
+        error = None
+        if not dry_run:
+            # index the new receipts for /search now rather than on the first search
+            run_write(schema.refresh_search_index)
+            run_write(anomalies.detect)
+    if request.args.get('format') == 'json':
+        return jsonify(summary or {'error': error}), 200 if summary else 400
+    return render_template('import_expenses.html', summary=summary, error=error), 200 if summary else 400
+
+
 @app.route('/cheltuieli')
 def cheltuieli():
     """Page that lists all expenses."""
     # Group by receipts: fetch receipts and their lines, plus ungrouped lines
-    conn = sqlite3.connect('expenses.db')
+    conn = get_db()
     cursor = conn.cursor()
+    # check the lines added since the last view (anomalies.py)
+    if anomalies.pending(cursor):
+        run_write(anomalies.detect)
     # fetch receipts with store name
     cursor.execute("""
-        SELECT r.nr_bon, r.date, s.id, s.name
+        SELECT r.nr_bon, r.date, s.id, s.name, r.total_bani, r.line_count, r.discount_total_bani, r.completed_at
         FROM receipts r
         LEFT JOIN stores s ON r.store_id = s.id
         ORDER BY r.date DESC
     """)
     receipts = []
     rows = cursor.fetchall()
+    images = image_store.receipt_images(conn)
     for r in rows:
-        nr_bon, rdate, store_id, store_name = r
+        nr_bon, rdate, store_id, store_name, total_bani, line_count, discount_total_bani, completed_at = r
         # fetch lines for this receipt
-        cursor.execute("""
-            SELECT e.id, p.name, e.price, e.quantity, IFNULL(e.discount,0) as discount,
-                   (e.price * e.quantity - IFNULL(e.discount,0)) AS total, IFNULL(e.quantity_type,'buc') as quantity_type, e.date
+        cursor.execute(f"""
+            SELECT e.id, p.name, e.price, e.quantity, e.discount,
+                   {LINE_TOTAL_LEI} AS total, IFNULL(e.quantity_type,'buc') as quantity_type, e.date
             FROM expenses e
             LEFT JOIN products p ON e.product_id = p.id
             WHERE e.receipt_nr = ?
             ORDER BY e.id
     """, (nr_bon,))
         lines = cursor.fetchall()
-        receipts.append({'nr_bon': nr_bon, 'date': rdate, 'store_id': store_id, 'store_name': store_name, 'lines': lines})
+        receipts.append({'nr_bon': nr_bon, 'images': images.get(nr_bon, []), 'date': rdate, 'store_id': store_id, 'store_name': store_name, 'lines': lines,
+                         'total': money.lei(total_bani), 'line_count': line_count,
+                         'discount_total': money.lei(discount_total_bani), 'completed_at': completed_at})
 
     # fetch ungrouped expenses (no receipt)
-    cursor.execute("""
-        SELECT e.id, p.name, s.name, e.price, e.quantity, IFNULL(e.discount,0) as discount,
-               (e.price * e.quantity - IFNULL(e.discount,0)) AS total, e.date
+    cursor.execute(f"""
+        SELECT e.id, p.name, s.name, e.price, e.quantity, e.discount,
+               {LINE_TOTAL_LEI} AS total, e.date
         FROM expenses e
         LEFT JOIN products p ON e.product_id = p.id
         LEFT JOIN stores s ON e.store_id = s.id
@@ -629,26 +1074,300 @@ def cheltuieli():
         ORDER BY e.date DESC
     """)
     ungrouped = cursor.fetchall()
+    flags = anomalies.flags(cursor)
+    recurring = anomalies.recurring(cursor)
+    conn.close()
+    return render_template('cheltuieli.html', receipts=receipts, ungrouped=ungrouped,
+                           thumb_width=image_store.THUMB_WIDTHS[0], flags=flags, recurring=recurring,
+                           today=dates.to_day(datetime.now().date()))
+
+
+# --- Bugete (budgets.py) ---
+@app.route('/budgets/status')
+@cached_by_data_version(vary=current_month_vary)
+def budget_status():
+    payload, status = handle_budget_status(request.args)
+    return jsonify(payload), status
+
+
+@app.route('/budgets')
+def budgets_page():
+    """Budgets of a month (?month=YYYY-MM) and the forms to set them."""
+    payload, status = handle_budget_status(request.args)
+    if status != 200:
+        abort(400)
+    conn = get_db()
+    cursor = conn.cursor()
+    categories = get_categories()
+    names = {str(cid): name for cid, name in categories}
+    cursor.execute("SELECT scope, target, month, limit_bani, warn_percent FROM budgets ORDER BY scope, target, month")
+    defined = []
+    for scope, target, month, limit_bani, warn in cursor.fetchall():
+        if scope == 'category':
+            name = names.get(target) or ('Fără categorie' if target == '0' else target)
+        else:
+            name = target or 'Fără tip'
+        defined.append((scope, target, name, month, money.lei(limit_bani), warn))
+    cursor.execute("SELECT DISTINCT store_type FROM stores WHERE store_type IS NOT NULL AND store_type != '' "
+                   "ORDER BY store_type")
+    store_types = [r[0] for r in cursor.fetchall()]
     conn.close()
-    return render_template('cheltuieli.html', receipts=receipts, ungrouped=ungrouped)
+    return render_template('budgets.html', month=payload['month'], budgets=payload['budgets'], defined=defined,
+                           categories=categories, store_types=store_types,
+                           error=bool(request.args.get('error')))
+
+
+def _budget_form(form):
+    """(scope, target, month) of a budget form; raises ValueError."""
+    scope = form.get('scope')
+    if scope not in budgets.SCOPES:
+        raise ValueError(scope)
+    target = (form.get('target') or '').strip()
+    if scope == 'category':
+        target = str(int(target or 0))
+    month = (form.get('month') or '').strip()
+    if month:
+        month = _month_arg({'month': month})
+    return scope, target, month
+
+
+@app.route('/budgets/set', methods=['POST'])
+def set_budget_route():
+    try:
+        scope, target, month = _budget_form(request.form)
+        limit_bani = money.to_bani(request.form.get('limit'))
+        warn_percent = int(request.form.get('warn_percent') or budgets.WARN_PERCENT)
+        if limit_bani <= 0 or not 1 <= warn_percent <= 100:
+            raise ValueError(limit_bani)
+    except ValueError:
+        return redirect('/budgets?error=1')
+    run_write(budgets.set_budget, scope, target, month, limit_bani, warn_percent)
+    return redirect(f'/budgets?month={month}' if month else '/budgets')
+
+
+@app.route('/budgets/delete', methods=['POST'])
+def delete_budget_route():
+    try:
+        scope, target, month = _budget_form(request.form)
+    except ValueError:
+        abort(400)
+    run_write(budgets.delete_budget, scope, target, month)
+    return redirect(f'/budgets?month={month}' if month else '/budgets')
+
+
+# --- Poze bonuri (image_store.py) ---
+# an image URL names its content, so it can be cached for good
+IMAGE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def _link_receipt_image_op(conn, receipt_nr, image):
+    """Link a stored image to a receipt; None if the receipt is missing."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM receipts WHERE nr_bon = ?", (receipt_nr,))
+    if not cursor.fetchone():
+        return None
+    return image_store.link(conn, receipt_nr, image)
+
+
+@app.route('/receipt_images/add', methods=['POST'])
+def add_receipt_image_route():
+    receipt_id = request.form.get('receipt_id')
+    upload = request.files.get('image')
+    if not receipt_id:
+        return jsonify({'success': False, 'error': 'receipt_id_required'}), 400
+    if not upload or not upload.filename:
+        return jsonify({'success': False, 'error': 'image_required'}), 400
+    data = upload.read()
+    image_hash = image_store.digest(data)
+    conn = get_db()
+    try:
+        image = image_store.find(conn, image_hash)
+    finally:
+        conn.close()
+    if image is None:
+        # compressed and written outside the writer; a known image skips this
+        try:
+            image = image_store.save(data, image_hash=image_hash)
+        except ValueError:
+            return jsonify({'success': False, 'error': 'unsupported_image'}), 400
+    linked = run_write(_link_receipt_image_op, str(receipt_id), image)
+    if linked is None:
+        return jsonify({'success': False, 'error': 'receipt_not_found'}), 404
+    if request.args.get('format') == 'json':
+        return jsonify({'success': True, 'hash': image_hash, 'duplicate': not linked,
+                        'url': f'/images/{image_hash}', 'thumb_url': f'/images/{image_hash}/thumb',
+                        'size_bytes': image['size_bytes'], 'original_bytes': image['original_bytes']})
+    return redirect('/cheltuieli')
+
+
+@app.route('/receipt_images/delete', methods=['POST'])
+def delete_receipt_image_route():
+    receipt_id = request.form.get('receipt_id')
+    image_hash = request.form.get('hash', '')
+    if not receipt_id or not image_store.is_hash(image_hash):
+        return jsonify({'success': False, 'error': 'receipt_id_and_hash_required'}), 400
+    deleted = run_write(image_store.unlink, str(receipt_id), image_hash)
+    return jsonify({'success': True, 'deleted': deleted})
+
+
+def _image_response(path, mime):
+    response = send_file(path, mimetype=mime, conditional=True)
+    response.headers['Cache-Control'] = IMAGE_CACHE_CONTROL
+    return response
+
+
+@app.route('/images/<image_hash>')
+def receipt_image(image_hash):
+    if not image_store.is_hash(image_hash):
+        abort(404)
+    path = image_store.original_path(image_hash)
+    if not os.path.exists(path):
+        abort(404)
+    return _image_response(path, image_store.original_mime(image_hash))
+
+
+@app.route('/images/<image_hash>/thumb')
+def receipt_image_thumb(image_hash):
+    width = request.args.get('w', image_store.DEFAULT_THUMB, type=int)
+    if not image_store.is_hash(image_hash) or width not in image_store.THUMB_WIDTHS:
+        abort(404)
+    found = image_store.thumbnail(image_hash, width)
+    if found is None:
+        abort(404)
+    path, mime = found
+    if path is None:
+        # no Pillow: a temporary redirect, so that a real thumbnail is cached later
+        return redirect(f'/images/{image_hash}')
+    return _image_response(path, mime)
+
+def _set_ocr_text_op(conn, receipt_nr, ocr_text):
+    cursor = conn.cursor()
+    cursor.execute("UPDATE receipts SET ocr_text = ? WHERE nr_bon = ?", (ocr_text, receipt_nr))
+    return cursor.rowcount
+
+
+@app.route('/receipt_ocr_text', methods=['POST'])
+def receipt_ocr_text_route():
+    """Store (or clear) the raw OCR text of a receipt, for /search."""
+    receipt_id = request.form.get('receipt_id')
+    if not receipt_id:
+        return jsonify({'success': False, 'error': 'receipt_id_required'}), 400
+    if not run_write(_set_ocr_text_op, str(receipt_id), request.form.get('ocr_text') or None):
+        return jsonify({'success': False, 'error': 'receipt_not_found'}), 404
+    return jsonify({'success': True})
+
+
+# --- Căutare (receipt_search, schema.ensure_search) ---
+SEARCH_PAGE_SIZE = 25
+SNIPPET_START, SNIPPET_END = '\x02', '\x03'
+
+
+def _fts_query(text):
+    """User text -> FTS5 query: every word must match, as a prefix ("lap" finds LAPTE).
+    Words are quoted, so FTS5 operators typed by the user are plain text."""
+    words = re.findall(r'\w+', text)
+    return ' '.join(f'"{w}"*' for w in words)
+
+
+def _snippet_html(snippet):
+    html = str(escape(snippet or ''))
+    return Markup(html.replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>'))
+
+
+def handle_search(args):
+    """Receipts matching `q` (nr_bon, store, products, OCR text), best first, with
+    optional start_date / end_date / store_id filters and `page` (25 per page)."""
+    q = (args.get('q') or '').strip()
+    match = _fts_query(q)
+    try:
+        page = max(1, int(args.get('page') or 1))
+        store_id = int(args['store_id']) if args.get('store_id') else None
+    except ValueError:
+        return {'error': 'invalid_parameter'}, 400
+    where, params = get_date_filter_clause(args.get('start_date'), args.get('end_date'), "r.day")
+    if store_id is not None:
+        where += (" AND " if where else " WHERE ") + "r.store_id = ?"
+        params.append(store_id)
+    payload = {'q': q, 'page': page, 'results': [], 'has_more': False}
+    if not match:
+        return payload, 200
+    conn = get_db()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM search_dirty LIMIT 1")
+        # fetchall: the finished statement holds no lock while the writer runs
+        if cursor.fetchall():
+            # receipts written since the last search: reindex them first (usually a handful)
+            run_write(schema.refresh_search_index)
+        where = where.replace(" WHERE ", " AND ", 1)
+        # bm25 weights: nr_bon, store, products, OCR text; the snippet is made for this page only
+        cursor.execute(f"""
+            SELECT d.id, r.nr_bon, r.date, s.id, s.name, r.total_bani, r.line_count
+            FROM receipt_search
+            JOIN search_docs d ON d.id = receipt_search.rowid
+            JOIN receipts r ON r.nr_bon = d.nr_bon
+            LEFT JOIN stores s ON s.id = r.store_id
+            WHERE receipt_search MATCH ? {where}
+            ORDER BY bm25(receipt_search, 10.0, 4.0, 3.0, 1.0), r.day DESC
+            LIMIT ? OFFSET ?
+        """, [match, *params, SEARCH_PAGE_SIZE + 1, (page - 1) * SEARCH_PAGE_SIZE])
+        rows = cursor.fetchall()
+        payload['has_more'] = len(rows) > SEARCH_PAGE_SIZE
+        rows = rows[:SEARCH_PAGE_SIZE]
+        snippets = {}
+        if rows:
+            cursor.execute(f"""
+                SELECT rowid, snippet(receipt_search, -1, '{SNIPPET_START}', '{SNIPPET_END}', '…', 12)
+                FROM receipt_search WHERE receipt_search MATCH ? AND rowid IN ({', '.join('?' * len(rows))})
+            """, [match, *(r[0] for r in rows)])
+            snippets = dict(cursor.fetchall())
+    finally:
+        conn.close()
+    for doc_id, nr_bon, rdate, sid, store_name, total_bani, line_count in rows:
+        payload['results'].append({'nr_bon': nr_bon, 'date': rdate, 'store_id': sid, 'store': store_name,
+                                   'total': money.lei(total_bani), 'line_count': line_count,
+                                   'snippet': _snippet_html(snippets.get(doc_id))})
+    return payload, 200
+
+
+@app.route('/search')
+def search():
+    payload, status = handle_search(request.args)
+    if request.args.get('format') == 'json':
+        return jsonify(payload), status
+    return render_template('search.html', stores=get_stores(), args=request.args, **payload), status
+
 
 # === Funcții auxiliare pentru rapoarte ===
-def get_date_filter_clause(start_date=None, end_date=None):
-    """Generate SQL WHERE clause for date filtering"""
+def get_date_filter_clause(start_date=None, end_date=None, column="day"):
+    """Generate SQL WHERE clause for date filtering, on the day number (idx_expenses_day_total).
+    An invalid date is a 400."""
     conditions = []
     params = []
     
-    if start_date:
-        conditions.append("date >= ?")
-        params.append(start_date)
-    if end_date:
-        conditions.append("date <= ?")
-        params.append(end_date)
+    try:
+        if start_date:
+            params.append(dates.to_day(start_date))
+            conditions.append(f"{column} >= ?")
+        if end_date:
+            params.append(dates.to_day(end_date))
+            conditions.append(f"{column} <= ?")
+    except ValueError:
+        abort(400, "Data nu este validă (AAAA-LL-ZZ sau ZZ.LL.AAAA)")
     
     if conditions:
         return " WHERE " + " AND ".join(conditions), params
     return "", []
 
+def _date_range_args(args):
+    """start_date / end_date of a report as 'YYYY-MM-DD' (or None), so that the filter, the
+    report_cache key and the form all see the ISO form; an invalid date is a 400."""
+    try:
+        return tuple(dates.to_iso(args[name]) if args.get(name) else None for name in ('start_date', 'end_date'))
+    except ValueError:
+        abort(400, "Data nu este validă (AAAA-LL-ZZ sau ZZ.LL.AAAA)")
+
+
 def generate_csv(data, headers):
     """Generate CSV file from data"""
     si = StringIO()
@@ -666,19 +1385,20 @@ def reports_home():
     return render_template("reports.html")
 
 @app.route("/reports/monthly")
+@cached_by_data_version
 def report_monthly():
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
+    start_date, end_date = _date_range_args(request.args)
     where_clause, params = get_date_filter_clause(start_date, end_date)
     
+    # summed per day in idx_expenses_day_total order, the month is computed once per day
     query = f"""
-        SELECT substr(date, 1, 7) AS luna, SUM(price * quantity) AS total
-        FROM expenses
-        {where_clause}
-        GROUP BY substr(date, 1, 7)
+        SELECT {dates.month_sql('day')} AS luna, SUM(total) / 100.0 AS total
+        FROM (SELECT day, SUM(line_total_bani) AS total FROM expenses {where_clause} GROUP BY day)
+        GROUP BY luna
         ORDER BY luna DESC
     """
-    data = query_db(EXPENSES_DB, query, params)
+    data = report_cache.get_or_compute('monthly', start_date, end_date,
+                                        lambda: report_snapshot.query(query, params))
     
     if request.args.get('format') == 'csv':
         headers = ['Luna', 'Total (lei)']
@@ -688,23 +1408,21 @@ def report_monthly():
                          start_date=start_date, end_date=end_date)
 
 @app.route("/reports/products")
+@cached_by_data_version
 def report_products():
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
-    where_clause, params = get_date_filter_clause(start_date, end_date)
-    
-    if where_clause:
-        where_clause = where_clause.replace("date", "e.date")
+    start_date, end_date = _date_range_args(request.args)
+    where_clause, params = get_date_filter_clause(start_date, end_date, "e.day")
     
     query = f"""
-        SELECT p.name, SUM(e.price * e.quantity) AS total
+        SELECT p.name, SUM(e.line_total_bani) / 100.0 AS total
         FROM expenses e
         JOIN products p ON e.product_id = p.id
         {where_clause}
         GROUP BY p.name
         ORDER BY total DESC
     """
-    data = query_db(EXPENSES_DB, query, params)
+    data = report_cache.get_or_compute('products', start_date, end_date,
+                                        lambda: report_snapshot.query(query, params))
     
     if request.args.get('format') == 'csv':
         headers = ['Produs', 'Total (lei)']
@@ -714,25 +1432,23 @@ def report_products():
                          start_date=start_date, end_date=end_date)
 
 @app.route("/reports/stores")
+@cached_by_data_version
 def report_stores():
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
-    where_clause, params = get_date_filter_clause(start_date, end_date)
-    
-    if where_clause:
-        where_clause = where_clause.replace("date", "e.date")
+    start_date, end_date = _date_range_args(request.args)
+    where_clause, params = get_date_filter_clause(start_date, end_date, "e.day")
     
     query = f"""
         SELECT s.name, 
                COUNT(*) as num_transactions,
-               SUM(e.price * e.quantity) AS total
+               SUM(e.line_total_bani) / 100.0 AS total
         FROM expenses e
         JOIN stores s ON e.store_id = s.id
         {where_clause}
         GROUP BY s.name
         ORDER BY total DESC
     """
-    data = query_db(EXPENSES_DB, query, params)
+    data = report_cache.get_or_compute('stores', start_date, end_date,
+                                        lambda: report_snapshot.query(query, params))
     
     if request.args.get('format') == 'csv':
         headers = ['Magazin', 'Număr tranzacții', 'Total (lei)']
@@ -741,20 +1457,264 @@ def report_stores():
     return render_template("report_stores.html", data=data,
                          start_date=start_date, end_date=end_date)
 
-if __name__ == '__main__':
-    import socket
-    
-    # Get local WiFi IP (not loopback)
+TOP_LINES_LIMIT = 50
+
+
+@app.route("/reports/top_lines")
+@cached_by_data_version
+def report_top_lines():
+    """The most expensive expense lines (after discount), optionally within a date range."""
+    start_date, end_date = _date_range_args(request.args)
+    where_clause, params = get_date_filter_clause(start_date, end_date, "e.day")
+
+    # without a range this walks idx_expenses_line_total backwards and stops after LIMIT rows
+    query = f"""
+        SELECT e.date, p.name, s.name, e.quantity, e.price, e.discount,
+               e.line_total_bani / 100.0 AS total, e.receipt_nr
+        FROM expenses e
+        LEFT JOIN products p ON e.product_id = p.id
+        LEFT JOIN stores s ON e.store_id = s.id
+        {where_clause}
+        ORDER BY e.line_total_bani DESC
+        LIMIT {TOP_LINES_LIMIT}
+    """
+    data = report_cache.get_or_compute('top_lines', start_date, end_date,
+                                        lambda: report_snapshot.query(query, params))
+
+    if request.args.get('format') == 'csv':
+        headers = ['Data', 'Produs', 'Magazin', 'Cantitate', 'Preț (lei)', 'Discount (lei)', 'Total (lei)', 'Nr. bon']
+        return generate_csv(data, headers)
+
+    return render_template("report_top_lines.html", data=data,
+                         start_date=start_date, end_date=end_date)
+
+def _month_range(start_date=None, end_date=None):
+    """Months ('YYYY-MM') containing start_date / end_date ('YYYY-MM-DD' from _date_range_args),
+    plus the date range they cover (used as the report cache key, so a change anywhere in those
+    months invalidates it)."""
+    start_month = start_date[:7] if start_date else None
+    end_month = end_date[:7] if end_date else None
+    # every day of end_month sorts below '-32'
+    return start_month, end_month, (start_month and start_month + '-01'), (end_month and end_month + '-32')
+
+
+def _month_filter(start_month, end_month, column='month'):
+    conditions, params = [], []
+    if start_month:
+        conditions.append(f"{column} >= ?")
+        params.append(start_month)
+    if end_month:
+        conditions.append(f"{column} <= ?")
+        params.append(end_month)
+    return (" AND " + " AND ".join(conditions) if conditions else ""), params
+
+
+@app.route("/reports/categories")
+@cached_by_data_version
+def report_categories():
+    """Spend per product category, from the monthly_category_stats rollup (no expenses scan).
+    The date filter applies to whole months."""
+    start_date, end_date = _date_range_args(request.args)
+    start_month, end_month, cache_start, cache_end = _month_range(start_date, end_date)
+    month_clause, params = _month_filter(start_month, end_month, 'm.month')
+
+    query = f"""
+        SELECT m.category_id, IFNULL(c.categorie, 'Fără categorie'),
+               SUM(m.line_count), SUM(m.spend_bani) / 100.0 AS total
+        FROM monthly_category_stats m
+        LEFT JOIN categorii c ON c.id = m.category_id
+        WHERE 1 {month_clause}
+        GROUP BY m.category_id
+        ORDER BY total DESC
+    """
+    data = report_cache.get_or_compute('categories', cache_start, cache_end,
+                                        lambda: report_snapshot.query(query, params))
+
+    if request.args.get('format') == 'csv':
+        headers = ['Categorie', 'Număr linii', 'Total (lei)']
+        return generate_csv([row[1:] for row in data], headers)
+
+    return render_template("report_categories.html", data=data,
+                         start_date=start_date, end_date=end_date)
+
+
+@app.route("/reports/categories/<int:category_id>")
+@cached_by_data_version
+def report_category_products(category_id):
+    """Products of one category (0 = without category) with their spend, from monthly_product_stats."""
+    start_date, end_date = _date_range_args(request.args)
+    start_month, end_month, cache_start, cache_end = _month_range(start_date, end_date)
+    month_clause, month_params = _month_filter(start_month, end_month, 'm.month')
+
+    rows = report_snapshot.query("SELECT categorie FROM categorii WHERE id = ?", (category_id,))
+    if category_id and not rows:
+        return "Categoria nu există", 404
+    category_name = rows[0][0] if rows else 'Fără categorie'
+
+    # one category's products (idx_products_category), each read by its months
+    if category_id:
+        products_clause, params = "p.category_id = ?", [category_id]
+    else:
+        products_clause, params = "p.category_id IS NULL", []
+    query = f"""
+        SELECT p.name, SUM(m.line_count), SUM(m.quantity_milli) / 1000.0, SUM(m.spend_bani) / 100.0 AS total
+        FROM products p
+        JOIN monthly_product_stats m ON m.product_id = p.id
+        WHERE {products_clause} {month_clause}
+        GROUP BY p.id
+    """
+    params += month_params
+    if not category_id:
+        # lines without a product
+        query += f"""
+        UNION ALL
+        SELECT 'Fără produs', SUM(m.line_count), SUM(m.quantity_milli) / 1000.0, SUM(m.spend_bani) / 100.0
+        FROM monthly_product_stats m
+        WHERE m.product_id = 0 {month_clause}
+        HAVING COUNT(*) > 0
+        """
+        params += month_params
+    query += " ORDER BY 4 DESC"
+    data = report_cache.get_or_compute(f'categories/{category_id}', cache_start, cache_end,
+                                        lambda: report_snapshot.query(query, params))
+
+    if request.args.get('format') == 'csv':
+        headers = ['Produs', 'Număr linii', 'Cantitate', 'Total (lei)']
+        return generate_csv(data, headers)
+
+    return render_template("report_category_products.html", data=data, category_id=category_id,
+                         category_name=category_name, start_date=start_date, end_date=end_date)
+
+# === Prețuri pe unitate (price_analytics.py) ===
+def _names(table):
+    return dict(report_snapshot.query(f"SELECT id, name FROM {table}"))
+
+
+def _numpy_missing():
+    return "Rapoartele de prețuri au nevoie de NumPy (pip install numpy)", 503
+
+
+@app.route("/reports/prices")
+@cached_by_data_version
+def report_prices():
+    """Unit-price trend of every product bought at least TREND_MIN_LINES times in the last `days` days."""
+    if not price_analytics.available():
+        return _numpy_missing()
     try:
-        # Connect to a non-routable address to find the local IP
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        local_ip = s.getsockname()[0]
-        s.close()
-    except Exception:
-        # Fallback to localhost if unable to determine
-        local_ip = "127.0.0.1"
-    
-    print(f"Starting app on {local_ip}:5000")
-    print(f"Access from WiFi: http://{local_ip}:5000")
-    app.run(host=local_ip, port=5000, debug=True)
+        days = max(1, int(request.args.get('days') or price_analytics.TREND_DAYS))
+    except ValueError:
+        abort(400, "Numărul de zile nu este valid")
+    products = _names('products')
+    data = [(product_id, products.get(product_id, '—'), *row)
+            for product_id, *row in price_history.trends(days)]
+    # biggest price rises first, products without a trend last
+    data.sort(key=lambda row: (row[7] is None, -(row[7] or 0)))
+
+    if request.args.get('format') == 'csv':
+        headers = ['Produs', 'Unitate', 'Număr linii', 'Minim (lei)', 'Medie (lei)', 'Ultimul (lei)',
+                   'Variație anuală (%)']
+        return generate_csv([(*row[1:7], None if row[7] is None else round(row[7] * 100, 1)) for row in data],
+                            headers)
+
+    return render_template("report_prices.html", data=data, days=days)
+
+
+@app.route("/reports/prices/<int:product_id>")
+@cached_by_data_version
+def report_price_product(product_id):
+    """One product's unit prices over time, per store, with the latest price at each."""
+    if not price_analytics.available():
+        return _numpy_missing()
+    rows = report_snapshot.query("SELECT name FROM products WHERE id = ?", (product_id,))
+    if not rows:
+        return "Produsul nu există", 404
+    stores = _names('stores')
+    series = price_history.series(product_id)
+    latest = price_history.latest(product_id)
+    summary = []
+    for store_id, points in series.items():
+        prices = [p[2] for p in points]
+        summary.append({'store_id': store_id, 'store': stores.get(store_id, '—'), 'lines': len(points),
+                        'latest_date': latest[store_id][0], 'unit': latest[store_id][1],
+                        'latest': latest[store_id][2], 'min': min(prices),
+                        'mean': round(sum(prices) / len(prices), 2)})
+    summary.sort(key=lambda row: (row['unit'], row['latest']))
+
+    if request.args.get('format') == 'json':
+        return jsonify({'product_id': product_id, 'name': rows[0][0], 'stores': summary,
+                        'series': {str(s): points for s, points in series.items()}})
+    if request.args.get('format') == 'csv':
+        headers = ['Magazin', 'Data', 'Unitate', 'Preț pe unitate (lei)', 'Cantitate']
+        return generate_csv([(stores.get(s, '—'), *point) for s, points in series.items() for point in points],
+                            headers)
+
+    return render_template("report_price_product.html", product_id=product_id, product_name=rows[0][0],
+                           summary=summary, series=series, stores=stores)
+
+
+def handle_price_basket(args):
+    """Cheapest store for the products in `product_id` (repeated); `qty_<id>` sets a quantity."""
+    try:
+        product_ids = [int(p) for p in args.getlist('product_id')]
+        quantities = {p: float(args.get(f'qty_{p}')) for p in product_ids if args.get(f'qty_{p}')}
+    except ValueError:
+        return {'success': False, 'error': 'invalid_parameter'}, 400
+    result = price_history.basket(product_ids, quantities)
+    return dict(result, success=True), 200
+
+
+@app.route("/reports/prices/basket")
+@cached_by_data_version
+def report_price_basket():
+    if not price_analytics.available():
+        return _numpy_missing()
+    payload, status = handle_price_basket(request.args)
+    if request.args.get('format') == 'json' or status != 200:
+        return jsonify(payload), status
+    products = _names('products')
+    stores = _names('stores')
+    # products with a price at some store, for the picker
+    choices = sorted(((p, products.get(p, '—')) for p in price_history.product_ids()), key=lambda c: c[1])
+    return render_template("report_price_basket.html", result=payload, products=products, stores=stores,
+                           choices=choices, selected=set(int(p) for p in request.args.getlist('product_id')))
+
+
+def _with_yearly(rows):
+    """Index rows (month, index, monthly change, products) plus the change over 12 months."""
+    return [(*row, rows[i][1] / rows[i - 12][1] - 1 if i >= 12 else None) for i, row in enumerate(rows)]
+
+
+@app.route("/reports/inflation")
+@cached_by_data_version
+def report_inflation():
+    """Personal inflation: chain-linked price index per month from repeat purchases,
+    for the whole basket or one category (category_id, 0 = without category)."""
+    if not price_analytics.available():
+        return _numpy_missing()
+    index = price_history.inflation()
+    categories = dict(report_snapshot.query("SELECT id, categorie FROM categorii"))
+    categories[0] = 'Fără categorie'
+
+    if request.args.get('format') == 'csv':
+        headers = ['Categorie', 'Luna', 'Indice', 'Variație lunară (%)', 'Variație anuală (%)', 'Produse comparate']
+        series = [('Total', index['basket'])] + sorted(
+            ((categories.get(c, '—'), rows) for c, rows in index['categories'].items()), key=lambda s: s[0])
+        data = [(name, month, round(level, 2), None if monthly is None else round(monthly * 100, 2),
+                 None if yearly is None else round(yearly * 100, 2), compared)
+                for name, rows in series for month, level, monthly, compared, yearly in _with_yearly(rows)]
+        return generate_csv(data, headers)
+
+    category_id = request.args.get('category_id', type=int)
+    if category_id is not None and category_id not in index['categories']:
+        return "Nu există prețuri comparabile pentru această categorie", 404
+    rows = index['basket'] if category_id is None else index['categories'][category_id]
+    choices = sorted(((c, categories.get(c, '—')) for c in index['categories']), key=lambda c: c[1])
+    return render_template("report_inflation.html", data=list(reversed(_with_yearly(rows))), choices=choices,
+                           category_id=category_id)
+
+
+if __name__ == '__main__':
+    # Production server by default; `python app_web.py --dev` for the Flask debug server.
+    # See serve.py for worker/thread options.
+    from serve import main
+    raise SystemExit(main())
@@ -0,0 +1,182 @@
+"""
+"Usually bought with" rules mined from receipt baskets.
+
+A receipt (expenses grouped by receipt_nr) is a basket of products. mine()
+finds the product sets that occur together on at least min_count receipts
+with FP-growth, and rules() turns them into association rules
+
+  {A} -> C  and  {A, B} -> C
+  confidence = receipts with A, B and C / receipts with A and B
+  lift       = confidence / share of receipts with C
+
+keeping those with lift above 1 and at least min_confidence, best
+max_per_antecedent per antecedent. scripts/mine_basket_rules.py runs this
+offline and replaces the basket_rules table (schema.ensure_basket_rules) in
+one transaction; the web app only reads it: suggestions() looks up the rules
+whose antecedent is one or two of the receipt's products, a few primary key
+seeks per request.
+
+Products are re-encoded as integers by descending frequency before mining,
+so a receipt is a sorted tuple of small ints and every FP-tree keeps one
+item order (identical baskets are counted once, with a weight). The trees
+are only built for items that are frequent in their conditional base, and
+the search stops at max_len products per set. 100k receipts of 3000
+products take a few seconds.
+"""
+
+import math
+from collections import Counter
+
+MIN_SUPPORT = 0.002   # share of receipts
+MIN_COUNT = 2         # and never fewer receipts than this
+MIN_CONFIDENCE = 0.2
+MAX_LEN = 3           # antecedents of one or two products
+MAX_PER_ANTECEDENT = 10
+
+
+class _Node:
+    __slots__ = ('item', 'count', 'parent', 'children')
+
+    def __init__(self, item, parent):
+        self.item = item
+        self.count = 0
+        self.parent = parent
+        self.children = {}
+
+
+def _tree(transactions, min_count):
+    """FP-tree of weighted transactions (ascending item tuples): the nodes of every
+    frequent item (header table) and the item counts."""
+    counts = Counter()
+    for items, weight in transactions:
+        for item in items:
+            counts[item] += weight
+    frequent = {item: count for item, count in counts.items() if count >= min_count}
+    root = _Node(None, None)
+    header = {}
+    for items, weight in transactions:
+        node = root
+        for item in items:
+            if item not in frequent:
+                continue
+            child = node.children.get(item)
+            if child is None:
+                child = node.children[item] = _Node(item, node)
+                header.setdefault(item, []).append(child)
+            child.count += weight
+            node = child
+    return header, frequent
+
+
+def _grow(transactions, min_count, suffix, max_len, found):
+    header, frequent = _tree(transactions, min_count)
+    for item, count in frequent.items():
+        itemset = (item,) + suffix
+        found[itemset] = count
+        if len(itemset) >= max_len:
+            continue
+        # conditional pattern base: the path above every node of the item
+        base = []
+        for node in header[item]:
+            path = []
+            parent = node.parent
+            while parent.item is not None:
+                path.append(parent.item)
+                parent = parent.parent
+            if path:
+                path.reverse()
+                base.append((path, node.count))
+        if base:
+            _grow(base, min_count, itemset, max_len, found)
+
+
+def mine(baskets, min_count, max_len=MAX_LEN):
+    """Frequent product sets of the baskets (iterables of product ids).
+    Returns ({sorted tuple of product ids: receipts}, number of baskets)."""
+    baskets = [frozenset(b) for b in baskets]
+    counts = Counter(product for basket in baskets for product in basket)
+    # rank 0 = most frequent; infrequent products are dropped right away
+    ranked = sorted((p for p, c in counts.items() if c >= min_count), key=lambda p: (-counts[p], p))
+    rank = {product: i for i, product in enumerate(ranked)}
+    transactions = Counter(tuple(sorted(rank[p] for p in basket if p in rank)) for basket in baskets)
+    found = {}
+    _grow([(items, weight) for items, weight in transactions.items() if items], min_count, (), max_len, found)
+    return {tuple(sorted(ranked[i] for i in itemset)): count for itemset, count in found.items()}, len(baskets)
+
+
+def rules(itemsets, total, min_confidence=MIN_CONFIDENCE, max_per_antecedent=MAX_PER_ANTECEDENT):
+    """[(antecedent tuple, consequent, support_count, confidence, lift), ...] from mine()'s itemsets,
+    best (confidence, lift) first within each antecedent."""
+    by_antecedent = {}
+    for itemset, count in itemsets.items():
+        if len(itemset) < 2:
+            continue
+        for consequent in itemset:
+            antecedent = tuple(p for p in itemset if p != consequent)
+            confidence = count / itemsets[antecedent]
+            lift = confidence * total / itemsets[(consequent,)]
+            if confidence >= min_confidence and lift > 1:
+                by_antecedent.setdefault(antecedent, []).append((antecedent, consequent, count, confidence, lift))
+    result = []
+    for candidates in by_antecedent.values():
+        candidates.sort(key=lambda rule: (-rule[3], -rule[4], rule[1]))
+        result.extend(candidates[:max_per_antecedent])
+    return result
+
+
+def min_count_for(total, min_support=MIN_SUPPORT, min_count=MIN_COUNT):
+    return max(min_count, math.ceil(min_support * total))
+
+
+def read_baskets(conn):
+    """Product sets of all receipts, from idx_expenses_receipt_nr order."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT receipt_nr, product_id FROM expenses
+        WHERE receipt_nr IS NOT NULL AND product_id IS NOT NULL
+        ORDER BY receipt_nr
+    """)
+    baskets = []
+    current, basket = None, None
+    for receipt_nr, product_id in cursor:
+        if receipt_nr != current:
+            current, basket = receipt_nr, set()
+            baskets.append(basket)
+        basket.add(product_id)
+    return baskets
+
+
+def replace_rules(conn, mined):
+    """Write operation: basket_rules := mined (rules() output)."""
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM basket_rules")
+    cursor.executemany(
+        "INSERT INTO basket_rules (antecedent_1, antecedent_2, consequent_id, support_count, confidence, lift) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        ((antecedent[0], antecedent[1] if len(antecedent) > 1 else 0, consequent, count,
+          round(confidence, 4), round(lift, 3))
+         for antecedent, consequent, count, confidence, lift in mined))
+    return len(mined)
+
+
+def suggestions(cursor, product_ids, limit=5):
+    """[(product_id, name, confidence, lift), ...] most likely to be bought with product_ids,
+    none of them already among product_ids."""
+    product_ids = sorted(set(product_ids))
+    if not product_ids:
+        return []
+    marks = ', '.join('?' * len(product_ids))
+    # single antecedents (antecedent_2 = 0) and every pair of the receipt's products
+    cursor.execute(f"""
+        SELECT r.consequent_id, p.name, r.confidence, r.lift
+        FROM basket_rules r JOIN products p ON p.id = r.consequent_id
+        WHERE r.antecedent_1 IN ({marks}) AND r.antecedent_2 IN (0, {marks})
+    """, product_ids + product_ids)
+    best = {}
+    present = set(product_ids)
+    for consequent, name, confidence, lift in cursor.fetchall():
+        if consequent in present:
+            continue
+        if consequent not in best or (confidence, lift) > best[consequent][2:]:
+            best[consequent] = (consequent, name, confidence, lift)
+    return sorted(best.values(), key=lambda row: (-row[2], -row[3], row[1]))[:limit]
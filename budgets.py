@@ -0,0 +1,120 @@
+"""
+Monthly budgets per category and per store type.
+
+A budget row (schema.ensure_budgets) limits the spend of one category
+(target = category id, '0' for lines without a category) or one store type
+(target = stores.store_type, '' for stores without a type) in one month, or in
+every month when its month is '' (a row for a given month overrides it). At
+warn_percent of the limit it is 'warning', from 100% 'over'.
+
+Spend is never summed from expenses here: it is read from the per-month
+counters the expense triggers keep in the same transaction as every write,
+monthly_category_stats and monthly_store_type_stats. status() reads one month
+of those counters for the budget page and GET /budgets/status;
+line_alerts() checks the two budgets a new line counts against with a few
+primary-key reads, so /add_line_item can answer with them at no extra cost.
+"""
+
+import money
+
+SCOPES = ('category', 'store_type')
+WARN_PERCENT = 80
+
+
+def level(spend_bani, limit_bani, warn_percent):
+    if spend_bani >= limit_bani:
+        return 'over'
+    if spend_bani * 100 >= limit_bani * warn_percent:
+        return 'warning'
+    return 'ok'
+
+
+def _entry(scope, target, name, budget_month, limit_bani, warn_percent, spend_bani):
+    return {'scope': scope, 'target': target, 'name': name, 'budget_month': budget_month,
+            'limit': money.lei(limit_bani), 'spend': money.lei(spend_bani),
+            'remaining': money.lei(limit_bani - spend_bani), 'percent': round(spend_bani * 100 / limit_bani, 1),
+            'warn_percent': warn_percent, 'level': level(spend_bani, limit_bani, warn_percent)}
+
+
+def status(cursor, month):
+    """Every budget in force in month ('YYYY-MM') with its spend so far, the fullest first."""
+    cursor.execute("""
+        SELECT scope, target, month, limit_bani, warn_percent FROM budgets
+        WHERE month IN (?, '') ORDER BY month
+    """, (month,))
+    # the month's own row comes after (and replaces) the every-month default
+    budgets = {(scope, target): row for scope, target, *row in cursor.fetchall()}
+    if not budgets:
+        return []
+    cursor.execute("SELECT CAST(category_id AS TEXT), spend_bani FROM monthly_category_stats WHERE month = ?",
+                   (month,))
+    spend = {('category', target): value for target, value in cursor.fetchall()}
+    cursor.execute("SELECT store_type, spend_bani FROM monthly_store_type_stats WHERE month = ?", (month,))
+    spend.update((('store_type', target), value) for target, value in cursor.fetchall())
+    cursor.execute("SELECT CAST(id AS TEXT), categorie FROM categorii")
+    categories = dict(cursor.fetchall())
+    result = []
+    for (scope, target), (budget_month, limit_bani, warn_percent) in budgets.items():
+        if scope == 'category':
+            name = categories.get(target) or ('Fără categorie' if target == '0' else f'Categoria {target}')
+        else:
+            name = target or 'Fără tip'
+        result.append(_entry(scope, target, name, budget_month, limit_bani, warn_percent,
+                             spend.get((scope, target), 0)))
+    result.sort(key=lambda b: (-b['percent'], b['scope'], b['name']))
+    return result
+
+
+def line_alerts(cursor, expense_id):
+    """The budgets of the line's category and store type in its month that are at
+    'warning' or 'over' (primary-key reads of the counters, no aggregate)."""
+    cursor.execute("""
+        SELECT substr(e.date, 1, 7), CAST(IFNULL(p.category_id, 0) AS TEXT), IFNULL(s.store_type, ''),
+               c.categorie
+        FROM expenses e
+        LEFT JOIN products p ON p.id = e.product_id
+        LEFT JOIN stores s ON s.id = e.store_id
+        LEFT JOIN categorii c ON c.id = p.category_id
+        WHERE e.id = ?
+    """, (expense_id,))
+    row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return []
+    month, category, store_type, category_name = row
+    checks = (
+        ('category', category, category_name or 'Fără categorie',
+         "SELECT spend_bani FROM monthly_category_stats WHERE month = ? AND category_id = ?", int(category)),
+        ('store_type', store_type, store_type or 'Fără tip',
+         "SELECT spend_bani FROM monthly_store_type_stats WHERE month = ? AND store_type = ?", store_type),
+    )
+    alerts = []
+    for scope, target, name, spend_sql, key in checks:
+        cursor.execute("""
+            SELECT month, limit_bani, warn_percent FROM budgets
+            WHERE scope = ? AND target = ? AND month IN (?, '') ORDER BY month DESC LIMIT 1
+        """, (scope, target, month))
+        budget = cursor.fetchone()
+        if budget is None:
+            continue
+        cursor.execute(spend_sql, (month, key))
+        spent = cursor.fetchone()
+        entry = _entry(scope, target, name, *budget, spent[0] if spent else 0)
+        if entry['level'] != 'ok':
+            alerts.append(entry)
+    return alerts
+
+
+def set_budget(conn, scope, target, month, limit_bani, warn_percent=WARN_PERCENT):
+    """Write operation: add or change a budget (month '' = every month)."""
+    conn.execute("""
+        INSERT INTO budgets (scope, target, month, limit_bani, warn_percent) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (scope, target, month) DO UPDATE SET
+            limit_bani = excluded.limit_bani, warn_percent = excluded.warn_percent
+    """, (scope, target, month, limit_bani, warn_percent))
+
+
+def delete_budget(conn, scope, target, month):
+    """Write operation: remove a budget; returns the number of rows deleted."""
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM budgets WHERE scope = ? AND target = ? AND month = ?", (scope, target, month))
+    return cursor.rowcount
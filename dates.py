@@ -0,0 +1,65 @@
+"""
+Dates as integer day numbers.
+
+expenses.date and receipts.date hold the canonical text form 'YYYY-MM-DD'
+(read by the pages, the maintained tables and report_cache); next to it
+`day` holds the same date as the number of days since 1970-01-01, see
+migration 0008. Date-range reports filter on `day` through
+idx_expenses_day_total, a range scan over small integers instead of string
+comparisons, and month grouping is computed once per day rather than with
+substr() on every row.
+
+Input (form fields, import files, OCR text) is converted once, on the way
+in, with to_iso(): ISO dates (a time part is dropped) and the receipt
+printers' dd.mm.yyyy / dd/mm/yyyy are accepted, anything else is a
+ValueError. Triggers (schema.ensure_dates) refuse any other text on every
+write path and keep `day` in step with `date`.
+"""
+
+import functools
+from datetime import date, timedelta
+
+EPOCH = date(1970, 1, 1)
+# julianday('1970-01-01')
+EPOCH_JULIAN = 2440587.5
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def to_iso(value):
+    """Date (date object, ISO text, dd.mm.yyyy or dd/mm/yyyy) -> 'YYYY-MM-DD'. Raises ValueError."""
+    # cached: an import repeats the same few thousand dates
+    if isinstance(value, date):
+        return value.isoformat()[:10]
+    s = str(value or '').strip()
+    if len(s) >= 10 and s[4] == '-':
+        return date.fromisoformat(s[:10]).isoformat()
+    if len(s) == 10 and s[2] in './' and s[5] == s[2]:
+        return date(int(s[6:]), int(s[3:5]), int(s[:2])).isoformat()
+    raise ValueError(f'invalid date {value!r}')
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def to_day(value):
+    """Date (anything to_iso accepts) -> days since 1970-01-01. Raises ValueError."""
+    return (date.fromisoformat(to_iso(value)) - EPOCH).days
+
+
+def iso(day):
+    """Day number -> 'YYYY-MM-DD' (None stays None)."""
+    return None if day is None else (EPOCH + timedelta(days=day)).isoformat()
+
+
+def invalid_sql(expr):
+    """SQL true when a date text is not NULL and not a real 'YYYY-MM-DD' date
+    (date() alone lets '2024-02-30' through; the julianday round trip does not)."""
+    return f"({expr} IS NOT NULL AND date(julianday({expr})) IS NOT {expr})"
+
+
+def day_sql(expr):
+    """SQL for the day number of a canonical date text (NULL for NULL / invalid)."""
+    return f"CAST(julianday({expr}) - {EPOCH_JULIAN} AS INTEGER)"
+
+
+def month_sql(day_expr):
+    """SQL for the 'YYYY-MM' of a day number."""
+    return f"strftime('%Y-%m', {day_expr} + {EPOCH_JULIAN})"
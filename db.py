@@ -0,0 +1,150 @@
+"""
+SQLite connection helper shared by app_web.py and the helper scripts.
+
+Every connection opened through `get_db()` is counted and its execute/fetch
+calls are timed, so /metrics can show SQLite time separately from template
+rendering.
+
+When the app runs under several worker processes (see serve.py) the
+database is switched to WAL mode once at startup and every connection waits
+on locks (busy timeout) instead of failing with "database is locked".
+
+The data version is a stamp kept as the mtime of `<db>.version`. The single
+writer bumps it after every commit, and readers check it with one stat()
+call, which lets HTTP caching (ETag / Last-Modified) answer "not modified"
+without opening the database.
+"""
+
+import os
+import sqlite3
+import time
+from time import perf_counter
+
+import metrics
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# EXPENSES_DB lets benchmarks and scratch copies point the app at another file
+EXPENSES_DB = os.environ.get('EXPENSES_DB', os.path.join(BASE_DIR, "expenses.db"))
+
+# seconds a connection waits for a competing writer before raising
+BUSY_TIMEOUT = float(os.environ.get('EXPENSES_DB_BUSY_TIMEOUT', '30'))
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that reports the time spent inside SQLite to `metrics`."""
+
+    def execute(self, *args):
+        start = perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            metrics.add_db_time(perf_counter() - start)
+
+    def executemany(self, *args):
+        start = perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            metrics.add_db_time(perf_counter() - start)
+
+    def executescript(self, *args):
+        start = perf_counter()
+        try:
+            return super().executescript(*args)
+        finally:
+            metrics.add_db_time(perf_counter() - start)
+
+    def fetchone(self):
+        start = perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            metrics.add_db_time(perf_counter() - start)
+
+    def fetchmany(self, *args):
+        start = perf_counter()
+        try:
+            return super().fetchmany(*args)
+        finally:
+            metrics.add_db_time(perf_counter() - start)
+
+    def fetchall(self):
+        start = perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            metrics.add_db_time(perf_counter() - start)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose cursors are TimedCursor; counts open/close for /metrics."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._closed = False
+        metrics.connection_opened()
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            metrics.connection_closed()
+        super().close()
+
+
+def get_db(db_name=None):
+    """Open a connection to the expenses database (or `db_name`).
+
+    Foreign keys are enforced on every connection (SQLite leaves them off by
+    default), so the ON DELETE CASCADE keys declared by migration 0006 apply.
+    """
+    conn = sqlite3.connect(db_name or EXPENSES_DB, timeout=BUSY_TIMEOUT, factory=TimedConnection)
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+
+def enable_wal(db_name=None):
+    """Switch the database to WAL journaling so readers never block the writer.
+
+    The journal mode is stored in the database file, so this only needs to
+    run once (serve.py calls it before starting the workers). Returns the
+    resulting journal mode.
+    """
+    conn = get_db(db_name)
+    try:
+        return conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    finally:
+        conn.close()
+
+
+_last_version = 0
+
+
+def _version_file(db_name=None):
+    return (db_name or EXPENSES_DB) + '.version'
+
+
+def bump_data_version(db_name=None):
+    """Mark the data as changed. Returns the new version (nanoseconds since the epoch)."""
+    global _last_version
+    # strictly increasing within the process even if the clock doesn't move
+    version = max(time.time_ns(), _last_version + 1)
+    _last_version = version
+    path = _version_file(db_name)
+    try:
+        os.utime(path, ns=(version, version))
+    except FileNotFoundError:
+        with open(path, 'w'):
+            pass
+        os.utime(path, ns=(version, version))
+    return version
+
+
+def data_version(db_name=None):
+    """Current data version (0 if nothing has been written since the stamp was introduced)."""
+    try:
+        return os.stat(_version_file(db_name)).st_mtime_ns
+    except FileNotFoundError:
+        return 0
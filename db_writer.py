@@ -0,0 +1,193 @@
+"""
+Single-writer queue for the expenses database.
+
+SQLite allows one writer at a time. Instead of every request opening its own
+connection and committing on its own (and racing for the write lock under
+concurrent use), write operations are queued to one thread per process that
+owns the only write connection. The thread takes whatever has queued up during
+a short window (EXPENSES_WRITER_BATCH_MS, default 2 ms), runs each operation
+inside its own SAVEPOINT and commits the whole batch once, so N concurrent
+writes cost one commit (one fsync) instead of N lock hand-offs.
+
+The writer is per process: it is the only write connection only while the
+app runs as one process, which is serve.py's default (one worker process,
+several threads). With --workers N > 1 every process has its own writer, the
+N writers take turns on SQLite's write lock through the busy timeout
+(db.BUSY_TIMEOUT), and batches only group the writes of one process.
+
+A write operation is a plain function taking the connection as its first
+argument; it must not call commit()/rollback() itself:
+
+    def _delete_expense_op(conn, eid):
+        cur = conn.cursor()
+        cur.execute('DELETE FROM expenses WHERE id = ?', (eid,))
+        return cur.rowcount
+
+    deleted = run_write(_delete_expense_op, 12)        # blocks, returns the result
+    future = submit_write(_delete_expense_op, 12)      # concurrent.futures.Future
+
+An exception raised by an operation rolls back only that operation's
+savepoint and is re-raised in the caller; the rest of the batch commits.
+Every committed batch bumps the data version (db.bump_data_version).
+"""
+
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from time import monotonic, perf_counter
+
+import metrics
+from db import bump_data_version, get_db
+
+BATCH_WINDOW = float(os.environ.get('EXPENSES_WRITER_BATCH_MS', '2')) / 1000.0
+MAX_BATCH = int(os.environ.get('EXPENSES_WRITER_MAX_BATCH', '256'))
+
+_STOP = object()
+
+
+class DBWriter:
+    """Owns the write connection and applies queued operations in group commits."""
+
+    def __init__(self, db_name=None, batch_window=BATCH_WINDOW, max_batch=MAX_BATCH):
+        self.db_name = db_name
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.stats = {'ops': 0, 'batches': 0, 'failed_ops': 0, 'failed_batches': 0}
+
+    # --- caller side ---
+    def submit(self, fn, *args, **kwargs):
+        self._ensure_started()
+        future = Future()
+        self._queue.put((fn, args, kwargs, future))
+        return future
+
+    def execute(self, fn, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return self.submit(fn, *args, **kwargs).result()
+        finally:
+            # queue wait + statement + commit is database time from the request's point of view
+            metrics.add_request_db_time(perf_counter() - start)
+
+    def stop(self, timeout=None):
+        with self._lock:
+            if self._thread is None:
+                return
+            self._queue.put(_STOP)
+            thread, self._thread = self._thread, None
+        thread.join(timeout)
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='expenses-db-writer', daemon=True)
+                self._thread.start()
+
+    # --- writer thread ---
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is _STOP:
+            return None
+        batch = [first]
+        deadline = monotonic() + self.batch_window
+        while len(batch) < self.max_batch:
+            remaining = deadline - monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                # finish this batch, then stop
+                self._queue.put(_STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        conn = get_db(self.db_name)
+        # explicit BEGIN/SAVEPOINT/COMMIT below
+        conn.isolation_level = None
+        try:
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+                self._apply(conn, batch)
+        finally:
+            conn.close()
+
+    def _apply(self, conn, batch):
+        outcomes = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for fn, args, kwargs, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    outcomes.append(None)
+                    continue
+                conn.execute('SAVEPOINT write_op')
+                try:
+                    result = fn(conn, *args, **kwargs)
+                except BaseException as e:
+                    conn.execute('ROLLBACK TO write_op')
+                    conn.execute('RELEASE write_op')
+                    outcomes.append((False, e))
+                else:
+                    conn.execute('RELEASE write_op')
+                    outcomes.append((True, result))
+            conn.execute('COMMIT')
+        except BaseException as e:
+            # the batch could not be committed: fail every operation in it
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            self.stats['failed_batches'] += 1
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.stats['batches'] += 1
+        # before results are handed back, so a caller never sees its write with a stale version
+        bump_data_version(self.db_name)
+        for (_, _, _, future), outcome in zip(batch, outcomes):
+            if outcome is None:
+                continue
+            ok, value = outcome
+            self.stats['ops'] += 1
+            if ok:
+                future.set_result(value)
+            else:
+                self.stats['failed_ops'] += 1
+                future.set_exception(value)
+
+
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """The process-wide writer (re-created after fork, e.g. in gunicorn workers)."""
+    global _writer, _writer_pid
+    if _writer is None or _writer_pid != os.getpid():
+        with _writer_lock:
+            if _writer is None or _writer_pid != os.getpid():
+                _writer = DBWriter()
+                _writer_pid = os.getpid()
+    return _writer
+
+
+def submit_write(fn, *args, **kwargs):
+    return get_writer().submit(fn, *args, **kwargs)
+
+
+def run_write(fn, *args, **kwargs):
+    return get_writer().execute(fn, *args, **kwargs)
+
+
+metrics.register_counters('writer', lambda: dict(get_writer().stats))
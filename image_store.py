@@ -0,0 +1,275 @@
+"""
+Content-addressed store for receipt photos.
+
+An image is stored once, under the SHA-256 of the uploaded bytes:
+
+  <root>/ab/abcdef...             the original, re-encoded as JPEG when that is smaller
+  <root>/thumbs/320/ab/abcdef...  thumbnails, made on first request
+
+The root is EXPENSES_IMAGE_STORE, by default `receipt_images/` next to the
+database. schema.ensure_receipt_images keeps one receipt_images row per
+stored image and the receipt_image_links from receipts.nr_bon to it, so the
+same photo uploaded twice (or attached to two receipts) costs one file and
+one row; a second upload of a known hash skips the compression altogether.
+
+The file name is the content, so an image URL never changes meaning: the
+web app serves originals and thumbnails with a one-year `immutable` cache
+header and pages load the small thumbnails (THUMB_WIDTHS) instead of the
+photos. Serving needs no database access.
+
+Files are written before the rows that name them (and never rewritten), so
+a crash leaves at most an unreferenced file; collect_garbage() removes
+those and the images whose receipts are gone (scripts/receipt_images.py gc).
+Pillow is optional: without it originals are stored as uploaded and the
+thumbnail URLs redirect to the original.
+"""
+
+import hashlib
+import io
+import os
+import re
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import metrics
+from db import EXPENSES_DB
+
+ROOT = os.environ.get('EXPENSES_IMAGE_STORE', os.path.join(os.path.dirname(os.path.abspath(EXPENSES_DB)),
+                                                          'receipt_images'))
+JPEG_QUALITY = 85
+THUMB_QUALITY = 80
+THUMB_WIDTHS = (160, 320, 640)
+DEFAULT_THUMB = 320
+# files younger than this may belong to an upload whose row is not committed yet
+GC_GRACE_SECONDS = 3600
+
+_HASH = re.compile(r'^[0-9a-f]{64}$')
+_MAGIC = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+)
+
+_stats_lock = threading.Lock()
+stats = {'stored': 0, 'duplicates': 0, 'thumbnails': 0}
+
+
+def _count(key):
+    with _stats_lock:
+        stats[key] += 1
+
+
+def sniff_mime(data):
+    """MIME type from the first bytes (JPEG, PNG or WebP), None for anything else."""
+    for magic, mime in _MAGIC:
+        if data.startswith(magic):
+            return mime
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_hash(value):
+    return bool(_HASH.match(value or ''))
+
+
+def original_path(image_hash, root=None):
+    if not is_hash(image_hash):
+        raise ValueError(f'invalid image hash {image_hash!r}')
+    return os.path.join(root or ROOT, image_hash[:2], image_hash)
+
+
+def thumbnail_path(image_hash, width, root=None):
+    if not is_hash(image_hash):
+        raise ValueError(f'invalid image hash {image_hash!r}')
+    return os.path.join(root or ROOT, 'thumbs', str(width), image_hash[:2], image_hash)
+
+
+def _write_atomic(path, data):
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=folder, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _compress(data, mime):
+    """(bytes to keep, their mime, width, height): a JPEG re-encode when it is smaller."""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return data, mime, None, None
+    with Image.open(io.BytesIO(data)) as img:
+        # phone photos carry their rotation in EXIF, which the re-encode would drop
+        img = ImageOps.exif_transpose(img)
+        width, height = img.size
+        if img.mode not in ('L', 'RGB'):
+            img = img.convert('RGB')
+        out = io.BytesIO()
+        img.save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    if out.tell() < len(data):
+        return out.getvalue(), 'image/jpeg', width, height
+    return data, mime, width, height
+
+
+def _size(data):
+    try:
+        from PIL import Image
+    except ImportError:
+        return None, None
+    with Image.open(io.BytesIO(data)) as img:
+        return img.size
+
+
+def save(data, root=None, image_hash=None):
+    """Store an uploaded image file (unless it is there already) and return its
+    receipt_images row as a dict. Raises ValueError for anything but JPEG / PNG / WebP."""
+    mime = sniff_mime(data)
+    if mime is None:
+        raise ValueError('unsupported image type (JPEG, PNG or WebP expected)')
+    image_hash = image_hash or digest(data)
+    path = original_path(image_hash, root)
+    if os.path.exists(path):
+        # left by an earlier upload whose row was never written (or collected since);
+        # touched so that collect_garbage() gives the new row time to be committed
+        os.utime(path)
+        with open(path, 'rb') as f:
+            blob = f.read()
+        mime = sniff_mime(blob)
+        width, height = _size(blob)
+    else:
+        blob, mime, width, height = _compress(data, mime)
+        _write_atomic(path, blob)
+        _count('stored')
+    return {'hash': image_hash, 'mime': mime, 'size_bytes': len(blob), 'original_bytes': len(data),
+            'width': width, 'height': height}
+
+
+def find(conn, image_hash):
+    """The receipt_images row of a hash as a dict, or None."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT hash, mime, size_bytes, original_bytes, width, height FROM receipt_images "
+                   "WHERE hash = ?", (image_hash,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return dict(zip(('hash', 'mime', 'size_bytes', 'original_bytes', 'width', 'height'), row))
+
+
+def link(conn, nr_bon, image):
+    """Write operation: record the image (if new) and link it to the receipt.
+    Returns True when the link is new, False when the receipt already had it."""
+    cursor = conn.cursor()
+    now = datetime.now().isoformat(timespec='seconds')
+    cursor.execute("""
+        INSERT INTO receipt_images (hash, mime, size_bytes, original_bytes, width, height, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (hash) DO NOTHING
+    """, (image['hash'], image['mime'], image['size_bytes'], image['original_bytes'], image['width'],
+          image['height'], now))
+    cursor.execute("INSERT INTO receipt_image_links (nr_bon, hash, added_at) VALUES (?, ?, ?) "
+                   "ON CONFLICT (nr_bon, hash) DO NOTHING", (nr_bon, image['hash'], now))
+    if not cursor.rowcount:
+        _count('duplicates')
+    return cursor.rowcount == 1
+
+
+def unlink(conn, nr_bon, image_hash):
+    """Write operation: remove one receipt's link (the file goes at the next collect_garbage)."""
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM receipt_image_links WHERE nr_bon = ? AND hash = ?", (nr_bon, image_hash))
+    return cursor.rowcount
+
+
+def receipt_images(conn, nr_bons=None):
+    """{nr_bon: [hash, ...]} in upload order, for the given receipts or all of them."""
+    cursor = conn.cursor()
+    if nr_bons is None:
+        cursor.execute("SELECT nr_bon, hash FROM receipt_image_links ORDER BY nr_bon, added_at, hash")
+    else:
+        nr_bons = list(nr_bons)
+        if not nr_bons:
+            return {}
+        cursor.execute(f"SELECT nr_bon, hash FROM receipt_image_links WHERE nr_bon IN "
+                       f"({', '.join('?' * len(nr_bons))}) ORDER BY nr_bon, added_at, hash", nr_bons)
+    images = {}
+    for nr_bon, image_hash in cursor.fetchall():
+        images.setdefault(nr_bon, []).append(image_hash)
+    return images
+
+
+def thumbnail(image_hash, width=DEFAULT_THUMB, root=None):
+    """(path, mime) of the thumbnail, made now if it does not exist yet; (None, None)
+    when Pillow is missing; None when the image is not in the store."""
+    path = thumbnail_path(image_hash, width, root)
+    if os.path.exists(path):
+        return path, 'image/jpeg'
+    source = original_path(image_hash, root)
+    if not os.path.exists(source):
+        return None
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None, None
+    with Image.open(source) as img:
+        img = ImageOps.exif_transpose(img)
+        # receipts are long and narrow: the width is what has to fit
+        img.thumbnail((width, width * 8))
+        if img.mode not in ('L', 'RGB'):
+            img = img.convert('RGB')
+        out = io.BytesIO()
+        img.save(out, 'JPEG', quality=THUMB_QUALITY, optimize=True)
+    # two requests may race here; both write the same bytes and os.replace keeps one
+    _write_atomic(path, out.getvalue())
+    _count('thumbnails')
+    return path, 'image/jpeg'
+
+
+def original_mime(image_hash, root=None):
+    with open(original_path(image_hash, root), 'rb') as f:
+        return sniff_mime(f.read(16)) or 'application/octet-stream'
+
+
+def collect_garbage(conn, root=None, grace_seconds=GC_GRACE_SECONDS, dry_run=False):
+    """Delete the rows of images no receipt links to and every file without a row
+    (older than grace_seconds). Runs on the caller's transaction; returns counts."""
+    root = root or ROOT
+    cursor = conn.cursor()
+    cursor.execute("SELECT hash FROM receipt_images i WHERE NOT EXISTS "
+                   "(SELECT 1 FROM receipt_image_links l WHERE l.hash = i.hash)")
+    unlinked = {r[0] for r in cursor.fetchall()}
+    if unlinked and not dry_run:
+        cursor.execute("DELETE FROM receipt_images WHERE NOT EXISTS "
+                       "(SELECT 1 FROM receipt_image_links l WHERE l.hash = receipt_images.hash)")
+    cursor.execute("SELECT hash FROM receipt_images")
+    known = {r[0] for r in cursor.fetchall()} - unlinked
+    cutoff = time.time() - grace_seconds
+    files = freed = 0
+    for folder, _, names in os.walk(root):
+        for name in names:
+            # .tmp- files are writes that never finished
+            if not (name.startswith('.tmp-') or (is_hash(name) and name not in known)):
+                continue
+            path = os.path.join(folder, name)
+            st = os.stat(path)
+            if st.st_mtime > cutoff:
+                continue
+            files += 1
+            freed += st.st_size
+            if not dry_run:
+                os.remove(path)
+    return {'rows': len(unlinked), 'files': files, 'bytes': freed}
+
+
+metrics.register_counters('image_store', lambda: dict(stats))
@@ -0,0 +1,332 @@
+"""
+Bulk import of historical expenses from CSV or JSON.
+
+Input is streamed: nothing larger than one chunk (CHUNK_LINES lines) is held
+in memory. Accepted shapes:
+
+  CSV (header row required, `;` or `,` separated), one expense line per row:
+      date,store,product,price[,quantity,quantity_type,discount,nr_bon,category,store_type]
+
+  JSON array or JSON Lines (one object per line); each object is either one
+  line with the same keys as the CSV columns, or one receipt with its lines:
+      {"nr_bon": "...", "date": "2024-05-01", "store": "LIDL",
+       "lines": [{"product": "LAPTE", "price": 5.49, "quantity": 2}, ...]}
+
+Dates may be YYYY-MM-DD (a time part is dropped) or DD.MM.YYYY / DD/MM/YYYY
+and are stored as YYYY-MM-DD plus the day number (dates.py). Decimal commas are accepted; amounts are stored
+as integer bani / milli-units (money.py).
+
+Stores, products and categories are resolved against in-memory name maps
+loaded once (case-insensitive, stores upper-cased like the web forms). The
+names a chunk is missing are created with one executemany per table, the
+chunk's new receipts and lines follow with one executemany each, and the
+whole chunk commits as one transaction. Lines that fail validation are
+skipped, counted and reported (first MAX_ERROR_SAMPLES with their location);
+--dry-run validates and resolves everything without writing.
+
+Used by scripts/import_expenses.py (direct connection) and POST /import in
+app_web.py (chunks go through the single writer).
+"""
+
+import csv
+import json
+import re
+from time import perf_counter
+
+import dates
+import money
+import schema
+
+CHUNK_LINES = 50000
+MAX_ERROR_SAMPLES = 20
+# SQLite's default limit on host parameters is 999 on older builds
+_IN_BATCH = 500
+
+_FIELD_ALIASES = {
+    'data': 'date', 'magazin': 'store', 'produs': 'product', 'pret': 'price', 'preț': 'price',
+    'cantitate': 'quantity', 'unitate': 'quantity_type', 'discount': 'discount', 'reducere': 'discount',
+    'categorie': 'category', 'tip_magazin': 'store_type', 'receipt_nr': 'nr_bon', 'store_name': 'store',
+    'product_name': 'product',
+}
+
+_WS = re.compile(r'[\s,]*')
+
+
+class ImportFormatError(ValueError):
+    """The file itself cannot be read (bad header, broken JSON)."""
+
+
+def _number(value, convert, default=None):
+    """Integer bani / milli-units from a number or its text (money.to_bani / to_milli)."""
+    if value is None or value == '':
+        if default is None:
+            raise ValueError('missing number')
+        return default
+    return convert(value)
+
+
+def _text(value):
+    return value.strip() if isinstance(value, str) else ('' if value is None else str(value))
+
+
+def parse_line(rec):
+    """Validate one record; returns the normalized line tuple
+    (nr_bon, date, store, store_type, product, category, price, quantity, quantity_type, discount)
+    with price/discount in integer bani and quantity in milli-units."""
+    get = rec.get
+    store = _text(get('store')).upper()
+    if not store:
+        raise ValueError('store is required')
+    product = _text(get('product'))
+    if not product:
+        raise ValueError('product is required')
+    try:
+        price = _number(get('price'), money.to_bani)
+    except ValueError:
+        raise ValueError(f"invalid price {get('price')!r}")
+    try:
+        quantity = _number(get('quantity'), money.to_milli, money.MILLI)
+        discount = _number(get('discount'), money.to_bani, 0)
+    except ValueError:
+        raise ValueError(f"invalid quantity/discount {get('quantity')!r}/{get('discount')!r}")
+    if quantity <= 0:
+        raise ValueError('quantity must be positive')
+    return (_text(get('nr_bon')) or None, dates.to_iso(get('date')), store, _text(get('store_type')) or None,
+            product, _text(get('category')) or None, price, quantity, _text(get('quantity_type')) or 'buc', discount)
+
+
+# --- readers: yield (location, record dict); see _describe for the location ---
+def iter_csv(f):
+    head = f.readline()
+    if not head.strip():
+        return
+    dialect = ';' if head.count(';') > head.count(',') else ','
+    header = next(csv.reader([head], delimiter=dialect))
+    fields = [_FIELD_ALIASES.get(h.strip().lower(), h.strip().lower()) for h in header]
+    missing = {'date', 'store', 'product', 'price'} - set(fields)
+    if missing:
+        raise ImportFormatError(f"CSV header lacks columns: {', '.join(sorted(missing))}")
+    for n, row in enumerate(csv.reader(f, delimiter=dialect), start=2):
+        if row:
+            yield n, dict(zip(fields, row))
+
+
+def _iter_json_values(f, bufsize=1 << 16):
+    """Stream the elements of a top-level JSON array, or the objects of a JSON Lines file."""
+    decoder = json.JSONDecoder()
+    buf = f.read(bufsize).lstrip()
+    in_array = buf.startswith('[')
+    pos = 1 if in_array else 0
+    while True:
+        pos = _WS.match(buf, pos).end()
+        if pos == len(buf):
+            more = f.read(bufsize)
+            if not more:
+                if in_array:
+                    raise ImportFormatError('unterminated JSON array')
+                return
+            buf, pos = buf[pos:] + more, 0
+            continue
+        if in_array and buf[pos] == ']':
+            return
+        try:
+            value, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError as e:
+            more = f.read(bufsize)
+            if not more:
+                raise ImportFormatError(f'invalid JSON: {e}')
+            buf, pos = buf[pos:] + more, 0
+            continue
+        if end == len(buf):
+            # a number or literal may continue in the next block
+            more = f.read(bufsize)
+            if more:
+                buf, pos = buf[pos:] + more, 0
+                continue
+        yield value
+        pos = end
+
+
+def iter_json(f):
+    for n, obj in enumerate(_iter_json_values(f), start=1):
+        if not isinstance(obj, dict):
+            yield (n,), None
+            continue
+        obj = {_FIELD_ALIASES.get(k, k): v for k, v in obj.items()}
+        lines = obj.pop('lines', None)
+        if lines is None:
+            yield (n,), obj
+            continue
+        for i, line in enumerate(lines, start=1):
+            rec = dict(obj)
+            if isinstance(line, dict):
+                rec.update((_FIELD_ALIASES.get(k, k), v) for k, v in line.items())
+                yield (n, i), rec
+            else:
+                yield (n, i), None
+
+
+def _describe(where):
+    # built only for lines that fail, not for every line read
+    if isinstance(where, int):
+        return f'line {where}'
+    return f'record {where[0]}' if len(where) == 1 else f'record {where[0]}, line {where[1]}'
+
+
+def detect_format(filename):
+    return 'json' if filename.lower().endswith(('.json', '.jsonl', '.ndjson')) else 'csv'
+
+
+class Importer:
+    """Name maps plus the per-chunk insert; one instance per import."""
+
+    def __init__(self, conn):
+        cursor = conn.cursor()
+        # a database made by init_db.py has no categorii or receipts until schema.ensure_all
+        # runs, which a dry run does not do: their maps start empty
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        tables = {r[0] for r in cursor.fetchall()}
+        cursor.execute("SELECT id, name FROM stores")
+        self.stores = {name.upper(): sid for sid, name in cursor.fetchall() if name}
+        cursor.execute("SELECT id, name FROM products")
+        self.products = {name.upper(): pid for pid, name in cursor.fetchall() if name}
+        self.categories = {}
+        if 'categorii' in tables:
+            cursor.execute("SELECT id, categorie FROM categorii")
+            self.categories = {name.lower(): cid for cid, name in cursor.fetchall() if name}
+        self.receipts = set()
+        if 'receipts' in tables:
+            cursor.execute("SELECT nr_bon FROM receipts")
+            self.receipts = {r[0] for r in cursor.fetchall()}
+
+    def plan(self, lines):
+        """Names and receipts in `lines` that do not exist yet (dicts keep first-seen details)."""
+        stores, products, categories, receipts = {}, {}, {}, {}
+        for nr_bon, day, store, store_type, product, category, *_ in lines:
+            if store not in self.stores:
+                stores.setdefault(store, store_type)
+            key = product.upper()
+            if key not in self.products:
+                products.setdefault(key, (product, category))
+                if category and category.lower() not in self.categories:
+                    categories.setdefault(category.lower(), category)
+            if nr_bon and nr_bon not in self.receipts:
+                receipts.setdefault(nr_bon, (store, day))
+        return stores, products, categories, receipts
+
+    def import_chunk(self, conn, lines):
+        """Insert one chunk; runs inside the caller's transaction (no commit here).
+
+        Returns counts of created stores/products/categories/receipts and inserted lines.
+        """
+        stores, products, categories, receipts = self.plan(lines)
+        cursor = conn.cursor()
+        new_categories = self._create(cursor, 'categorii', 'categorie', str.lower,
+                                      [(name,) for name in categories.values()])
+        new_stores = self._create(cursor, 'stores', 'name', str.upper,
+                                  list(stores.items()), extra_column='store_type')
+        category_ids = dict(self.categories, **new_categories)
+        new_products = self._create(
+            cursor, 'products', 'name', str.upper,
+            [(name, category_ids.get(category.lower()) if category else None) for name, category in products.values()],
+            extra_column='category_id')
+
+        store_ids = dict(self.stores, **new_stores)
+        product_ids = dict(self.products, **new_products)
+        cursor.executemany("INSERT OR IGNORE INTO receipts (nr_bon, store_id, date, day) VALUES (?, ?, ?, ?)",
+                           [(nr, store_ids[store], day, dates.to_day(day)) for nr, (store, day) in receipts.items()])
+        schema.bulk_insert_expenses(
+            conn, [(product_ids[product.upper()], store_ids[store], price, quantity, day, nr_bon, discount, qtype,
+                    money.line_total_bani(price, quantity, discount), dates.to_day(day))
+                   for nr_bon, day, store, _, product, _, price, quantity, qtype, discount in lines])
+
+        # only now: if the transaction fails the maps must not point at rolled-back rows
+        self.categories.update(new_categories)
+        self.stores.update(new_stores)
+        self.products.update(new_products)
+        self.receipts.update(receipts)
+        return {'stores': len(stores), 'products': len(products), 'categories': len(categories),
+                'receipts': len(receipts), 'lines': len(lines)}
+
+    @staticmethod
+    def _create(cursor, table, column, key, rows, extra_column=None):
+        """Insert rows whose name is missing; returns {key(name): id} for all of them.
+
+        Names created since the maps were loaded (by the app, while importing)
+        are picked up instead of being inserted twice.
+        """
+        if not rows:
+            return {}
+        ids = {}
+        names = [row[0] for row in rows]
+        for i in range(0, len(names), _IN_BATCH):
+            batch = [key(n) for n in names[i:i + _IN_BATCH]]
+            sql_fn = 'UPPER' if key is str.upper else 'LOWER'
+            cursor.execute(f"SELECT id, {column} FROM {table} WHERE {sql_fn}({column}) IN "
+                           f"({','.join('?' * len(batch))})", batch)
+            ids.update((key(name), rid) for rid, name in cursor.fetchall())
+        rows = [row for row in rows if key(row[0]) not in ids]
+        if rows:
+            cursor.execute(f"SELECT IFNULL(MAX(id), 0) FROM {table}")
+            last_id = cursor.fetchone()[0]
+            columns = f"{column}, {extra_column}" if extra_column else column
+            cursor.executemany(f"INSERT INTO {table} ({columns}) VALUES ({', '.join('?' * len(rows[0]))})", rows)
+            cursor.execute(f"SELECT id, {column} FROM {table} WHERE id > ?", (last_id,))
+            ids.update((key(name), rid) for rid, name in cursor.fetchall())
+        return ids
+
+
+def import_stream(f, fmt, importer, write_chunk=None, chunk_lines=CHUNK_LINES, finish=None):
+    """Validate and import the records read from text stream `f`.
+
+    `write_chunk(lines)` stores one chunk in its own transaction and returns
+    Importer.import_chunk's counts; without it the run is a dry run that only
+    validates and counts what would be created. `finish()` runs after the last
+    chunk, also when the import fails, and counts in the time (the callers
+    rebuild the report indexes there, see schema.drop_import_indexes).
+    """
+    start = perf_counter()
+    summary = {'lines': 0, 'receipts': 0, 'stores': 0, 'products': 0, 'categories': 0,
+               'errors': 0, 'error_samples': [], 'dry_run': write_chunk is None}
+    dry_seen = (set(), set(), set(), set())
+
+    def flush(chunk):
+        if write_chunk is not None:
+            counts = write_chunk(chunk)
+        else:
+            counts = {'lines': len(chunk)}
+            # names repeat across chunks: count each new one once
+            for seen, new, field in zip(dry_seen, importer.plan(chunk),
+                                        ('stores', 'products', 'categories', 'receipts')):
+                fresh = new.keys() - seen
+                seen.update(fresh)
+                counts[field] = len(fresh)
+        for field, value in counts.items():
+            summary[field] += value
+
+    records = iter_json(f) if fmt == 'json' else iter_csv(f)
+    chunk = []
+    try:
+        for where, rec in records:
+            try:
+                if rec is None:
+                    raise ValueError('not an object')
+                chunk.append(parse_line(rec))
+            except (ValueError, TypeError, AttributeError) as e:
+                summary['errors'] += 1
+                if len(summary['error_samples']) < MAX_ERROR_SAMPLES:
+                    summary['error_samples'].append(f'{_describe(where)}: {e}')
+                continue
+            if len(chunk) >= chunk_lines:
+                flush(chunk)
+                chunk = []
+        if chunk:
+            flush(chunk)
+    finally:
+        if finish is not None:
+            finish()
+
+    elapsed = perf_counter() - start
+    summary['seconds'] = round(elapsed, 3)
+    summary['lines_per_second'] = int(summary['lines'] / elapsed) if elapsed else summary['lines']
+    return summary
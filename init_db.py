@@ -1,5 +1,7 @@
 import sqlite3
 
+import schema
+
 # --- Creare baza de date unică pentru toate tabelele ---
 conn = sqlite3.connect('expenses.db')
 cursor = conn.cursor()
@@ -21,19 +23,8 @@ CREATE TABLE IF NOT EXISTS stores (
 )
 ''')
 
-# Creare tabel pentru cheltuieli
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS expenses (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    product_id INTEGER,
-    store_id INTEGER,
-    price REAL,
-    quantity REAL,
-    date TEXT,
-    FOREIGN KEY(product_id) REFERENCES products(id),
-    FOREIGN KEY(store_id) REFERENCES stores(id)
-)
-''')
+# Creare tabel pentru cheltuieli (sume în bani, cantități în miimi - vezi money.py)
+cursor.execute(schema.EXPENSES_TABLE)
 
 conn.commit()
 conn.close()
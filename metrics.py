@@ -0,0 +1,244 @@
+"""
+In-process metrics for the web app, exported in Prometheus text format.
+
+Collection is kept cheap on purpose: a request only touches a thread-local
+and takes one lock when it finishes, and SQLite / template timings are plain
+float additions. Everything is rendered on demand by GET /metrics.
+
+Caches register themselves with `register_cache(name, stats_fn)`; `stats_fn`
+returns a dict with at least `hits`, `misses` and `evictions`. Other components
+export plain counters with `register_counters(name, stats_fn)`.
+"""
+
+import bisect
+import threading
+from time import perf_counter
+
+# seconds; chosen for a small SQLite-backed app (most requests are < 50ms)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    """Cumulative histogram with fixed upper bounds (Prometheus semantics)."""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # one extra slot for +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self):
+        clone = Histogram(self.buckets)
+        clone.counts = list(self.counts)
+        clone.sum = self.sum
+        clone.count = self.count
+        return clone
+
+
+_lock = threading.Lock()
+_local = threading.local()
+
+_requests = {}        # (endpoint, method, status) -> count
+_errors = {}          # endpoint -> count of 5xx responses
+_latency = {}         # endpoint -> Histogram (whole request)
+_db_time = {}         # endpoint -> Histogram (SQLite time inside the request)
+_render_time = {}     # endpoint -> Histogram (template render time inside the request)
+_db_totals = {'seconds': 0.0, 'calls': 0}
+_connections = {'opened': 0, 'closed': 0}
+_caches = {}          # name -> stats callable
+_counters = {}        # name -> stats callable (e.g. the single DB writer)
+
+
+# --- per request ---
+def start_request():
+    _local.start = perf_counter()
+    _local.db = 0.0
+    _local.render = 0.0
+
+
+def add_db_time(elapsed):
+    """Called by db.TimedCursor for every execute/fetch."""
+    _local.db = getattr(_local, 'db', 0.0) + elapsed
+    # += is a read and a write: without the lock concurrent threads lose updates
+    with _lock:
+        _db_totals['seconds'] += elapsed
+        _db_totals['calls'] += 1
+
+
+def start_render():
+    _local.render_start = perf_counter()
+
+
+def end_render():
+    started = getattr(_local, 'render_start', None)
+    if started is not None:
+        _local.render = getattr(_local, 'render', 0.0) + (perf_counter() - started)
+        _local.render_start = None
+
+
+def finish_request(endpoint, method, status):
+    started = getattr(_local, 'start', None)
+    if started is None:
+        return
+    _local.start = None
+    record_request(endpoint, method, status, perf_counter() - started, _local.db, _local.render)
+
+
+def add_request_db_time(elapsed):
+    """Add database time measured on another thread (the single writer) to this request."""
+    _local.db = getattr(_local, 'db', 0.0) + elapsed
+
+
+def take_db_time():
+    """Return and reset the SQLite time accumulated on the current thread.
+
+    Used by app_async.py, where the database work for a request runs on an
+    executor thread rather than the thread that handles the request.
+    """
+    elapsed = getattr(_local, 'db', 0.0)
+    _local.db = 0.0
+    return elapsed
+
+
+def record_request(endpoint, method, status, elapsed, db_time=0.0, render_time=0.0):
+    with _lock:
+        key = (endpoint, method, status)
+        _requests[key] = _requests.get(key, 0) + 1
+        if status >= 500:
+            _errors[endpoint] = _errors.get(endpoint, 0) + 1
+        for table, value in ((_latency, elapsed), (_db_time, db_time), (_render_time, render_time)):
+            hist = table.get(endpoint)
+            if hist is None:
+                hist = table[endpoint] = Histogram()
+            hist.observe(value)
+
+
+# --- connections ---
+def connection_opened():
+    with _lock:
+        _connections['opened'] += 1
+
+
+def connection_closed():
+    with _lock:
+        _connections['closed'] += 1
+
+
+# --- caches ---
+def register_cache(name, stats_fn):
+    _caches[name] = stats_fn
+
+
+def register_counters(name, stats_fn):
+    """Export every key of stats_fn() as expenses_<name>_<key>_total."""
+    _counters[name] = stats_fn
+
+
+# --- exposition ---
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**kw):
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in kw.items()) + '}'
+
+
+def _render_histograms(lines, name, help_text, table):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} histogram')
+    for endpoint, hist in sorted(table.items()):
+        cumulative = 0
+        for bound, count in zip(hist.buckets, hist.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{_labels(endpoint=endpoint, le=bound)} {cumulative}')
+        lines.append(f'{name}_bucket{_labels(endpoint=endpoint, le="+Inf")} {hist.count}')
+        lines.append(f'{name}_sum{_labels(endpoint=endpoint)} {hist.sum:.6f}')
+        lines.append(f'{name}_count{_labels(endpoint=endpoint)} {hist.count}')
+
+
+def render():
+    """Return all metrics as Prometheus text exposition (version 0.0.4)."""
+    with _lock:
+        requests = dict(_requests)
+        errors = dict(_errors)
+        latency = {k: h.copy() for k, h in _latency.items()}
+        db_time = {k: h.copy() for k, h in _db_time.items()}
+        render_time = {k: h.copy() for k, h in _render_time.items()}
+        connections = dict(_connections)
+        db_totals = dict(_db_totals)
+
+    lines = []
+    lines.append('# HELP expenses_http_requests_total HTTP requests by endpoint, method and status.')
+    lines.append('# TYPE expenses_http_requests_total counter')
+    for (endpoint, method, status), count in sorted(requests.items()):
+        lines.append(f'expenses_http_requests_total{_labels(endpoint=endpoint, method=method, status=status)} {count}')
+
+    lines.append('# HELP expenses_http_request_errors_total HTTP 5xx responses by endpoint.')
+    lines.append('# TYPE expenses_http_request_errors_total counter')
+    for endpoint, count in sorted(errors.items()):
+        lines.append(f'expenses_http_request_errors_total{_labels(endpoint=endpoint)} {count}')
+
+    _render_histograms(lines, 'expenses_http_request_duration_seconds',
+                       'Wall-clock request latency by endpoint.', latency)
+    _render_histograms(lines, 'expenses_request_db_seconds',
+                       'Time spent in SQLite per request by endpoint.', db_time)
+    _render_histograms(lines, 'expenses_request_render_seconds',
+                       'Time spent rendering templates per request by endpoint.', render_time)
+
+    lines.append('# HELP expenses_db_seconds_total Total time spent in SQLite calls.')
+    lines.append('# TYPE expenses_db_seconds_total counter')
+    lines.append(f'expenses_db_seconds_total {db_totals["seconds"]:.6f}')
+    lines.append('# HELP expenses_db_calls_total Total SQLite execute/fetch calls.')
+    lines.append('# TYPE expenses_db_calls_total counter')
+    lines.append(f'expenses_db_calls_total {db_totals["calls"]}')
+
+    lines.append('# HELP expenses_db_connections_opened_total SQLite connections opened.')
+    lines.append('# TYPE expenses_db_connections_opened_total counter')
+    lines.append(f'expenses_db_connections_opened_total {connections["opened"]}')
+    lines.append('# HELP expenses_db_connections_open SQLite connections currently open.')
+    lines.append('# TYPE expenses_db_connections_open gauge')
+    lines.append(f'expenses_db_connections_open {connections["opened"] - connections["closed"]}')
+
+    cache_stats = {}
+    for name, stats_fn in sorted(_caches.items()):
+        try:
+            cache_stats[name] = stats_fn()
+        except Exception:
+            continue
+    for field in ('hits', 'misses', 'evictions', 'invalidations'):
+        lines.append(f'# HELP expenses_cache_{field}_total Cache {field} by cache name.')
+        lines.append(f'# TYPE expenses_cache_{field}_total counter')
+        for name, stats in cache_stats.items():
+            lines.append(f'expenses_cache_{field}_total{_labels(cache=name)} {stats.get(field, 0)}')
+    for field in ('entries', 'bytes'):
+        lines.append(f'# HELP expenses_cache_{field} Current cache {field} by cache name (when reported).')
+        lines.append(f'# TYPE expenses_cache_{field} gauge')
+        for name, stats in cache_stats.items():
+            if field in stats:
+                lines.append(f'expenses_cache_{field}{_labels(cache=name)} {stats[field]}')
+    lines.append('# HELP expenses_cache_hit_ratio Hits / (hits + misses) by cache name.')
+    lines.append('# TYPE expenses_cache_hit_ratio gauge')
+    for name, stats in cache_stats.items():
+        lookups = stats.get('hits', 0) + stats.get('misses', 0)
+        ratio = stats.get('hits', 0) / lookups if lookups else 0.0
+        lines.append(f'expenses_cache_hit_ratio{_labels(cache=name)} {ratio:.6f}')
+
+    for name, stats_fn in sorted(_counters.items()):
+        try:
+            stats = stats_fn()
+        except Exception:
+            continue
+        for key, value in sorted(stats.items()):
+            metric = f'expenses_{name}_{key}_total'
+            lines.append(f'# TYPE {metric} counter')
+            lines.append(f'{metric} {value}')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,85 @@
+"""
+Money and quantities as integers.
+
+expenses stores prices and discounts in bani (1 leu = 100 bani) and
+quantities in milli-units (1 buc / kg / l = 1000), see migration 0007. Sums
+over integer columns are exact, so a report total does not depend on the
+order SQLite adds the rows in and needs no rounding pass.
+
+Input (form fields, import files, JSON numbers) is converted once, on the
+way in, from its decimal text: "1.005" is 101 bani, not the 100 that
+round(1.005 * 100) gives. `price`, `quantity` and `discount` stay readable
+as generated columns (price_bani / 100.0, ...) for display and older
+queries; writes go to the integer columns.
+
+One line's amount is price * quantity rounded to the ban (half away from
+zero, like SQLite's ROUND) minus the discount; line_total_sql() and
+line_total_bani() compute the same number.
+"""
+
+import functools
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+BANI = 100
+MILLI = 1000
+
+_CENT = Decimal('0.01')
+_MILLI = Decimal('0.001')
+
+
+def _decimal(value):
+    if isinstance(value, Decimal):
+        return value
+    # str() of a float is its shortest round-trip form, i.e. what was typed
+    s = str(value).strip().replace(',', '.')
+    try:
+        return Decimal(s)
+    except InvalidOperation:
+        raise ValueError(f'invalid number {value!r}')
+
+
+@functools.lru_cache(maxsize=1 << 14)
+def to_bani(value):
+    """Lei (number or decimal text, comma allowed) -> integer bani. Raises ValueError."""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value * BANI
+    d = _decimal(value)
+    if not d.is_finite():
+        raise ValueError(f'invalid amount {value!r}')
+    return int(d.quantize(_CENT, rounding=ROUND_HALF_UP) * BANI)
+
+
+@functools.lru_cache(maxsize=1 << 14)
+def to_milli(value):
+    """Quantity (number or decimal text) -> integer milli-units. Raises ValueError."""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value * MILLI
+    d = _decimal(value)
+    if not d.is_finite():
+        raise ValueError(f'invalid quantity {value!r}')
+    return int(d.quantize(_MILLI, rounding=ROUND_HALF_UP) * MILLI)
+
+
+def lei(bani):
+    """Integer bani -> lei as a float for JSON/templates (None stays None)."""
+    return None if bani is None else bani / BANI
+
+
+def units(milli):
+    """Integer milli-units -> quantity as a float (None stays None)."""
+    return None if milli is None else milli / MILLI
+
+
+def line_total_bani(price_bani, quantity_milli, discount_bani=0):
+    """price * quantity rounded to the ban, minus the discount (all integers)."""
+    gross = (price_bani or 0) * (quantity_milli or 0)
+    rounded = (abs(gross) + MILLI // 2) // MILLI
+    return (rounded if gross >= 0 else -rounded) - (discount_bani or 0)
+
+
+def line_total_sql(row=None):
+    """SQL for one line's amount (price * quantity - discount) in integer bani,
+    of a table alias / NEW / OLD, or unqualified (generated column definition)."""
+    p = f"{row}." if row else ""
+    return (f"(CAST(ROUND(IFNULL({p}price_bani * {p}quantity_milli, 0) / {MILLI}.0) AS INTEGER)"
+            f" - IFNULL({p}discount_bani, 0))")
@@ -0,0 +1,247 @@
+"""
+Receipt OCR with one long-lived Tesseract engine per worker.
+
+The scripts in old/ call pytesseract.image_to_string() for every image, which
+writes the image to a temporary file and starts a new `tesseract` process
+that loads the ron+eng language models again before it reads a single line.
+For a receipt that start-up is a large part of the time. Here the engine is
+created once per worker thread and reused:
+
+  tesserocr    (default when installed) the Tesseract C++ API through
+               tesserocr; the models are loaded when the engine is created
+               and the image is handed over from memory (SetImageBytes), no
+               file and no process per image. An engine is not thread-safe,
+               so every thread gets its own (gunicorn workers are separate
+               processes anyway).
+  pytesseract  the previous path (one process per image), kept as the
+               fallback when tesserocr is not installed and as the baseline
+               for scripts/bench_ocr.py.
+
+EXPENSES_OCR_BACKEND selects one of them (`auto`, the default, prefers
+tesserocr). TESSDATA_PREFIX points at the traineddata folder as before;
+EXPENSES_TESSERACT_CMD sets the tesseract executable for pytesseract.
+
+recognize(image) takes a NumPy uint8 array (grayscale, RGB or RGBA, e.g.
+from preprocess() or load_image()) and returns
+
+  {'text': ..., 'words': [{'text', 'conf', 'box': (x1, y1, x2, y2)}, ...],
+   'backend': ..., 'seconds': ...}
+
+with conf in 0..100 as reported by Tesseract. scan_image() runs the whole
+scan of one receipt (load, preprocess, OCR, receipt_parser) and times each
+stage; scripts/bench_scan.py measures it. Pillow, NumPy, tesserocr,
+pytesseract and OpenCV are optional dependencies (see requirements.txt);
+importing this module works without them.
+"""
+
+import os
+import threading
+import time
+
+import metrics
+import receipt_parser
+
+try:
+    import numpy as np
+except ImportError:  # only needed once an image is read
+    np = None
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+try:
+    import pytesseract
+except ImportError:
+    pytesseract = None
+
+LANG = 'ron+eng'
+PSM = 6  # a single uniform block of text, as the old scanners used (--psm 6)
+BACKEND = os.environ.get('EXPENSES_OCR_BACKEND', 'auto')
+TESSDATA = os.environ.get('TESSDATA_PREFIX')
+TESSERACT_CMD = os.environ.get('EXPENSES_TESSERACT_CMD')
+
+_local = threading.local()
+_stats_lock = threading.Lock()
+stats = {'images': 0, 'engines': 0, 'seconds': 0.0}
+
+
+def _as_uint8(image):
+    if np is None:
+        raise RuntimeError('numpy is required for OCR (pip install numpy)')
+    image = np.ascontiguousarray(image)
+    if image.dtype != np.uint8:
+        raise ValueError(f'expected a uint8 image, got {image.dtype}')
+    if image.ndim not in (2, 3) or (image.ndim == 3 and image.shape[2] not in (1, 3, 4)):
+        raise ValueError(f'expected a grayscale, RGB or RGBA image, got shape {image.shape}')
+    return image
+
+
+class TesserocrBackend:
+    """One tesserocr.PyTessBaseAPI, models loaded once, images passed from memory."""
+
+    name = 'tesserocr'
+
+    def __init__(self, lang=LANG, psm=PSM):
+        if tesserocr is None:
+            raise RuntimeError('tesserocr is not installed (pip install tesserocr)')
+        kwargs = {'lang': lang, 'psm': psm}
+        if TESSDATA:
+            kwargs['path'] = TESSDATA
+        self.api = tesserocr.PyTessBaseAPI(**kwargs)
+
+    def recognize(self, image):
+        image = _as_uint8(image)
+        height, width = image.shape[:2]
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        api = self.api
+        api.SetImageBytes(image.tobytes(), width, height, channels, width * channels)
+        try:
+            api.Recognize()
+            text = api.GetUTF8Text()
+            words = []
+            level = tesserocr.RIL.WORD
+            iterator = api.GetIterator()
+            if iterator is not None:
+                for word in tesserocr.iterate_level(iterator, level):
+                    word_text = word.GetUTF8Text(level)
+                    box = word.BoundingBox(level)
+                    if not word_text or box is None:
+                        continue
+                    words.append({'text': word_text, 'conf': float(word.Confidence(level)), 'box': tuple(box)})
+            return text, words
+        finally:
+            # drop the image and the results, keep the loaded models
+            api.Clear()
+
+    def close(self):
+        self.api.End()
+
+
+class PytesseractBackend:
+    """The old path: one tesseract process (and model load) per image."""
+
+    name = 'pytesseract'
+
+    def __init__(self, lang=LANG, psm=PSM):
+        if pytesseract is None:
+            raise RuntimeError('pytesseract is not installed (pip install pytesseract)')
+        if TESSERACT_CMD:
+            pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
+        self.lang = lang
+        self.config = f'--psm {psm}'
+
+    def recognize(self, image):
+        image = _as_uint8(image)
+        if image.ndim == 3 and image.shape[2] == 1:
+            image = image[:, :, 0]
+        data = pytesseract.image_to_data(image, lang=self.lang, config=self.config,
+                                         output_type=pytesseract.Output.DICT)
+        # image_to_data gives the words only; the text is rebuilt line by line
+        # instead of running tesseract a second time for image_to_string()
+        words = []
+        lines = {}
+        for i, word_text in enumerate(data['text']):
+            conf = float(data['conf'][i])
+            if conf < 0 or not word_text.strip():
+                continue
+            x, y = data['left'][i], data['top'][i]
+            words.append({'text': word_text, 'conf': conf,
+                          'box': (x, y, x + data['width'][i], y + data['height'][i])})
+            key = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+            lines.setdefault(key, []).append(word_text)
+        text = ''.join(' '.join(line) + '\n' for _, line in sorted(lines.items()))
+        return text, words
+
+    def close(self):
+        pass
+
+
+BACKENDS = {'tesserocr': TesserocrBackend, 'pytesseract': PytesseractBackend}
+
+
+def backend_name(name=None):
+    """Resolve `auto` (and EXPENSES_OCR_BACKEND) to an installed backend name."""
+    name = name or BACKEND
+    if name == 'auto':
+        return 'tesserocr' if tesserocr is not None else 'pytesseract'
+    if name not in BACKENDS:
+        raise ValueError(f"EXPENSES_OCR_BACKEND must be auto, tesserocr or pytesseract, not {name!r}")
+    return name
+
+
+def get_engine(name=None):
+    """The calling thread's engine for that backend, created on first use."""
+    name = backend_name(name)
+    engines = getattr(_local, 'engines', None)
+    if engines is None:
+        engines = _local.engines = {}
+    engine = engines.get(name)
+    if engine is None:
+        engine = engines[name] = BACKENDS[name]()
+        with _stats_lock:
+            stats['engines'] += 1
+    return engine
+
+
+def close_engines():
+    """Free the calling thread's engines (the next recognize() loads the models again)."""
+    for engine in getattr(_local, 'engines', {}).values():
+        engine.close()
+    _local.engines = {}
+
+
+def recognize(image, backend=None):
+    """OCR one in-memory image: text plus words with boxes and confidences."""
+    engine = get_engine(backend)
+    started = time.perf_counter()
+    text, words = engine.recognize(image)
+    elapsed = time.perf_counter() - started
+    with _stats_lock:
+        stats['images'] += 1
+        stats['seconds'] += elapsed
+    return {'text': text, 'words': words, 'backend': engine.name, 'seconds': elapsed}
+
+
+def load_image(path):
+    """Read an image file as a grayscale uint8 NumPy array."""
+    from PIL import Image
+    with Image.open(path) as img:
+        return np.asarray(img.convert('L'))
+
+
+def preprocess(image):
+    """Grayscale, local contrast (CLAHE) and adaptive threshold, in memory
+    (the old scanners' preprocess_image() without the temporary file)."""
+    import cv2
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+    enhanced = clahe.apply(image)
+    return cv2.adaptiveThreshold(enhanced, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                 cv2.THRESH_BINARY, 11, 2)
+
+
+def scan_image(image, clean=True, backend=None):
+    """The whole scan of one receipt: load (for a path), preprocess(), recognize()
+    and receipt_parser.parse(). Returns the fields, the text and the seconds per stage."""
+    timings = {}
+    started = time.perf_counter()
+    if isinstance(image, (str, os.PathLike)):
+        image = load_image(image)
+    timings['load'] = time.perf_counter() - started
+    started = time.perf_counter()
+    if clean:
+        image = preprocess(image)
+    timings['preprocess'] = time.perf_counter() - started
+    result = recognize(image, backend)
+    timings['ocr'] = result['seconds']
+    started = time.perf_counter()
+    fields = receipt_parser.parse(result['text'])
+    timings['extract'] = time.perf_counter() - started
+    return {'fields': fields, 'text': result['text'], 'words': result['words'],
+            'backend': result['backend'], 'timings': timings}
+
+
+metrics.register_counters('ocr', lambda: dict(stats))
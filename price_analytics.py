@@ -0,0 +1,476 @@
+"""
+Unit-price history per product and store (/reports/prices).
+
+Every dated expense line with a product, a store and a quantity gets a
+normalized unit price: what was paid for it after the discount, per piece
+(buc) or per kilogram (kg), in bani:
+
+    unit_price = line_total_bani * 1000 / quantity_milli
+
+The lines are held per worker process in a few parallel NumPy arrays
+(about 30 bytes a line) and every question is a vectorized pass over them:
+
+  series(product_id)      the product's unit prices over time, one series per store
+  trends(days)            per product and unit: the yearly change of the unit
+                          price, a least-squares fit of log(unit price) over the
+                          last `days` days of data, plus min / mean / latest
+  basket(product_ids)     the latest unit price of each product at each store:
+                          what the basket costs at every store, the cheapest store
+                          that has it all, and the cheapest store per item
+  inflation()             a personal price index per month, for the whole basket
+                          and per category (see below)
+
+Refresh is incremental, as in report_cache.py: when the data version moved,
+the dates logged in report_changes since the last refresh are read and only
+the lines of those days are dropped from the arrays and read again, so a new
+receipt costs one day's lines, not the history. The latest price per
+(product, store) is recomputed for the products of those lines only, and the
+trends are cached until a refresh changes something. The empty date in
+report_changes (migrations, undated lines, renames) reloads everything.
+
+The inflation index (/reports/inflation) is chain-linked from repeat
+purchases. A product's price in a month is what was spent on it divided by
+the quantity bought. Every product bought in a month that was also bought
+in an earlier month contributes the ratio to its price at that last
+purchase. The month's link is the geometric mean of those ratios, weighted
+by what was spent on each product that month. The index multiplies the
+links together, starting from 100. Months without a repeat purchase carry
+the index forward. The (product, month) prices and the links are kept
+between refreshes: a change recomputes only the months from the earliest
+changed day onwards, so a new month's receipts add one link.
+
+NumPy is needed for these reports only (see requirements.txt); without it
+available() is False and the pages say so.
+"""
+
+import itertools
+import math
+import threading
+
+import dates
+import metrics
+from db import data_version, get_db
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+UNITS = ('buc', 'kg')
+TREND_DAYS = 365
+# fewer lines than this in the window give no trend
+TREND_MIN_LINES = 3
+# nor lines closer together than this: a few days' difference is not a yearly rate
+TREND_MIN_SPAN_DAYS = 28
+# above this many changed days a refresh reads everything again instead
+MAX_RELOAD_DAYS = 500
+# price ratios beyond this factor (either way) are taken for typos or a unit
+# mix-up, not inflation, and left out of the index
+MAX_PRICE_RATIO = 5.0
+
+_LINES = """
+    SELECT id, product_id, store_id, day, CASE WHEN quantity_type = 'kg' THEN 1 ELSE 0 END,
+           line_total_bani, quantity_milli
+    FROM expenses
+    WHERE day IS NOT NULL AND product_id IS NOT NULL AND store_id IS NOT NULL
+      AND quantity_milli > 0 AND line_total_bani > 0
+"""
+_COLUMNS = ('id', 'product', 'store', 'day', 'unit', 'price', 'quantity')
+
+
+def available():
+    return np is not None
+
+
+def _arrays(rows):
+    """Column arrays from (id, product_id, store_id, day, unit, line_total_bani, quantity_milli) rows."""
+    table = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64, count=len(rows) * 7).reshape(-1, 7)
+    return {
+        'id': table[:, 0],
+        'product': table[:, 1].astype(np.int32),
+        'store': table[:, 2].astype(np.int32),
+        'day': table[:, 3].astype(np.int32),
+        'unit': table[:, 4].astype(np.int8),
+        # bani per piece / per kg
+        'price': table[:, 5] * 1000.0 / table[:, 6],
+        'quantity': (table[:, 6] / 1000.0).astype(np.float32),
+    }
+
+
+def _take(data, index):
+    return {name: data[name][index] for name in _COLUMNS}
+
+
+def _group_ends(*keys):
+    """Positions of the last element of every run of equal keys (keys already sorted)."""
+    change = np.zeros(len(keys[0]), dtype=bool)
+    change[-1:] = True
+    for key in keys:
+        change[:-1] |= key[1:] != key[:-1]
+    return np.flatnonzero(change)
+
+
+def _months(day):
+    """Month numbers (months since 1970-01) of day numbers."""
+    return day.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+
+
+def month_text(month):
+    return f'{1970 + month // 12}-{month % 12 + 1:02d}'
+
+
+def _monthly_prices(data, from_month):
+    """Spend and quantity per (product, unit, month) of the lines from from_month on,
+    sorted by product, unit and month."""
+    month = _months(data['day'])
+    window = month >= from_month
+    product_unit = data['product'][window].astype(np.int64) * 2 + data['unit'][window]
+    keys, group = np.unique(product_unit << 16 | month[window], return_inverse=True)
+    group = group.ravel()
+    quantity = data['quantity'][window].astype(np.float64)
+    return {
+        'product_unit': keys >> 16,
+        'month': keys & 0xFFFF,
+        'spend': np.bincount(group, data['price'][window] * quantity, len(keys)),
+        'quantity': np.bincount(group, quantity, len(keys)),
+    }
+
+
+def _links(monthly, categories, from_month):
+    """{(category_id or None for the basket, month): (sum of w * log ratio, sum of w, products)}
+    for the months from from_month on."""
+    product_unit, month = monthly['product_unit'], monthly['month']
+    price = monthly['spend'] / monthly['quantity']
+    # rows with an earlier purchase of the same product and unit right before them
+    repeat = np.flatnonzero(product_unit[1:] == product_unit[:-1]) + 1
+    repeat = repeat[month[repeat] >= from_month]
+    ratio = np.log(price[repeat] / price[repeat - 1])
+    plausible = np.abs(ratio) <= math.log(MAX_PRICE_RATIO)
+    repeat, ratio = repeat[plausible], ratio[plausible]
+    weight = monthly['spend'][repeat]
+    ids, category_ids = categories
+    at = np.clip(np.searchsorted(ids, product_unit[repeat] >> 1), 0, max(len(ids) - 1, 0))
+    category = (np.where(ids[at] == product_unit[repeat] >> 1, category_ids[at], 0) if len(ids)
+                else np.zeros(len(repeat), dtype=np.int64))
+    links = {}
+    for keys, label in ((month[repeat], None), (category << 16 | month[repeat], 'category')):
+        groups, group = np.unique(keys, return_inverse=True)
+        group = group.ravel()
+        swl = np.bincount(group, weight * ratio, len(groups))
+        sw = np.bincount(group, weight, len(groups))
+        n = np.bincount(group, minlength=len(groups))
+        for key, a, b, c in zip(groups.tolist(), swl.tolist(), sw.tolist(), n.tolist()):
+            links[(None, key) if label is None else (key >> 16, key & 0xFFFF)] = (a, b, c)
+    return links
+
+
+def _chain(links, months):
+    """[(month, index, monthly change or None, products compared), ...] over consecutive
+    months, the index 100 in the first one."""
+    rows = []
+    level = 0.0
+    for month in months:
+        swl, sw, n = links.get(month, (0.0, 0.0, 0))
+        step = swl / sw if sw > 0 else 0.0
+        level += step
+        rows.append((month, 100 * math.exp(level), math.expm1(step) if n else None, n))
+    return rows
+
+
+def _latest_prices(data, latest):
+    """Add the newest line of every (product, store) in `data` to latest
+    ({product_id: {store_id: (day, unit, unit_price_bani, expense_id)}}) and return it."""
+    if not len(data['id']):
+        return latest
+    order = np.lexsort((data['id'], data['day'], data['store'], data['product']))
+    ends = order[_group_ends(data['product'][order], data['store'][order])]
+    for product_id, store_id, day, unit, price, expense_id in zip(
+            data['product'][ends].tolist(), data['store'][ends].tolist(), data['day'][ends].tolist(),
+            data['unit'][ends].tolist(), data['price'][ends].tolist(), data['id'][ends].tolist()):
+        latest.setdefault(product_id, {})[store_id] = (day, unit, price, expense_id)
+    return latest
+
+
+class PriceHistory:
+    def __init__(self, db_name=None):
+        self.db_name = db_name
+        self._data = None        # column arrays (see _arrays), in no particular order
+        self._latest = {}        # product_id -> {store_id: (day, unit, unit_price_bani, expense_id)}
+        self._trends = {}        # days -> rows
+        # inflation index state, see _update_inflation()
+        self._monthly = None     # (product, unit, month) spend and quantity
+        self._links = {}         # (category_id or None, month) -> (sum w log ratio, sum w, products)
+        self._stale_month = None  # first month whose prices changed since then (None: all current)
+        self._version = None
+        self._last_change = None
+        self._lock = threading.Lock()
+        self.stats = {'refreshes': 0, 'full_loads': 0, 'days_reloaded': 0, 'lines': 0,
+                      'inflation_updates': 0, 'inflation_months': 0}
+
+    # --- refresh ---
+    def refresh(self):
+        """Bring the arrays up to the current data version; returns them."""
+        if np is None:
+            raise RuntimeError('numpy is required for the price reports (pip install numpy)')
+        version = data_version(self.db_name)
+        if version == self._version and self._data is not None:
+            return self._data
+        with self._lock:
+            if version != self._version or self._data is None:
+                self._refresh(version)
+            return self._data
+
+    def _refresh(self, version):
+        conn = get_db(self.db_name)
+        try:
+            cursor = conn.cursor()
+            # the log and the lines from one read transaction
+            cursor.execute("BEGIN")
+            if self._last_change is None:
+                changed = None
+                cursor.execute("SELECT IFNULL(MAX(id), 0) FROM report_changes")
+                last_change = cursor.fetchone()[0]
+            else:
+                cursor.execute("SELECT id, date FROM report_changes WHERE id > ? ORDER BY id",
+                               (self._last_change,))
+                log = cursor.fetchall()
+                last_change = log[-1][0] if log else self._last_change
+                changed = {r[1] for r in log}
+                if '' in changed or len(changed) > MAX_RELOAD_DAYS:
+                    changed = None
+            if changed is None:
+                cursor.execute(_LINES)
+                data = _arrays(cursor.fetchall())
+                affected = None
+                self.stats['full_loads'] += 1
+            else:
+                days = sorted(dates.to_day(d) for d in changed)
+                rows = []
+                for i in range(0, len(days), 200):
+                    chunk = days[i:i + 200]
+                    cursor.execute(f"{_LINES} AND day IN ({', '.join('?' * len(chunk))})", chunk)
+                    rows.extend(cursor.fetchall())
+                old = self._data
+                keep = ~np.isin(old['day'], np.array(days, dtype=np.int32))
+                fresh = _arrays(rows)
+                data = {name: np.concatenate((old[name][keep], fresh[name])) for name in _COLUMNS}
+                affected = np.union1d(old['product'][~keep], fresh['product'])
+                self.stats['days_reloaded'] += len(days)
+            cursor.execute("COMMIT")
+        finally:
+            conn.close()
+
+        # a new dict, so that queries running meanwhile keep a consistent one
+        if affected is None:
+            self._latest = _latest_prices(data, {})
+        elif len(affected):
+            latest = dict(self._latest)
+            for product_id in affected.tolist():
+                latest.pop(product_id, None)
+            self._latest = _latest_prices(_take(data, np.isin(data['product'], affected)), latest)
+        if affected is None or len(affected):
+            self._trends = {}
+        if affected is None:
+            self._monthly = None
+        elif len(affected):
+            first = int(_months(np.array(days[:1], dtype=np.int32))[0])
+            self._stale_month = first if self._stale_month is None else min(self._stale_month, first)
+        self._data = data
+        self._version = version
+        self._last_change = last_change
+        self.stats['refreshes'] += 1
+        self.stats['lines'] = len(data['id'])
+
+    # --- queries ---
+    def series(self, product_id):
+        """{store_id: [(date, unit, unit_price_lei, quantity), ...]} oldest first."""
+        data = self.refresh()
+        index = np.flatnonzero(data['product'] == product_id)
+        lines = _take(data, index)
+        order = np.lexsort((lines['id'], lines['day'], lines['store']))
+        result = {}
+        for store_id, day, unit, price, quantity in zip(
+                lines['store'][order].tolist(), lines['day'][order].tolist(), lines['unit'][order].tolist(),
+                lines['price'][order].tolist(), lines['quantity'][order].tolist()):
+            result.setdefault(store_id, []).append(
+                (dates.iso(day), UNITS[unit], round(price) / 100, round(quantity, 3)))
+        return result
+
+    def latest(self, product_id):
+        """{store_id: (date, unit, unit_price_lei)} from the newest line at each store."""
+        self.refresh()
+        return {store_id: (dates.iso(day), UNITS[unit], round(price) / 100)
+                for store_id, (day, unit, price, _) in self._latest.get(product_id, {}).items()}
+
+    def trends(self, days=TREND_DAYS):
+        """Per (product, unit) with at least TREND_MIN_LINES lines in the last `days` days
+        of data: [(product_id, unit, lines, min_lei, mean_lei, latest_lei, change_per_year), ...],
+        change_per_year a fraction (0.1 = +10% a year), or None when the lines span less
+        than TREND_MIN_SPAN_DAYS."""
+        data = self.refresh()
+        with self._lock:
+            cached = self._trends.get(days)
+        if cached is not None:
+            return cached
+        rows = []
+        if len(data['day']):
+            end = int(data['day'].max())
+            window = data['day'] > end - days
+            product = data['product'][window].astype(np.int64)
+            key = product * 2 + data['unit'][window]
+            groups, group = np.unique(key, return_inverse=True)
+            group = group.ravel()
+            # days relative to the end keep the sums small
+            x = (data['day'][window] - end).astype(np.float64)
+            y = np.log(data['price'][window])
+            n = np.bincount(group)
+            sx = np.bincount(group, x)
+            sy = np.bincount(group, y)
+            sxx = np.bincount(group, x * x)
+            sxy = np.bincount(group, x * y)
+            spread = n * sxx - sx * sx
+            first = np.full(len(groups), np.inf)
+            last = np.full(len(groups), -np.inf)
+            np.minimum.at(first, group, x)
+            np.maximum.at(last, group, x)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                slope = np.where(spread > 0, (n * sxy - sx * sy) / spread, np.nan)
+            slope[last - first < TREND_MIN_SPAN_DAYS] = np.nan
+            low = np.full(len(groups), np.inf)
+            np.minimum.at(low, group, data['price'][window])
+            mean = np.bincount(group, data['price'][window]) / n
+            # newest line of each group: the last one in (group, day, id) order
+            order = np.lexsort((data['id'][window], x, group))
+            ends = order[_group_ends(group[order])]
+            newest = np.empty(len(groups))
+            newest[group[ends]] = data['price'][window][ends]
+            for i in np.flatnonzero(n >= TREND_MIN_LINES).tolist():
+                change = None if math.isnan(slope[i]) else math.expm1(slope[i] * 365)
+                rows.append((int(groups[i]) // 2, UNITS[int(groups[i]) % 2], int(n[i]), round(low[i]) / 100,
+                             round(mean[i]) / 100, round(newest[i]) / 100, change))
+        with self._lock:
+            if self._data is data:
+                self._trends[days] = rows
+        return rows
+
+    def basket(self, product_ids, quantities=None):
+        """What the basket costs at each store, from the latest unit prices.
+
+        quantities maps product_id -> units (default 1). A product is priced in the
+        unit of its newest line anywhere; stores whose last line of it was in the
+        other unit count as not having it. Returns
+          {'stores': [{'store_id', 'total', 'found', 'missing': [product_id, ...]}, ...]
+                      (stores with every product first, then by total),
+           'cheapest_store': store_id with every product at the lowest total, or None,
+           'items': [{'product_id', 'unit', 'quantity', 'prices': {store_id: lei},
+                      'best_store', 'best_price'}, ...],
+           'split_total': lowest total buying each product where it is cheapest}
+        """
+        self.refresh()
+        latest = self._latest
+        quantities = quantities or {}
+        product_ids = list(dict.fromkeys(product_ids))
+        known = [p for p in product_ids if latest.get(p)]
+        store_ids = sorted({s for p in known for s in latest[p]})
+        column = {s: j for j, s in enumerate(store_ids)}
+        # unit prices (bani), NaN where a store does not have the product
+        prices = np.full((len(known), len(store_ids)), np.nan)
+        units = []
+        for i, product_id in enumerate(known):
+            lines = latest[product_id]
+            unit = max(lines.values(), key=lambda line: (line[0], line[3]))[1]
+            units.append(unit)
+            for store_id, (_, line_unit, price, _) in lines.items():
+                if line_unit == unit:
+                    prices[i, column[store_id]] = price
+        amount = np.array([float(quantities.get(p, 1)) for p in known]).reshape(-1, 1)
+        cost = prices * amount
+        found = (~np.isnan(cost)).sum(axis=0)
+        totals = np.nansum(cost, axis=0)
+        stores = [{'store_id': s, 'total': round(totals[j]) / 100, 'found': int(found[j]),
+                   'missing': [known[i] for i in np.flatnonzero(np.isnan(cost[:, j])).tolist()]
+                   + [p for p in product_ids if p not in latest]}
+                  for j, s in enumerate(store_ids)]
+        stores.sort(key=lambda row: (-row['found'], row['total']))
+        complete = [row for row in stores if row['found'] == len(product_ids)]
+        items = []
+        split = 0.0
+        for i, product_id in enumerate(known):
+            j = int(np.nanargmin(cost[i]))
+            split += cost[i, j]
+            items.append({'product_id': product_id, 'unit': UNITS[units[i]], 'quantity': float(amount[i, 0]),
+                          'prices': {s: round(prices[i, column[s]]) / 100
+                                     for s in store_ids if not np.isnan(prices[i, column[s]])},
+                          'best_store': store_ids[j], 'best_price': round(prices[i, j]) / 100})
+        return {'stores': stores, 'cheapest_store': complete[0]['store_id'] if complete else None,
+                'items': items, 'split_total': round(split) / 100}
+
+    def _update_inflation(self, data):
+        """Bring _monthly and _links up to date with data (under self._lock)."""
+        if self._monthly is not None and self._stale_month is None:
+            return
+        conn = get_db(self.db_name)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, IFNULL(category_id, 0) FROM products ORDER BY id")
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
+        categories = (np.array([r[0] for r in rows], dtype=np.int64), np.array([r[1] for r in rows], dtype=np.int64))
+        if self._monthly is None:
+            from_month = 0
+            monthly = _monthly_prices(data, from_month)
+            links = {}
+        else:
+            # the months before the first changed one stay as they are
+            from_month = self._stale_month
+            old = self._monthly
+            keep = old['month'] < from_month
+            fresh = _monthly_prices(data, from_month)
+            merged = {name: np.concatenate((old[name][keep], fresh[name])) for name in old}
+            order = np.lexsort((merged['month'], merged['product_unit']))
+            monthly = {name: values[order] for name, values in merged.items()}
+            links = {key: value for key, value in self._links.items() if key[1] < from_month}
+        links.update(_links(monthly, categories, from_month))
+        self._monthly, self._links, self._stale_month = monthly, links, None
+        self.stats['inflation_updates'] += 1
+        self.stats['inflation_months'] += len({key[1] for key in links if key[1] >= from_month})
+
+    def inflation(self):
+        """Personal price index per month: {'basket': rows, 'categories': {category_id: rows}},
+        rows as [('YYYY-MM', index, monthly change or None, products compared), ...].
+        Each category's index starts at 100 in its first month."""
+        self.refresh()
+        with self._lock:
+            # a refresh by another thread meanwhile is included as well
+            self._update_inflation(self._data)
+            monthly, links = self._monthly, self._links
+        if monthly is None or not len(monthly['month']):
+            return {'basket': [], 'categories': {}}
+        first, last = int(monthly['month'].min()), int(monthly['month'].max())
+        basket = _chain({m: v for (c, m), v in links.items() if c is None}, range(first, last + 1))
+        per_category = {}
+        for (category_id, month), value in links.items():
+            if category_id is not None:
+                per_category.setdefault(category_id, {})[month] = value
+        categories = {}
+        for category_id, category_links in per_category.items():
+            # from the month before its first link: that month's prices are the base
+            start = max(first, min(category_links) - 1)
+            categories[category_id] = _chain(category_links, range(start, last + 1))
+
+        def text(rows):
+            return [(month_text(month), *rest) for month, *rest in rows]
+        return {'basket': text(basket), 'categories': {c: text(rows) for c, rows in categories.items()}}
+
+    def product_ids(self):
+        """Products with at least one priced line, for the basket picker."""
+        self.refresh()
+        return list(self._latest)
+
+    def info(self):
+        return dict(self.stats)
+
+
+price_history = PriceHistory()
+metrics.register_counters('price_history', price_history.info)
@@ -0,0 +1,108 @@
+"""
+Fields of a Romanian fiscal receipt from its OCR text.
+
+parse(text) returns
+
+  {'total_bani': int | None, 'date': 'YYYY-MM-DD' | None, 'nr_bon': str | None,
+   'lines': [{'name', 'quantity_milli', 'price_bani', 'discount_bani', 'total_bani'}, ...]}
+
+Amounts are integers (see money.py) and the date is canonical (dates.py), so
+the result can go straight into /create_receipt and /add_line_item. The
+printers in bonuri/ put the quantity line before the product line:
+
+  1.000 BUC. x 6.51
+  ZUZU LAPTE 1.5% 1L                 6.51 B
+  REDUCERE LOIALITATE -0.13
+
+Lines are read until SUBTOTAL / TOTAL. The total keywords are those of the
+old scanners' extract_total_smart(), without its "last number anywhere"
+fallback, which mostly picked up the fiscal id.
+"""
+
+import re
+
+import dates
+import money
+
+_AMOUNT = r'-?\d+[.,]\d{2}'
+_TOTAL = re.compile(r'^\s*(?:total(?!\s*tva)(?:\s+de\s+plat[aă])?|sum[aă]\s+de\s+plat[aă])\b[\s:.]*'
+                    rf'({_AMOUNT})', re.IGNORECASE)
+_DATE = re.compile(r'(?<!\d)(\d{2})[./-](\d{2})[./-](\d{4})(?!\d)|(?<!\d)(\d{4}-\d{2}-\d{2})(?!\d)')
+_NR_BON = re.compile(r'\b(?:BF|bon\s+fiscal\s+nr|nr\.?\s*bon)\b\s*[.:]?\s*(\d{1,10})\b', re.IGNORECASE)
+_QUANTITY = re.compile(rf'^\s*(\d+[.,]\d{{1,3}})\s*(?:buc\.?|kg|l)?\s*[x×*]\s*(\d+[.,]\d{{2}})\s*$',
+                       re.IGNORECASE)
+_ITEM = re.compile(rf'^\s*(.*?[^\W\d_].*?)\s+({_AMOUNT})\s*-?\s*[A-E]?\s*$')
+_DISCOUNT = re.compile(rf'^\s*(?:reducere|discount)\b.*?({_AMOUNT})\s*-?\s*[A-E]?\s*$', re.IGNORECASE)
+_END = re.compile(r'^\s*(?:sub\s*total|total)\b', re.IGNORECASE)
+# header / footer lines that end in a number but are not products
+_NOT_ITEM = re.compile(r'\b(?:tva|c\.?i\.?f|cod|rest|numerar|card|ron|lei)\b', re.IGNORECASE)
+
+
+def _bani(text):
+    return money.to_bani(text.replace(',', '.'))
+
+
+def extract_total(text):
+    """TOTAL / SUMA DE PLATA amount in bani (the first such line), or None."""
+    for line in text.splitlines():
+        m = _TOTAL.search(line)
+        if m:
+            return _bani(m.group(1))
+    return None
+
+
+def extract_date(text):
+    """First valid dd.mm.yyyy / dd/mm/yyyy / ISO date as 'YYYY-MM-DD', or None."""
+    for m in _DATE.finditer(text):
+        value = m.group(4) or f'{m.group(1)}.{m.group(2)}.{m.group(3)}'
+        try:
+            return dates.to_iso(value)
+        except ValueError:
+            continue
+    return None
+
+
+def extract_nr_bon(text):
+    """Receipt number (BF: 00116, BON FISCAL NR 345, ...) as printed, or None."""
+    m = _NR_BON.search(text)
+    return m.group(1) if m else None
+
+
+def extract_lines(text):
+    """Product lines before SUBTOTAL / TOTAL, discounts folded into their line."""
+    lines = []
+    pending = None  # (quantity_milli, price_bani) from the line above
+    for raw in text.splitlines():
+        if not raw.strip():
+            continue
+        if _END.match(raw):
+            break
+        m = _QUANTITY.match(raw)
+        if m:
+            pending = (money.to_milli(m.group(1).replace(',', '.')), _bani(m.group(2)))
+            continue
+        m = _DISCOUNT.match(raw)
+        if m:
+            if lines:
+                lines[-1]['discount_bani'] += abs(_bani(m.group(1)))
+            continue
+        m = _ITEM.match(raw)
+        if not m or _NOT_ITEM.search(m.group(1)):
+            pending = None
+            continue
+        total = _bani(m.group(2))
+        quantity, price = pending or (money.MILLI, total)
+        lines.append({'name': m.group(1).strip(), 'quantity_milli': quantity, 'price_bani': price,
+                      'discount_bani': 0, 'total_bani': total})
+        pending = None
+    return lines
+
+
+def parse(text):
+    """All fields of one receipt text (see the module docstring)."""
+    return {
+        'total_bani': extract_total(text),
+        'date': extract_date(text),
+        'nr_bon': extract_nr_bon(text),
+        'lines': extract_lines(text),
+    }
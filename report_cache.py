@@ -0,0 +1,151 @@
+"""
+In-process result cache for the report queries (/reports/monthly, /products, /stores).
+
+Entries are keyed by (report, start_date, end_date) and kept in LRU order,
+capped both by count (EXPENSES_REPORT_CACHE_ENTRIES, default 256) and by the
+estimated size of the cached rows (EXPENSES_REPORT_CACHE_MB, default 32).
+
+Invalidation is range-aware. Triggers (schema.ensure_report_changes) record
+every changed expense date in report_changes. Before serving from the cache,
+the data version stamp (db.data_version, one stat() call) is compared with the
+one seen last; when it moved, the dates changed since the last seen id are
+read and only the entries whose [start_date, end_date] contains one of them
+are dropped. A line item dated today leaves last year's cached reports alone.
+Dates are compared as 'YYYY-MM-DD' text, so the reports pass their range
+already normalized with dates.to_iso (app_web._date_range_args); the WHERE
+clauses filter the same range on the day number.
+
+Each worker process has its own cache; report_changes lives in the database,
+so writes made by other workers or scripts are seen as well.
+"""
+
+import os
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+
+import metrics
+from db import data_version, get_db
+from report_snapshot import report_snapshot
+
+MAX_ENTRIES = int(os.environ.get('EXPENSES_REPORT_CACHE_ENTRIES', '256'))
+MAX_BYTES = int(float(os.environ.get('EXPENSES_REPORT_CACHE_MB', '32')) * 1024 * 1024)
+
+
+def estimate_size(rows):
+    """Approximate memory held by a list of result tuples."""
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+    return size
+
+
+def _contains(start, end, date):
+    return (not start or date >= start) and (not end or date <= end)
+
+
+class ReportCache:
+    def __init__(self, db_name=None, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.db_name = db_name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (rows, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._version = None
+        self._last_change = None
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get_or_compute(self, report, start_date, end_date, compute):
+        """Return the cached rows for this report/range, or run `compute()` and cache its result."""
+        key = (report, start_date or None, end_date or None)
+        try:
+            version = self._sync()
+        except sqlite3.Error:
+            # report_changes missing (schema not checked yet): serve uncached
+            return compute()
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return self._entries[key][0]
+            self.stats['misses'] += 1
+
+        rows = compute()
+        read_version = report_snapshot.version()
+        with self._lock:
+            # a write committed while computing may or may not be in `rows`, and rows
+            # read from a report snapshot that is behind are not current: don't keep them
+            if (version == self._version and data_version(self.db_name) == version
+                    and read_version in (None, version)):
+                self._store(key, rows)
+        return rows
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), bytes=self._bytes)
+
+    def _sync(self):
+        version = data_version(self.db_name)
+        if version == self._version:
+            return version
+        conn = get_db(self.db_name)
+        try:
+            cursor = conn.cursor()
+            if self._last_change is None:
+                # first use: nothing cached yet, just remember where the log is
+                cursor.execute("SELECT IFNULL(MAX(id), 0) FROM report_changes")
+                last_change, dates = cursor.fetchone()[0], []
+            else:
+                cursor.execute("SELECT id, date FROM report_changes WHERE id > ? ORDER BY id",
+                               (self._last_change,))
+                rows = cursor.fetchall()
+                last_change = rows[-1][0] if rows else self._last_change
+                dates = [r[1] for r in rows]
+        finally:
+            conn.close()
+        with self._lock:
+            self._invalidate(dates)
+            # a concurrent sync may already have read further
+            if self._last_change is None or last_change >= self._last_change:
+                self._last_change = last_change
+                self._version = version
+        return version
+
+    def _invalidate(self, dates):
+        if not dates:
+            return
+        if '' in dates:
+            stale = list(self._entries)
+        else:
+            stale = [key for key in self._entries
+                     if any(_contains(key[1], key[2], d) for d in dates)]
+        for key in stale:
+            self._drop(key)
+            self.stats['invalidations'] += 1
+
+    def _store(self, key, rows):
+        size = estimate_size(rows)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (rows, size)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+            self.stats['evictions'] += 1
+
+    def _drop(self, key):
+        _, size = self._entries.pop(key)
+        self._bytes -= size
+
+
+report_cache = ReportCache()
+metrics.register_cache('reports', report_cache.info)
@@ -0,0 +1,160 @@
+"""
+Read-only snapshot connection for the report queries (/reports/...).
+
+Reports read from one snapshot per worker process instead of the live
+database, so a long report never holds up the writer and a write never
+makes a report wait or retry. EXPENSES_REPORT_SNAPSHOT selects how:
+
+  wal     (default) one read-only connection keeps a read transaction open,
+          pinned to the WAL snapshot it started on. Readers never block the
+          writer in WAL mode; checkpoints only stop at the pinned frame.
+          Falls back to `off` when the database is not in WAL mode (the Flask
+          debug server), where an open read transaction would block commits.
+  memory  an in-memory copy taken with the SQLite backup API; nothing is
+          shared with the file at all between refreshes, at the cost of
+          holding the whole database in memory once per worker.
+  off     a new connection per query, as before.
+
+The snapshot is renewed on the first query after the data version
+(db.data_version) moved and the snapshot is at least
+EXPENSES_REPORT_STALENESS seconds old (default 2; 0 renews after every
+write). So a report is never more than that bound behind the last write
+seen by a query. An open WAL snapshot past the bound is also released at
+the end of any request (release_stale), so an idle worker does not keep
+the WAL from being reset.
+
+version() tells the oldest data version the current request has read; the
+report cache and the ETag helper use it so that rows read from a snapshot
+that is behind are neither cached nor labeled as current.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+from db import EXPENSES_DB, TimedConnection, data_version, get_db
+
+MODE = os.environ.get('EXPENSES_REPORT_SNAPSHOT', 'wal')
+MAX_STALENESS = float(os.environ.get('EXPENSES_REPORT_STALENESS', '2'))
+
+
+class ReportSnapshot:
+    def __init__(self, db_name=None, mode=MODE, max_staleness=MAX_STALENESS):
+        if mode not in ('wal', 'memory', 'off'):
+            raise ValueError(f"EXPENSES_REPORT_SNAPSHOT must be wal, memory or off, not {mode!r}")
+        self.db_name = db_name
+        self.mode = mode
+        self.max_staleness = max_staleness
+        self._conn = None
+        self._version = None   # data version when the snapshot was taken
+        self._taken = 0.0      # time.monotonic() of the same moment
+        self._lock = threading.Lock()          # queries and swapping the connection
+        self._refresh_lock = threading.Lock()  # one memory copy at a time
+        self._local = threading.local()
+        self.stats = {'queries': 0, 'refreshes': 0, 'behind': 0}
+
+    def query(self, sql, params=()):
+        """Run one read-only query against the snapshot and return all rows."""
+        if self.mode != 'off' and self._stale():
+            self._refresh()
+        with self._lock:
+            if self._conn is not None:
+                cursor = self._conn.cursor()
+                cursor.execute(sql, params)
+                rows = cursor.fetchall()
+                self._note(self._version)
+                self.stats['queries'] += 1
+                if self._version != data_version(self.db_name):
+                    self.stats['behind'] += 1
+                return rows
+        return self._query_live(sql, params)
+
+    def version(self):
+        """Oldest data version the current thread read since reset() (None: nothing read)."""
+        return getattr(self._local, 'version', None)
+
+    def reset(self):
+        """Start tracking anew (app_web calls it at the start of every request)."""
+        self._local.version = None
+
+    def _note(self, version):
+        seen = self.version()
+        self._local.version = version if seen is None else min(seen, version)
+
+    def release_stale(self):
+        """End a WAL read transaction that is past the staleness bound (cheap when there is none)."""
+        if self.mode != 'wal' or self._conn is None or not self._stale():
+            return
+        with self._lock:
+            if self._conn is not None and self._stale():
+                self._conn.close()
+                self._conn = None
+
+    def _stale(self):
+        if self._conn is None:
+            return True
+        return (data_version(self.db_name) != self._version
+                and time.monotonic() - self._taken >= self.max_staleness)
+
+    def _query_live(self, sql, params):
+        self._note(data_version(self.db_name))
+        conn = get_db(self.db_name)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+        finally:
+            conn.close()
+
+    def _refresh(self):
+        if self.mode == 'memory':
+            self._refresh_memory()
+            return
+        with self._lock:
+            if self._conn is not None and not self._stale():
+                return
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            path = os.path.abspath(self.db_name or EXPENSES_DB)
+            conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False,
+                                   factory=TimedConnection)
+            if conn.execute("PRAGMA journal_mode").fetchone()[0] != 'wal':
+                # an open read transaction would block commits here
+                conn.close()
+                self.mode = 'off'
+                return
+            # the version is read first: the pinned data is at least that new
+            version = data_version(self.db_name)
+            conn.isolation_level = None
+            conn.execute("BEGIN")
+            # the snapshot is pinned by the first read, not by BEGIN
+            conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+            self._conn, self._version, self._taken = conn, version, time.monotonic()
+            self.stats['refreshes'] += 1
+
+    def _refresh_memory(self):
+        # the copy is made outside self._lock: reports keep using the old one meanwhile
+        with self._refresh_lock:
+            if not self._stale():
+                return
+            version = data_version(self.db_name)
+            copy = sqlite3.connect(':memory:', check_same_thread=False, factory=TimedConnection)
+            source = get_db(self.db_name)
+            try:
+                source.backup(copy)
+            finally:
+                source.close()
+            copy.execute("PRAGMA query_only = ON")
+            with self._lock:
+                old = self._conn
+                self._conn, self._version, self._taken = copy, version, time.monotonic()
+                self.stats['refreshes'] += 1
+            if old is not None:
+                old.close()
+
+
+report_snapshot = ReportSnapshot()
+metrics.register_counters('report_snapshot', lambda: dict(report_snapshot.stats))
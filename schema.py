@@ -0,0 +1,1168 @@
+"""
+Best-effort schema checks for the expenses database.
+
+app_web.ensure_schema() runs `ensure_all` once per process through the single
+writer; migration scripts may call the individual functions directly. Every
+function only adds what is missing, so running them again is harmless.
+Changes that rebuild a table (integer money, migration 0007) are left to the
+migration scripts, which take a backup first.
+"""
+
+import sqlite3
+
+import anomalies
+import dates
+import money
+
+# expenses as created on a new database (init_db.py) and by migration 0007.
+# Money is stored in integer bani and quantities in milli-units (see money.py);
+# price / quantity / discount are computed from them for reading only. day is
+# the date as a day number (see dates.py).
+EXPENSES_TABLE = """
+    CREATE TABLE IF NOT EXISTS expenses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_id INTEGER REFERENCES products(id) ON DELETE SET NULL,
+        store_id INTEGER REFERENCES stores(id) ON DELETE CASCADE,
+        price_bani INTEGER,
+        quantity_milli INTEGER,
+        date TEXT,
+        receipt_nr TEXT REFERENCES receipts(nr_bon) ON DELETE CASCADE ON UPDATE CASCADE,
+        discount_bani INTEGER NOT NULL DEFAULT 0,
+        quantity_type TEXT DEFAULT 'buc',
+        line_total_bani INTEGER,
+        day INTEGER,
+        {generated}
+    )
+"""
+
+# legacy REAL column -> (integer column, generated definition)
+MONEY_COLUMNS = {
+    'price': ('price_bani', "price REAL GENERATED ALWAYS AS (price_bani / 100.0) VIRTUAL"),
+    'quantity': ('quantity_milli', "quantity REAL GENERATED ALWAYS AS (quantity_milli / 1000.0) VIRTUAL"),
+    'discount': ('discount_bani', "discount REAL GENERATED ALWAYS AS (discount_bani / 100.0) VIRTUAL"),
+}
+EXPENSES_TABLE = EXPENSES_TABLE.format(
+    generated=',\n        '.join(generated for _, generated in MONEY_COLUMNS.values()))
+
+
+def has_integer_money(conn):
+    """True once expenses stores price_bani / quantity_milli / discount_bani (migration 0007)."""
+    cursor = conn.cursor()
+    # table_info leaves out generated columns; the integer ones are ordinary columns
+    cursor.execute("PRAGMA table_info(expenses)")
+    return 'price_bani' in {r[1] for r in cursor.fetchall()}
+
+
+def ensure_integer_money(conn):
+    """Refuse to start on a database that still stores REAL prices."""
+    if not has_integer_money(conn):
+        raise RuntimeError("expenses still stores REAL price/quantity/discount: "
+                           "run scripts/migrate_0007_integer_money.py first")
+
+
+def ensure_receipts_schema(conn):
+    """Ensure receipts table exists and expenses has receipt_id column."""
+    cursor = conn.cursor()
+    # Create receipts table if missing. New schema uses nr_bon as primary key (TEXT).
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS receipts (
+            nr_bon TEXT PRIMARY KEY,
+            store_id INTEGER REFERENCES stores(id) ON DELETE CASCADE,
+            date TEXT,
+            day INTEGER
+        )
+    """)
+    # Ensure expenses has receipt_nr (TEXT) column for linking to receipts.nr_bon
+    cursor.execute("PRAGMA table_info(expenses)")
+    cols = [r[1] for r in cursor.fetchall()]
+    if 'receipt_nr' not in cols:
+        try:
+            cursor.execute("ALTER TABLE expenses ADD COLUMN receipt_nr TEXT")
+        except Exception:
+            pass
+
+
+def ensure_expense_discount_column(conn):
+    """Ensure the expenses table has a discount column (REAL, before migration 0007)."""
+    cursor = conn.cursor()
+    # table_xinfo also lists the generated discount column of the integer layout
+    cursor.execute("PRAGMA table_xinfo(expenses)")
+    cols = [r[1] for r in cursor.fetchall()]
+    if 'discount' not in cols:
+        try:
+            cursor.execute("ALTER TABLE expenses ADD COLUMN discount REAL DEFAULT 0.0")
+        except Exception:
+            # best-effort; if it fails we'll still proceed
+            pass
+
+
+def _create_triggers(cursor, triggers):
+    """Create the triggers, replacing any whose stored definition differs from the current one."""
+    cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'")
+    existing = dict(cursor.fetchall())
+    # one statement per execute(): executescript() would commit the writer's open transaction
+    for name, (event, body) in triggers.items():
+        sql = f"CREATE TRIGGER {name} {event} BEGIN {body} END"
+        if existing.get(name) == sql:
+            continue
+        if name in existing:
+            cursor.execute(f"DROP TRIGGER {name}")
+        cursor.execute(sql)
+
+
+def _table_exists(cursor, name):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+    return cursor.fetchone() is not None
+
+
+def _line_total(row):
+    """SQL for one expense line's amount in bani (price * quantity - discount) of NEW/OLD/a table alias."""
+    return money.line_total_sql(row)
+
+
+# Row triggers on INSERT INTO expenses that have a set-based equivalent:
+# trigger name -> SQL applying the same change for every expense with id > ?.
+# bulk_insert_expenses() drops these triggers for the length of one insert and
+# runs the SQL once instead of the trigger once per row.
+_BULK_EXPENSE_INSERT = {}
+# Row triggers that only validate: trigger name -> (SELECT returning an offending
+# value among the expenses with id > ?, error message).
+_BULK_EXPENSE_CHECKS = {}
+_ALL_TRIGGERS = {}
+# Secondary indexes on expenses that only the reads use: index name -> CREATE
+# INDEX. An import run drops them before its first chunk and builds them again,
+# with one sort each, after its last (drop_import_indexes / create_import_indexes).
+_BULK_EXPENSE_INDEXES = {
+    'idx_expenses_day_total': "CREATE INDEX IF NOT EXISTS idx_expenses_day_total "
+                              "ON expenses(day, line_total_bani, store_id, product_id)",
+    'idx_expenses_line_total': "CREATE INDEX IF NOT EXISTS idx_expenses_line_total ON expenses(line_total_bani)",
+}
+
+
+# Writers set line_total_bani themselves (money.line_total_bani); these only
+# correct a row written without it, or whose amounts changed, so a correct
+# insert costs one comparison and no second write.
+_LINE_TOTAL_FIX = f"UPDATE expenses SET line_total_bani = {_line_total('NEW')} WHERE id = NEW.id;"
+_LINE_TOTAL_TRIGGERS = {
+    'expenses_line_total_insert': (
+        f"AFTER INSERT ON expenses WHEN NEW.line_total_bani IS NOT {_line_total('NEW')}", _LINE_TOTAL_FIX),
+    'expenses_line_total_update': (
+        'AFTER UPDATE OF price_bani, quantity_milli, discount_bani, line_total_bani ON expenses '
+        f"WHEN NEW.line_total_bani IS NOT {_line_total('NEW')}", _LINE_TOTAL_FIX),
+}
+_ALL_TRIGGERS.update(_LINE_TOTAL_TRIGGERS)
+_BULK_EXPENSE_INSERT['expenses_line_total_insert'] = (
+    f"UPDATE expenses SET line_total_bani = {_line_total('expenses')} "
+    f"WHERE id > ? AND line_total_bani IS NOT {_line_total('expenses')}")
+
+
+# --- dates: canonical 'YYYY-MM-DD' text plus the day number (see dates.py) ---
+_DATE_CHECK = "SELECT RAISE(ABORT, 'invalid date: expected YYYY-MM-DD');"
+
+
+def _date_triggers(table, key):
+    fix = f"UPDATE {table} SET day = {dates.day_sql('NEW.date')} WHERE {key} = NEW.{key};"
+    stale = f"NEW.day IS NOT {dates.day_sql('NEW.date')}"
+    return {
+        f'{table}_date_check_insert': (f"BEFORE INSERT ON {table} WHEN {dates.invalid_sql('NEW.date')}",
+                                       _DATE_CHECK),
+        f'{table}_date_check_update': (f"BEFORE UPDATE OF date ON {table} WHEN {dates.invalid_sql('NEW.date')}",
+                                       _DATE_CHECK),
+        # writers set day themselves (dates.to_day); these only correct a row written without it
+        f'{table}_day_insert': (f"AFTER INSERT ON {table} WHEN {stale}", fix),
+        f'{table}_day_update': (f"AFTER UPDATE OF date, day ON {table} WHEN {stale}", fix),
+    }
+
+
+_DATE_TRIGGERS = dict(_date_triggers('expenses', 'id'), **_date_triggers('receipts', 'nr_bon'))
+_ALL_TRIGGERS.update(_DATE_TRIGGERS)
+# checked once over the inserted rows instead: raises after the insert, the caller's transaction rolls back
+_BULK_EXPENSE_CHECKS['expenses_date_check_insert'] = (
+    f"SELECT date FROM expenses WHERE id > ? AND {dates.invalid_sql('date')} LIMIT 1",
+    "invalid date: expected YYYY-MM-DD")
+_BULK_EXPENSE_INSERT['expenses_day_insert'] = (
+    f"UPDATE expenses SET day = {dates.day_sql('date')} "
+    f"WHERE id > ? AND day IS NOT {dates.day_sql('date')}")
+
+
+def has_day_columns(conn):
+    """True once expenses has the day column (migration 0008)."""
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(expenses)")
+    return 'day' in {r[1] for r in cursor.fetchall()}
+
+
+def ensure_dates(conn):
+    """Refuse to start before migration 0008 (dates normalized, expenses.day filled);
+    then the day columns, idx_expenses_day_total and the triggers that reject any
+    date text other than 'YYYY-MM-DD' on every write and keep day in step."""
+    if not has_day_columns(conn):
+        raise RuntimeError("expenses has no day column (dates not normalized yet): "
+                           "run scripts/migrate_0008_day_numbers.py first")
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(receipts)")
+    if 'day' not in {r[1] for r in cursor.fetchall()}:
+        cursor.execute("ALTER TABLE receipts ADD COLUMN day INTEGER")
+        cursor.execute(f"UPDATE receipts SET day = {dates.day_sql('date')}")
+    # date-range reports: a range scan on day that also covers amount, store and product
+    cursor.execute(_BULK_EXPENSE_INDEXES['idx_expenses_day_total'])
+    cursor.execute("DROP INDEX IF EXISTS idx_expenses_date_total")
+    _create_triggers(cursor, _DATE_TRIGGERS)
+
+
+def ensure_line_total(conn):
+    """Ensure expenses.line_total_bani, filled for existing rows, and its indexes.
+
+    It is a plain column kept right by the writers and _LINE_TOTAL_TRIGGERS
+    rather than a generated one: SQLite does not answer queries from an index
+    on a generated column without reading the row, while with a plain column
+    idx_expenses_day_total (ensure_dates) covers the report queries (day range,
+    amount, store, product). idx_expenses_line_total serves "most expensive
+    lines" in index order.
+    """
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_xinfo(expenses)")
+    if 'line_total_bani' not in {r[1] for r in cursor.fetchall()}:
+        cursor.execute("ALTER TABLE expenses ADD COLUMN line_total_bani INTEGER")
+        cursor.execute(f"UPDATE expenses SET line_total_bani = {money.line_total_sql()}")
+    cursor.execute(_BULK_EXPENSE_INDEXES['idx_expenses_line_total'])
+    _create_triggers(cursor, _LINE_TOTAL_TRIGGERS)
+
+
+# delete + insert rather than INSERT OR REPLACE: inside a trigger fired by an
+# ON UPDATE CASCADE action the OR REPLACE is not applied and the insert fails
+_LOG_DATE = "DELETE FROM report_changes WHERE date = {0}; INSERT INTO report_changes (date) VALUES ({0});"
+
+# trigger name -> (event, body)
+_REPORT_CHANGE_TRIGGERS = {
+    'report_changes_expense_insert': ('AFTER INSERT ON expenses', _LOG_DATE.format("IFNULL(NEW.date, '')")),
+    'report_changes_expense_delete': ('AFTER DELETE ON expenses', _LOG_DATE.format("IFNULL(OLD.date, '')")),
+    'report_changes_expense_update': ('AFTER UPDATE ON expenses', _LOG_DATE.format("IFNULL(OLD.date, '')")
+                                      + _LOG_DATE.format("IFNULL(NEW.date, '')")),
+    'report_changes_store_rename': ('AFTER UPDATE OF name ON stores', _LOG_DATE.format("''")),
+    'report_changes_store_delete': ('AFTER DELETE ON stores', _LOG_DATE.format("''")),
+    'report_changes_product_rename': ('AFTER UPDATE OF name ON products', _LOG_DATE.format("''")),
+    'report_changes_product_delete': ('AFTER DELETE ON products', _LOG_DATE.format("''")),
+    'report_changes_product_category': ('AFTER UPDATE OF category_id ON products', _LOG_DATE.format("''")),
+    'report_changes_category_rename': ('AFTER UPDATE OF categorie ON categorii', _LOG_DATE.format("''")),
+}
+_ALL_TRIGGERS.update(_REPORT_CHANGE_TRIGGERS)
+_BULK_EXPENSE_INSERT['report_changes_expense_insert'] = (
+    "INSERT OR REPLACE INTO report_changes (date) SELECT DISTINCT IFNULL(date, '') FROM expenses WHERE id > ?")
+
+
+def ensure_report_changes(conn):
+    """Log which expense dates changed, for report_cache.py.
+
+    report_changes keeps one row per changed date; re-inserting a date moves
+    it to a new id, so "dates changed since id N" is a single indexed scan and
+    the table never grows past the number of distinct dates. The empty date
+    means "all ranges" (renamed/deleted stores and products, undated lines).
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS report_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date TEXT NOT NULL UNIQUE
+        )
+    """)
+    _create_triggers(cursor, _REPORT_CHANGE_TRIGGERS)
+
+
+# --- per-store summary (GET /stores/<id>) ---
+def _store_line_add(row):
+    return f"""
+        INSERT INTO store_stats (store_id, line_count, spend_bani, first_visit, last_visit)
+        VALUES ({row}.store_id, 1, {_line_total(row)}, {row}.date, {row}.date)
+        ON CONFLICT(store_id) DO UPDATE SET
+            line_count = line_count + 1,
+            spend_bani = spend_bani + excluded.spend_bani,
+            first_visit = CASE WHEN first_visit IS NULL OR excluded.first_visit < first_visit
+                               THEN excluded.first_visit ELSE first_visit END,
+            last_visit = CASE WHEN last_visit IS NULL OR excluded.last_visit > last_visit
+                              THEN excluded.last_visit ELSE last_visit END;
+        INSERT INTO store_product_stats (store_id, product_id, line_count, quantity_milli, spend_bani)
+        SELECT {row}.store_id, {row}.product_id, 1, IFNULL({row}.quantity_milli, 0), {_line_total(row)}
+        WHERE {row}.product_id IS NOT NULL
+        ON CONFLICT(store_id, product_id) DO UPDATE SET
+            line_count = line_count + 1,
+            quantity_milli = quantity_milli + excluded.quantity_milli,
+            spend_bani = spend_bani + excluded.spend_bani;"""
+
+
+def _store_line_remove(row):
+    # first/last visit come back from the (store_id, date) index: two seeks, not a scan
+    return f"""
+        UPDATE store_stats SET
+            line_count = line_count - 1,
+            spend_bani = spend_bani - {_line_total(row)},
+            first_visit = (SELECT MIN(date) FROM expenses WHERE store_id = {row}.store_id),
+            last_visit = (SELECT MAX(date) FROM expenses WHERE store_id = {row}.store_id)
+        WHERE store_id = {row}.store_id;
+        UPDATE store_product_stats SET
+            line_count = line_count - 1,
+            quantity_milli = quantity_milli - IFNULL({row}.quantity_milli, 0),
+            spend_bani = spend_bani - {_line_total(row)}
+        WHERE store_id = {row}.store_id AND product_id = {row}.product_id;
+        DELETE FROM store_product_stats
+        WHERE store_id = {row}.store_id AND product_id = {row}.product_id AND line_count <= 0;"""
+
+
+_RECEIPT_COUNT_ADD = """
+        INSERT INTO store_stats (store_id, receipt_count) SELECT NEW.store_id, 1 WHERE NEW.store_id IS NOT NULL
+        ON CONFLICT(store_id) DO UPDATE SET receipt_count = receipt_count + 1;"""
+_RECEIPT_COUNT_REMOVE = """
+        UPDATE store_stats SET receipt_count = receipt_count - 1 WHERE store_id = OLD.store_id;"""
+
+_STORE_STATS_TRIGGERS = {
+    'store_stats_expense_insert': ('AFTER INSERT ON expenses WHEN NEW.store_id IS NOT NULL',
+                                   _store_line_add('NEW')),
+    'store_stats_expense_delete': ('AFTER DELETE ON expenses WHEN OLD.store_id IS NOT NULL',
+                                   _store_line_remove('OLD')),
+    'store_stats_expense_update_old': (
+        'AFTER UPDATE OF store_id, product_id, price_bani, quantity_milli, discount_bani, date ON expenses '
+        'WHEN OLD.store_id IS NOT NULL', _store_line_remove('OLD')),
+    'store_stats_expense_update_new': (
+        'AFTER UPDATE OF store_id, product_id, price_bani, quantity_milli, discount_bani, date ON expenses '
+        'WHEN NEW.store_id IS NOT NULL', _store_line_add('NEW')),
+    'store_stats_receipt_insert': ('AFTER INSERT ON receipts WHEN NEW.store_id IS NOT NULL', _RECEIPT_COUNT_ADD),
+    'store_stats_receipt_delete': ('AFTER DELETE ON receipts WHEN OLD.store_id IS NOT NULL', _RECEIPT_COUNT_REMOVE),
+    'store_stats_receipt_move': ('AFTER UPDATE OF store_id ON receipts',
+                                 _RECEIPT_COUNT_REMOVE + _RECEIPT_COUNT_ADD),
+    'store_stats_store_delete': ('AFTER DELETE ON stores', """
+        DELETE FROM store_stats WHERE store_id = OLD.id;
+        DELETE FROM store_product_stats WHERE store_id = OLD.id;"""),
+}
+_ALL_TRIGGERS.update(_STORE_STATS_TRIGGERS)
+_BULK_EXPENSE_INSERT['store_stats_expense_insert'] = f"""
+        INSERT INTO store_stats (store_id, line_count, spend_bani, first_visit, last_visit)
+        SELECT store_id, COUNT(*), SUM({_line_total('e')}), MIN(date), MAX(date)
+        FROM expenses e WHERE id > ? AND store_id IS NOT NULL GROUP BY store_id
+        ON CONFLICT(store_id) DO UPDATE SET
+            line_count = line_count + excluded.line_count,
+            spend_bani = spend_bani + excluded.spend_bani,
+            first_visit = CASE WHEN first_visit IS NULL OR excluded.first_visit < first_visit
+                               THEN excluded.first_visit ELSE first_visit END,
+            last_visit = CASE WHEN last_visit IS NULL OR excluded.last_visit > last_visit
+                              THEN excluded.last_visit ELSE last_visit END;
+        INSERT INTO store_product_stats (store_id, product_id, line_count, quantity_milli, spend_bani)
+        SELECT store_id, product_id, COUNT(*), IFNULL(SUM(quantity_milli), 0), SUM({_line_total('e')})
+        FROM expenses e WHERE id > ?1 AND store_id IS NOT NULL AND product_id IS NOT NULL
+        GROUP BY store_id, product_id
+        ON CONFLICT(store_id, product_id) DO UPDATE SET
+            line_count = line_count + excluded.line_count,
+            quantity_milli = quantity_milli + excluded.quantity_milli,
+            spend_bani = spend_bani + excluded.spend_bani"""
+
+
+def rebuild_store_stats(conn):
+    """Recompute store_stats / store_product_stats from receipts and expenses."""
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM store_stats")
+    cursor.execute("DELETE FROM store_product_stats")
+    cursor.execute(f"""
+        INSERT INTO store_stats (store_id, line_count, spend_bani, first_visit, last_visit)
+        SELECT store_id, COUNT(*), SUM({_line_total('e')}), MIN(date), MAX(date)
+        FROM expenses e WHERE store_id IS NOT NULL GROUP BY store_id
+    """)
+    cursor.execute("""
+        INSERT INTO store_stats (store_id, receipt_count)
+        SELECT store_id, COUNT(*) FROM receipts WHERE store_id IS NOT NULL GROUP BY store_id
+        ON CONFLICT(store_id) DO UPDATE SET receipt_count = excluded.receipt_count
+    """)
+    cursor.execute(f"""
+        INSERT INTO store_product_stats (store_id, product_id, line_count, quantity_milli, spend_bani)
+        SELECT store_id, product_id, COUNT(*), IFNULL(SUM(quantity_milli), 0), SUM({_line_total('e')})
+        FROM expenses e WHERE store_id IS NOT NULL AND product_id IS NOT NULL
+        GROUP BY store_id, product_id
+    """)
+
+
+def ensure_store_stats(conn):
+    """Per-store summary maintained by triggers: receipt/line counts, spend (bani), first/last visit,
+    and per (store, product) totals for the top-products list. Filled from existing data
+    the first time."""
+    cursor = conn.cursor()
+    existed = _table_exists(cursor, 'store_stats')
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS store_stats (
+            store_id INTEGER PRIMARY KEY,
+            receipt_count INTEGER NOT NULL DEFAULT 0,
+            line_count INTEGER NOT NULL DEFAULT 0,
+            spend_bani INTEGER NOT NULL DEFAULT 0,
+            first_visit TEXT,
+            last_visit TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS store_product_stats (
+            store_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            line_count INTEGER NOT NULL DEFAULT 0,
+            quantity_milli INTEGER NOT NULL DEFAULT 0,
+            spend_bani INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (store_id, product_id)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_store_product_stats_spend ON store_product_stats(store_id, spend_bani)")
+    # first/last visit after a delete, and the store page's receipt history (keyset pagination)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_expenses_store_date ON expenses(store_id, date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_expenses_receipt_nr ON expenses(receipt_nr)")
+    # the page key is IFNULL(date, ''), so undated receipts sort last and stay reachable
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_receipts_store_day_key "
+                   "ON receipts(store_id, IFNULL(date, ''), nr_bon)")
+    cursor.execute("DROP INDEX IF EXISTS idx_receipts_store_date")
+    if not existed:
+        rebuild_store_stats(conn)
+    _create_triggers(cursor, _STORE_STATS_TRIGGERS)
+
+
+# --- receipt header totals (receipts.total_bani / line_count / discount_total_bani) ---
+RECEIPT_TOTAL_COLUMNS = {
+    'total_bani': "INTEGER NOT NULL DEFAULT 0",
+    'line_count': "INTEGER NOT NULL DEFAULT 0",
+    'discount_total_bani': "INTEGER NOT NULL DEFAULT 0",
+    'completed_at': "TEXT",
+}
+
+
+def _receipt_line(row, sign):
+    return f"""
+        UPDATE receipts SET
+            total_bani = total_bani {sign} {_line_total(row)},
+            line_count = line_count {sign} 1,
+            discount_total_bani = discount_total_bani {sign} IFNULL({row}.discount_bani, 0)
+        WHERE nr_bon = {row}.receipt_nr;"""
+
+
+_RECEIPT_TOTAL_TRIGGERS = {
+    'receipt_totals_expense_insert': ('AFTER INSERT ON expenses WHEN NEW.receipt_nr IS NOT NULL',
+                                      _receipt_line('NEW', '+')),
+    'receipt_totals_expense_delete': ('AFTER DELETE ON expenses WHEN OLD.receipt_nr IS NOT NULL',
+                                      _receipt_line('OLD', '-')),
+    # a renamed nr_bon reaches the lines through ON UPDATE CASCADE after the header
+    # (and its totals) already moved: the old header is gone then, nothing to move
+    'receipt_totals_expense_update': (
+        'AFTER UPDATE OF receipt_nr, price_bani, quantity_milli, discount_bani ON expenses '
+        'WHEN OLD.receipt_nr IS NEW.receipt_nr OR OLD.receipt_nr IS NULL '
+        'OR EXISTS (SELECT 1 FROM receipts WHERE nr_bon = OLD.receipt_nr)',
+        _receipt_line('OLD', '-') + _receipt_line('NEW', '+')),
+}
+_ALL_TRIGGERS.update(_RECEIPT_TOTAL_TRIGGERS)
+_BULK_EXPENSE_INSERT['receipt_totals_expense_insert'] = f"""
+        UPDATE receipts SET
+            total_bani = receipts.total_bani + d.total_bani,
+            line_count = receipts.line_count + d.line_count,
+            discount_total_bani = receipts.discount_total_bani + d.discount_total_bani
+        FROM (SELECT receipt_nr, SUM({_line_total('e')}) AS total_bani, COUNT(*) AS line_count,
+                     IFNULL(SUM(discount_bani), 0) AS discount_total_bani
+              FROM expenses e WHERE id > ? AND receipt_nr IS NOT NULL GROUP BY receipt_nr) AS d
+        WHERE receipts.nr_bon = d.receipt_nr"""
+
+_RECEIPT_TOTALS_FROM_LINES = f"""
+    SELECT receipt_nr AS nr, IFNULL(SUM({_line_total('e')}), 0) AS t, COUNT(*) AS n,
+           IFNULL(SUM(discount_bani), 0) AS disc
+    FROM expenses e WHERE receipt_nr IS NOT NULL {{where}} GROUP BY receipt_nr
+"""
+
+
+def recompute_receipt_totals(conn, nr_bon=None):
+    """Set the header totals from the receipt's lines (all receipts, or one)."""
+    cursor = conn.cursor()
+    where, params = ("AND receipt_nr = ?", (nr_bon,)) if nr_bon is not None else ("", ())
+    cursor.execute(f"""
+        UPDATE receipts SET total_bani = 0, line_count = 0, discount_total_bani = 0
+        {"WHERE nr_bon = ?" if nr_bon is not None else ""}
+    """, params)
+    cursor.execute(f"""
+        UPDATE receipts SET total_bani = d.t, line_count = d.n, discount_total_bani = d.disc
+        FROM ({_RECEIPT_TOTALS_FROM_LINES.format(where=where)}) AS d
+        WHERE receipts.nr_bon = d.nr
+    """, params)
+
+
+def verify_receipt_totals(conn):
+    """Receipts whose header totals differ from their lines:
+    [(nr_bon, (total_bani, line_count, discount_total_bani) stored, same from the lines), ...]."""
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT r.nr_bon, r.total_bani, r.line_count, r.discount_total_bani,
+               IFNULL(d.t, 0), IFNULL(d.n, 0), IFNULL(d.disc, 0)
+        FROM receipts r
+        LEFT JOIN ({_RECEIPT_TOTALS_FROM_LINES.format(where="")}) AS d ON d.nr = r.nr_bon
+        WHERE r.total_bani IS NOT IFNULL(d.t, 0) OR r.line_count IS NOT IFNULL(d.n, 0)
+           OR r.discount_total_bani IS NOT IFNULL(d.disc, 0)
+    """)
+    return [(row[0], row[1:4], row[4:7]) for row in cursor.fetchall()]
+
+
+def ensure_receipt_totals(conn):
+    """Header totals on receipts, kept up to date by triggers on expenses;
+    completed_at is set by /complete_receipt. Filled from the lines the first time."""
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(receipts)")
+    present = {r[1] for r in cursor.fetchall()}
+    for column, definition in RECEIPT_TOTAL_COLUMNS.items():
+        if column not in present:
+            cursor.execute(f"ALTER TABLE receipts ADD COLUMN {column} {definition}")
+    if 'total_bani' not in present:
+        recompute_receipt_totals(conn)
+    _create_triggers(cursor, _RECEIPT_TOTAL_TRIGGERS)
+
+
+# --- per-month, per-category rollup (GET /reports/categories) ---
+# month is 'YYYY-MM' ('' for undated lines); lines without a product or category count
+# under product_id / category_id 0. The category is the product's current one: moving a
+# product to another category moves its months with it.
+def _month(row):
+    return f"IFNULL(substr({row}.date, 1, 7), '')"
+
+
+def _category_of(row):
+    return f"IFNULL((SELECT category_id FROM products WHERE id = {row}.product_id), 0)"
+
+
+def _category_line(row, sign):
+    if sign == '+':
+        return f"""
+        INSERT INTO monthly_product_stats (month, product_id, line_count, quantity_milli, spend_bani)
+        VALUES ({_month(row)}, IFNULL({row}.product_id, 0), 1, IFNULL({row}.quantity_milli, 0), {_line_total(row)})
+        ON CONFLICT(month, product_id) DO UPDATE SET
+            line_count = line_count + 1,
+            quantity_milli = quantity_milli + excluded.quantity_milli,
+            spend_bani = spend_bani + excluded.spend_bani;
+        INSERT INTO monthly_category_stats (month, category_id, line_count, spend_bani)
+        VALUES ({_month(row)}, {_category_of(row)}, 1, {_line_total(row)})
+        ON CONFLICT(month, category_id) DO UPDATE SET
+            line_count = line_count + 1,
+            spend_bani = spend_bani + excluded.spend_bani;"""
+    return f"""
+        UPDATE monthly_product_stats SET
+            line_count = line_count - 1,
+            quantity_milli = quantity_milli - IFNULL({row}.quantity_milli, 0),
+            spend_bani = spend_bani - {_line_total(row)}
+        WHERE month = {_month(row)} AND product_id = IFNULL({row}.product_id, 0);
+        DELETE FROM monthly_product_stats
+        WHERE month = {_month(row)} AND product_id = IFNULL({row}.product_id, 0) AND line_count <= 0;
+        UPDATE monthly_category_stats SET
+            line_count = line_count - 1,
+            spend_bani = spend_bani - {_line_total(row)}
+        WHERE month = {_month(row)} AND category_id = {_category_of(row)};
+        DELETE FROM monthly_category_stats
+        WHERE month = {_month(row)} AND category_id = {_category_of(row)} AND line_count <= 0;"""
+
+
+def _category_move(sign, category, product=None):
+    # a product's months added to / taken from a category (product category change or delete)
+    product = product or ('NEW.id' if sign == '+' else 'OLD.id')
+    if sign == '+':
+        return f"""
+        INSERT INTO monthly_category_stats (month, category_id, line_count, spend_bani)
+        SELECT month, {category}, line_count, spend_bani FROM monthly_product_stats WHERE product_id = {product}
+        ON CONFLICT(month, category_id) DO UPDATE SET
+            line_count = line_count + excluded.line_count,
+            spend_bani = spend_bani + excluded.spend_bani;"""
+    return f"""
+        UPDATE monthly_category_stats SET
+            line_count = monthly_category_stats.line_count - m.line_count,
+            spend_bani = monthly_category_stats.spend_bani - m.spend_bani
+        FROM (SELECT month, line_count, spend_bani FROM monthly_product_stats WHERE product_id = {product}) AS m
+        WHERE monthly_category_stats.month = m.month AND monthly_category_stats.category_id = {category};
+        DELETE FROM monthly_category_stats WHERE category_id = {category} AND line_count <= 0;"""
+
+
+_CATEGORY_STATS_TRIGGERS = {
+    'category_stats_expense_insert': ('AFTER INSERT ON expenses', _category_line('NEW', '+')),
+    'category_stats_expense_delete': ('AFTER DELETE ON expenses', _category_line('OLD', '-')),
+    'category_stats_expense_update_old': (
+        'AFTER UPDATE OF product_id, price_bani, quantity_milli, discount_bani, date ON expenses',
+        _category_line('OLD', '-')),
+    'category_stats_expense_update_new': (
+        'AFTER UPDATE OF product_id, price_bani, quantity_milli, discount_bani, date ON expenses',
+        _category_line('NEW', '+')),
+    'category_stats_product_move': (
+        'AFTER UPDATE OF category_id ON products WHEN OLD.category_id IS NOT NEW.category_id',
+        _category_move('-', 'IFNULL(OLD.category_id, 0)') + _category_move('+', 'IFNULL(NEW.category_id, 0)')),
+    # ON DELETE SET NULL then moves the lines to product 0, but the expense update trigger
+    # runs after the product row is gone and cannot see its category any more: its months
+    # leave the category here, while the product can still be read
+    'category_stats_product_delete': (
+        'BEFORE DELETE ON products WHEN IFNULL(OLD.category_id, 0) <> 0',
+        _category_move('-', 'OLD.category_id') + _category_move('+', '0', 'OLD.id')),
+}
+_ALL_TRIGGERS.update(_CATEGORY_STATS_TRIGGERS)
+_BULK_EXPENSE_INSERT['category_stats_expense_insert'] = f"""
+        INSERT INTO monthly_product_stats (month, product_id, line_count, quantity_milli, spend_bani)
+        SELECT {_month('e')}, IFNULL(product_id, 0), COUNT(*), IFNULL(SUM(quantity_milli), 0), SUM({_line_total('e')})
+        FROM expenses e WHERE id > ? GROUP BY 1, 2
+        ON CONFLICT(month, product_id) DO UPDATE SET
+            line_count = line_count + excluded.line_count,
+            quantity_milli = quantity_milli + excluded.quantity_milli,
+            spend_bani = spend_bani + excluded.spend_bani;
+        INSERT INTO monthly_category_stats (month, category_id, line_count, spend_bani)
+        SELECT {_month('e')}, IFNULL(p.category_id, 0), COUNT(*), SUM({_line_total('e')})
+        FROM expenses e LEFT JOIN products p ON p.id = e.product_id WHERE e.id > ? GROUP BY 1, 2
+        ON CONFLICT(month, category_id) DO UPDATE SET
+            line_count = line_count + excluded.line_count,
+            spend_bani = spend_bani + excluded.spend_bani"""
+
+
+def rebuild_category_stats(conn):
+    """Recompute monthly_product_stats / monthly_category_stats from expenses."""
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM monthly_product_stats")
+    cursor.execute("DELETE FROM monthly_category_stats")
+    cursor.execute(f"""
+        INSERT INTO monthly_product_stats (month, product_id, line_count, quantity_milli, spend_bani)
+        SELECT {_month('e')}, IFNULL(product_id, 0), COUNT(*), IFNULL(SUM(quantity_milli), 0), SUM({_line_total('e')})
+        FROM expenses e GROUP BY 1, 2
+    """)
+    cursor.execute("""
+        INSERT INTO monthly_category_stats (month, category_id, line_count, spend_bani)
+        SELECT m.month, IFNULL(p.category_id, 0), SUM(m.line_count), SUM(m.spend_bani)
+        FROM monthly_product_stats m LEFT JOIN products p ON p.id = m.product_id
+        GROUP BY 1, 2
+    """)
+
+
+def ensure_product_categories(conn):
+    """categorii and products.category_id. A database made by init_db.py only has the text
+    column products.category: the id column is added empty and
+    scripts/migrate_products_category.py maps the text later."""
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE IF NOT EXISTS categorii (id INTEGER PRIMARY KEY AUTOINCREMENT, categorie TEXT)")
+    cursor.execute("PRAGMA table_info(products)")
+    if 'category_id' not in {r[1] for r in cursor.fetchall()}:
+        cursor.execute("ALTER TABLE products ADD COLUMN category_id INTEGER REFERENCES categorii(id)")
+
+
+def ensure_category_stats(conn):
+    """Per-month totals by category and by product, maintained by triggers, for the
+    category report and its product drill-down. Filled from existing data the first time."""
+    cursor = conn.cursor()
+    existed = _table_exists(cursor, 'monthly_category_stats')
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS monthly_category_stats (
+            month TEXT NOT NULL,
+            category_id INTEGER NOT NULL,
+            line_count INTEGER NOT NULL DEFAULT 0,
+            spend_bani INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (month, category_id)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS monthly_product_stats (
+            month TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            line_count INTEGER NOT NULL DEFAULT 0,
+            quantity_milli INTEGER NOT NULL DEFAULT 0,
+            spend_bani INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (month, product_id)
+        ) WITHOUT ROWID
+    """)
+    # category moves and the drill-down read one product's months
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_monthly_product_stats_product "
+                   "ON monthly_product_stats(product_id, month)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_category ON products(category_id)")
+    if not existed:
+        rebuild_category_stats(conn)
+    _create_triggers(cursor, _CATEGORY_STATS_TRIGGERS)
+
+
+# --- per-month spend by store type (budgets.py) ---
+# store_type '' = stores without a type. Like the category rollup, a line counts under
+# its store's current type: changing a store's type recounts that store's lines
+# (idx_expenses_store_date) from the old type to the new one.
+def _store_type_of(row):
+    return f"IFNULL((SELECT store_type FROM stores WHERE id = {row}.store_id), '')"
+
+
+def _store_type_line(row, sign):
+    if sign == '+':
+        return f"""
+        INSERT INTO monthly_store_type_stats (month, store_type, line_count, spend_bani)
+        VALUES ({_month(row)}, {_store_type_of(row)}, 1, {_line_total(row)})
+        ON CONFLICT(month, store_type) DO UPDATE SET
+            line_count = line_count + 1,
+            spend_bani = spend_bani + excluded.spend_bani;"""
+    return f"""
+        UPDATE monthly_store_type_stats SET
+            line_count = line_count - 1,
+            spend_bani = spend_bani - {_line_total(row)}
+        WHERE month = {_month(row)} AND store_type = {_store_type_of(row)};
+        DELETE FROM monthly_store_type_stats
+        WHERE month = {_month(row)} AND store_type = {_store_type_of(row)} AND line_count <= 0;"""
+
+
+def _store_months(store):
+    return (f"SELECT {_month('e')} AS month, COUNT(*) AS line_count, SUM({_line_total('e')}) AS spend_bani "
+            f"FROM expenses e WHERE store_id = {store} GROUP BY 1")
+
+
+def _store_type_move(store, old_type, new_type):
+    # a store's months moved between store types (store type change or delete)
+    return f"""
+        UPDATE monthly_store_type_stats SET
+            line_count = monthly_store_type_stats.line_count - m.line_count,
+            spend_bani = monthly_store_type_stats.spend_bani - m.spend_bani
+        FROM ({_store_months(store)}) AS m
+        WHERE monthly_store_type_stats.month = m.month
+          AND monthly_store_type_stats.store_type = IFNULL({old_type}, '');
+        DELETE FROM monthly_store_type_stats WHERE store_type = IFNULL({old_type}, '') AND line_count <= 0;
+        INSERT INTO monthly_store_type_stats (month, store_type, line_count, spend_bani)
+        SELECT month, IFNULL({new_type}, ''), line_count, spend_bani FROM ({_store_months(store)}) WHERE 1
+        ON CONFLICT(month, store_type) DO UPDATE SET
+            line_count = line_count + excluded.line_count,
+            spend_bani = spend_bani + excluded.spend_bani;"""
+
+
+_STORE_TYPE_STATS_TRIGGERS = {
+    'store_type_stats_expense_insert': ('AFTER INSERT ON expenses', _store_type_line('NEW', '+')),
+    'store_type_stats_expense_delete': ('AFTER DELETE ON expenses', _store_type_line('OLD', '-')),
+    'store_type_stats_expense_update_old': (
+        'AFTER UPDATE OF store_id, price_bani, quantity_milli, discount_bani, date ON expenses',
+        _store_type_line('OLD', '-')),
+    'store_type_stats_expense_update_new': (
+        'AFTER UPDATE OF store_id, price_bani, quantity_milli, discount_bani, date ON expenses',
+        _store_type_line('NEW', '+')),
+    'store_type_stats_store_move': (
+        "AFTER UPDATE OF store_type ON stores WHEN IFNULL(OLD.store_type, '') IS NOT IFNULL(NEW.store_type, '')",
+        _store_type_move('OLD.id', 'OLD.store_type', 'NEW.store_type')),
+    # the lines a store delete cascades to are deleted after the stores row, when
+    # _store_type_of no longer finds the type: move its months to '' first
+    'store_type_stats_store_delete': (
+        "BEFORE DELETE ON stores WHEN IFNULL(OLD.store_type, '') <> ''",
+        _store_type_move('OLD.id', 'OLD.store_type', "''")),
+}
+_ALL_TRIGGERS.update(_STORE_TYPE_STATS_TRIGGERS)
+_BULK_EXPENSE_INSERT['store_type_stats_expense_insert'] = f"""
+        INSERT INTO monthly_store_type_stats (month, store_type, line_count, spend_bani)
+        SELECT {_month('e')}, IFNULL(s.store_type, ''), COUNT(*), SUM({_line_total('e')})
+        FROM expenses e LEFT JOIN stores s ON s.id = e.store_id WHERE e.id > ? GROUP BY 1, 2
+        ON CONFLICT(month, store_type) DO UPDATE SET
+            line_count = line_count + excluded.line_count,
+            spend_bani = spend_bani + excluded.spend_bani"""
+
+
+def rebuild_store_type_stats(conn):
+    """Recompute monthly_store_type_stats from expenses."""
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM monthly_store_type_stats")
+    cursor.execute(f"""
+        INSERT INTO monthly_store_type_stats (month, store_type, line_count, spend_bani)
+        SELECT {_month('e')}, IFNULL(s.store_type, ''), COUNT(*), SUM({_line_total('e')})
+        FROM expenses e LEFT JOIN stores s ON s.id = e.store_id
+        GROUP BY 1, 2
+    """)
+
+
+def ensure_store_type_column(conn):
+    """stores.store_type (a database made by init_db.py only has id and name)."""
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(stores)")
+    if 'store_type' not in {r[1] for r in cursor.fetchall()}:
+        cursor.execute("ALTER TABLE stores ADD COLUMN store_type TEXT")
+
+
+def ensure_budgets(conn):
+    """Monthly budgets per category and per store type (budgets.py), and the per-month
+    spend by store type they are checked against, maintained by triggers next to
+    monthly_category_stats. Filled from existing data the first time."""
+    ensure_store_type_column(conn)
+    cursor = conn.cursor()
+    existed = _table_exists(cursor, 'monthly_store_type_stats')
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS monthly_store_type_stats (
+            month TEXT NOT NULL,
+            store_type TEXT NOT NULL,
+            line_count INTEGER NOT NULL DEFAULT 0,
+            spend_bani INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (month, store_type)
+        ) WITHOUT ROWID
+    """)
+    # scope 'category' (target = category id, '0' without category) or 'store_type'
+    # (target = the type, '' without type); month '' = every month without its own row
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS budgets (
+            scope TEXT NOT NULL CHECK (scope IN ('category', 'store_type')),
+            target TEXT NOT NULL,
+            month TEXT NOT NULL DEFAULT '',
+            limit_bani INTEGER NOT NULL CHECK (limit_bani > 0),
+            warn_percent INTEGER NOT NULL DEFAULT 80,
+            PRIMARY KEY (scope, target, month)
+        ) WITHOUT ROWID
+    """)
+    if not existed:
+        rebuild_store_type_stats(conn)
+    _create_triggers(cursor, _STORE_TYPE_STATS_TRIGGERS)
+
+
+def bulk_insert_expenses(conn, rows, columns=('product_id', 'store_id', 'price_bani', 'quantity_milli', 'date',
+                                              'receipt_nr', 'discount_bani', 'quantity_type', 'line_total_bani',
+                                              'day')):
+    """executemany INSERT INTO expenses, with the maintained tables updated once per call
+    instead of once per row. Must run inside a transaction (the writer's, or BEGIN IMMEDIATE)
+    so that no other connection ever sees the row triggers missing."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT IFNULL(MAX(id), 0) FROM expenses")
+    last_id = cursor.fetchone()[0]
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")
+    present = {r[0] for r in cursor.fetchall()}
+    deferred = [name for name in (*_BULK_EXPENSE_INSERT, *_BULK_EXPENSE_CHECKS) if name in present]
+    for name in deferred:
+        cursor.execute(f"DROP TRIGGER {name}")
+    cursor.executemany(f"INSERT INTO expenses ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                       rows)
+    inserted = cursor.rowcount
+    for name in deferred:
+        for statement in _BULK_EXPENSE_INSERT.get(name, '').split(';'):
+            if statement.strip():
+                cursor.execute(statement, (last_id,))
+    _create_triggers(cursor, {name: _ALL_TRIGGERS[name] for name in deferred})
+    for name in deferred:
+        if name in _BULK_EXPENSE_CHECKS:
+            sql, message = _BULK_EXPENSE_CHECKS[name]
+            cursor.execute(sql, (last_id,))
+            bad = cursor.fetchone()
+            if bad:
+                raise sqlite3.IntegrityError(f"{message} ({bad[0]!r})")
+    return inserted
+
+
+def drop_import_indexes(conn):
+    """Write operation: drop the report indexes of expenses (_BULK_EXPENSE_INDEXES) for the
+    length of an import run, so its chunks do not insert into them in random key order.
+    Reports stay correct meanwhile, only slower; create_import_indexes() (or ensure_all)
+    builds them again."""
+    for name in _BULK_EXPENSE_INDEXES:
+        conn.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+def create_import_indexes(conn):
+    """Write operation: build the indexes drop_import_indexes() dropped, one sort each."""
+    for sql in _BULK_EXPENSE_INDEXES.values():
+        conn.execute(sql)
+
+
+# --- full-text search over receipts (GET /search) ---
+# One receipt_search document per receipt: nr_bon, store name, product names and
+# the raw OCR text. Triggers only note which receipts changed (search_dirty);
+# refresh_search_index() rebuilds those documents, once, before the next search.
+# So a line written costs one small insert, and a receipt typed in line by line
+# is indexed once rather than once per line.
+def _mark_search(nr):
+    # NOT EXISTS rather than OR IGNORE: inside a trigger fired by an ON UPDATE
+    # CASCADE action the OR clause is not applied (see _LOG_DATE)
+    return (f"INSERT INTO search_dirty (nr_bon) SELECT {nr} WHERE {nr} IS NOT NULL "
+            f"AND NOT EXISTS (SELECT 1 FROM search_dirty WHERE nr_bon = {nr});")
+
+
+def _mark_search_where(select):
+    """Mark every receipt the SELECT (one nr_bon column) returns."""
+    return (f"INSERT INTO search_dirty (nr_bon) SELECT DISTINCT nr FROM ({select}) "
+            f"WHERE nr IS NOT NULL AND nr NOT IN (SELECT nr_bon FROM search_dirty);")
+
+
+_SEARCH_TRIGGERS = {
+    'search_receipt_insert': ('AFTER INSERT ON receipts', _mark_search('NEW.nr_bon')),
+    'search_receipt_update': ('AFTER UPDATE OF nr_bon, store_id, ocr_text ON receipts',
+                              _mark_search('OLD.nr_bon') + _mark_search('NEW.nr_bon')),
+    'search_receipt_delete': ('AFTER DELETE ON receipts', _mark_search('OLD.nr_bon')),
+    'search_expense_insert': ('AFTER INSERT ON expenses WHEN NEW.receipt_nr IS NOT NULL',
+                              _mark_search('NEW.receipt_nr')),
+    'search_expense_delete': ('AFTER DELETE ON expenses WHEN OLD.receipt_nr IS NOT NULL',
+                              _mark_search('OLD.receipt_nr')),
+    'search_expense_update': ('AFTER UPDATE OF product_id, receipt_nr ON expenses',
+                              _mark_search('OLD.receipt_nr') + _mark_search('NEW.receipt_nr')),
+    # renames are rare; the product one reads idx_expenses_product_store_date
+    'search_product_rename': ('AFTER UPDATE OF name ON products', _mark_search_where(
+        "SELECT receipt_nr AS nr FROM expenses WHERE product_id = NEW.id")),
+    'search_store_rename': ('AFTER UPDATE OF name ON stores', _mark_search_where(
+        "SELECT nr_bon AS nr FROM receipts WHERE store_id = NEW.id")),
+}
+_ALL_TRIGGERS.update(_SEARCH_TRIGGERS)
+_BULK_EXPENSE_INSERT['search_expense_insert'] = (
+    "INSERT INTO search_dirty (nr_bon) SELECT DISTINCT receipt_nr FROM expenses "
+    "WHERE id > ? AND receipt_nr IS NOT NULL AND receipt_nr NOT IN (SELECT nr_bon FROM search_dirty)")
+
+
+def refresh_search_index(conn):
+    """Rebuild the search documents of the receipts noted in search_dirty (write
+    operation). Returns how many receipts were looked at."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM search_dirty")
+    pending = cursor.fetchone()[0]
+    if not pending:
+        return 0
+    cursor.execute("""
+        DELETE FROM receipt_search WHERE rowid IN
+            (SELECT d.id FROM search_docs d JOIN search_dirty x ON x.nr_bon = d.nr_bon)
+    """)
+    cursor.execute("DELETE FROM search_docs WHERE nr_bon IN (SELECT nr_bon FROM search_dirty)")
+    # receipts deleted since are simply not found here
+    cursor.execute("""
+        INSERT INTO search_docs (nr_bon)
+        SELECT r.nr_bon FROM search_dirty x JOIN receipts r ON r.nr_bon = x.nr_bon
+    """)
+    cursor.execute("""
+        INSERT INTO receipt_search (rowid, nr_bon, store, products, ocr_text)
+        SELECT d.id, r.nr_bon, s.name,
+               (SELECT group_concat(DISTINCT p.name) FROM expenses e JOIN products p ON p.id = e.product_id
+                WHERE e.receipt_nr = r.nr_bon),
+               r.ocr_text
+        FROM search_dirty x
+        JOIN search_docs d ON d.nr_bon = x.nr_bon
+        JOIN receipts r ON r.nr_bon = x.nr_bon
+        LEFT JOIN stores s ON s.id = r.store_id
+    """)
+    cursor.execute("DELETE FROM search_dirty")
+    return pending
+
+
+def ensure_search(conn):
+    """receipts.ocr_text, the receipt_search FTS5 index and its change log.
+    Every receipt is indexed the first time."""
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(receipts)")
+    if 'ocr_text' not in {r[1] for r in cursor.fetchall()}:
+        cursor.execute("ALTER TABLE receipts ADD COLUMN ocr_text TEXT")
+    existed = _table_exists(cursor, 'receipt_search')
+    # remove_diacritics: "paine" finds "PÂINE"; prefix indexes answer "lap*" without a scan
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS receipt_search USING fts5(
+            nr_bon, store, products, ocr_text,
+            tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+        )
+    """)
+    # receipt_search rowid -> receipt (receipts.rowid is not stable across VACUUM)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS search_docs (
+            id INTEGER PRIMARY KEY,
+            nr_bon TEXT NOT NULL UNIQUE
+        )
+    """)
+    cursor.execute("CREATE TABLE IF NOT EXISTS search_dirty (nr_bon TEXT PRIMARY KEY) WITHOUT ROWID")
+    if not existed:
+        cursor.execute("INSERT OR IGNORE INTO search_dirty (nr_bon) SELECT nr_bon FROM receipts")
+        refresh_search_index(conn)
+    _create_triggers(cursor, _SEARCH_TRIGGERS)
+
+
+def ensure_receipt_images(conn):
+    """Receipt photos kept by image_store.py: one row per distinct image (keyed by the
+    SHA-256 of the uploaded bytes) and the links from receipts to them. A photo uploaded
+    twice is one row and one file; deleting a receipt drops its links, and
+    image_store.collect_garbage() removes the images nothing links to any more."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS receipt_images (
+            hash TEXT PRIMARY KEY,
+            mime TEXT NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            original_bytes INTEGER NOT NULL,
+            width INTEGER,
+            height INTEGER,
+            created_at TEXT
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS receipt_image_links (
+            nr_bon TEXT NOT NULL REFERENCES receipts(nr_bon) ON DELETE CASCADE ON UPDATE CASCADE,
+            hash TEXT NOT NULL REFERENCES receipt_images(hash),
+            added_at TEXT,
+            PRIMARY KEY (nr_bon, hash)
+        ) WITHOUT ROWID
+    """)
+    # garbage collection and "is this image still used" look links up by hash
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_receipt_image_links_hash ON receipt_image_links(hash)")
+
+
+# --- last price per (product, store) (record_expense prefill, GET /products/suggestion) ---
+# One product_prices row per product and store: the newest line's price, unit and
+# quantity ("newest" = latest date, then highest id; undated lines count as oldest)
+# plus the line count and quantity sum for the typical quantity. An insert is one
+# upsert; deleting or editing the newest line takes the next one from
+# idx_expenses_product_store_date, so no write ever scans expenses.
+_PRICE_COLUMNS = 'last_expense_id, last_date, price_bani, quantity_milli, quantity_type, discount_bani'
+_PRICE_NEWER = ("(IFNULL(excluded.last_date, ''), excluded.last_expense_id) > "
+                "(IFNULL(last_date, ''), last_expense_id)")
+# every SET expression sees the row as it was, so each column can test the same condition
+_PRICE_UPSERT = """
+        ON CONFLICT(product_id, store_id) DO UPDATE SET
+            line_count = line_count + excluded.line_count,
+            quantity_sum_milli = quantity_sum_milli + excluded.quantity_sum_milli,
+            """ + ',\n            '.join(f"{c} = CASE WHEN {_PRICE_NEWER} THEN excluded.{c} ELSE {c} END"
+                                         for c in _PRICE_COLUMNS.split(', '))
+_PRICE_LINE = 'NEW.product_id IS NOT NULL AND NEW.store_id IS NOT NULL AND NEW.price_bani IS NOT NULL'
+_PRICE_OLD_LINE = _PRICE_LINE.replace('NEW.', 'OLD.')
+
+_PRICE_ADD = f"""
+        INSERT INTO product_prices (product_id, store_id, {_PRICE_COLUMNS}, line_count, quantity_sum_milli)
+        VALUES (NEW.product_id, NEW.store_id, NEW.id, NEW.date, NEW.price_bani, NEW.quantity_milli,
+                NEW.quantity_type, NEW.discount_bani, 1, IFNULL(NEW.quantity_milli, 0)){_PRICE_UPSERT};"""
+_PRICE_REMOVE = f"""
+        UPDATE product_prices SET
+            line_count = line_count - 1,
+            quantity_sum_milli = quantity_sum_milli - IFNULL(OLD.quantity_milli, 0)
+        WHERE product_id = OLD.product_id AND store_id = OLD.store_id;
+        DELETE FROM product_prices
+        WHERE product_id = OLD.product_id AND store_id = OLD.store_id AND line_count <= 0;
+        UPDATE product_prices SET ({_PRICE_COLUMNS}) = (
+            SELECT id, date, price_bani, quantity_milli, quantity_type, discount_bani FROM expenses
+            WHERE product_id = OLD.product_id AND store_id = OLD.store_id AND price_bani IS NOT NULL
+            ORDER BY date DESC, id DESC LIMIT 1)
+        WHERE product_id = OLD.product_id AND store_id = OLD.store_id AND last_expense_id = OLD.id;"""
+_PRICE_UPDATE_OF = 'product_id, store_id, price_bani, quantity_milli, quantity_type, discount_bani, date'
+
+_PRODUCT_PRICE_TRIGGERS = {
+    'product_prices_expense_insert': (f'AFTER INSERT ON expenses WHEN {_PRICE_LINE}', _PRICE_ADD),
+    'product_prices_expense_delete': (f'AFTER DELETE ON expenses WHEN {_PRICE_OLD_LINE}', _PRICE_REMOVE),
+    # old line out first: if it was the newest, the replacement is read after the update,
+    # so an edited line that stays newest is picked up again and the add keeps it
+    'product_prices_expense_update_old': (f'AFTER UPDATE OF {_PRICE_UPDATE_OF} ON expenses '
+                                          f'WHEN {_PRICE_OLD_LINE}', _PRICE_REMOVE),
+    'product_prices_expense_update_new': (f'AFTER UPDATE OF {_PRICE_UPDATE_OF} ON expenses '
+                                          f'WHEN {_PRICE_LINE}', _PRICE_ADD),
+}
+_ALL_TRIGGERS.update(_PRODUCT_PRICE_TRIGGERS)
+
+
+def _product_prices_from(where):
+    # a single max() per group: SQLite takes the bare columns from the row holding
+    # the maximum, i.e. the newest line (date, then id) of each (product, store)
+    return f"""
+        SELECT product_id, store_id, id, date, price_bani, quantity_milli, quantity_type, discount_bani,
+               COUNT(*), SUM(IFNULL(quantity_milli, 0))
+        FROM expenses
+        WHERE {where} AND product_id IS NOT NULL AND store_id IS NOT NULL AND price_bani IS NOT NULL
+        GROUP BY product_id, store_id
+        HAVING MAX(IFNULL(date, '') || printf('%012d', id)) IS NOT NULL"""
+
+
+_BULK_EXPENSE_INSERT['product_prices_expense_insert'] = f"""
+        INSERT INTO product_prices (product_id, store_id, {_PRICE_COLUMNS}, line_count, quantity_sum_milli)
+        {_product_prices_from('id > ?')}{_PRICE_UPSERT}"""
+
+
+def rebuild_product_prices(conn):
+    """Recompute product_prices from expenses."""
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM product_prices")
+    cursor.execute(f"INSERT INTO product_prices (product_id, store_id, {_PRICE_COLUMNS}, line_count, "
+                   f"quantity_sum_milli) {_product_prices_from('1')}")
+
+
+def ensure_product_prices(conn):
+    """The last price, unit and quantity of every product at every store, maintained by
+    triggers, for the line-item suggestions. Filled from existing data the first time."""
+    cursor = conn.cursor()
+    existed = _table_exists(cursor, 'product_prices')
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS product_prices (
+            product_id INTEGER NOT NULL,
+            store_id INTEGER NOT NULL,
+            last_expense_id INTEGER NOT NULL,
+            last_date TEXT,
+            price_bani INTEGER NOT NULL,
+            quantity_milli INTEGER,
+            quantity_type TEXT,
+            discount_bani INTEGER,
+            line_count INTEGER NOT NULL DEFAULT 0,
+            quantity_sum_milli INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (product_id, store_id)
+        ) WITHOUT ROWID
+    """)
+    # the newest remaining line after a delete or edit: one backwards seek
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_expenses_product_store_date "
+                   "ON expenses(product_id, store_id, date)")
+    if not existed:
+        rebuild_product_prices(conn)
+    _create_triggers(cursor, _PRODUCT_PRICE_TRIGGERS)
+
+
+def ensure_basket_rules(conn):
+    """The "usually bought with" rules of basket_rules.py, written by scripts/mine_basket_rules.py.
+    antecedent_2 is 0 for a one-product antecedent; both are product ids in ascending order."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS basket_rules (
+            antecedent_1 INTEGER NOT NULL,
+            antecedent_2 INTEGER NOT NULL DEFAULT 0,
+            consequent_id INTEGER NOT NULL,
+            support_count INTEGER NOT NULL,
+            confidence REAL NOT NULL,
+            lift REAL NOT NULL,
+            PRIMARY KEY (antecedent_1, antecedent_2, consequent_id)
+        ) WITHOUT ROWID
+    """)
+
+
+# a deleted product's lines lose their product (ON DELETE SET NULL) and the job skips
+# lines without one, so its statistics go with it (a later product reusing the id
+# starts from nothing, as a recheck from scratch would)
+_ANOMALY_TRIGGERS = {
+    'anomaly_stats_product_delete': ('AFTER DELETE ON products',
+                                     "DELETE FROM anomaly_stats WHERE product_id = OLD.id;"),
+}
+_ALL_TRIGGERS.update(_ANOMALY_TRIGGERS)
+
+
+def ensure_anomalies(conn):
+    """State of the incremental anomaly / recurring-purchase job (anomalies.py): the
+    rolling statistics per (product, unit), the flagged lines and the last expense id
+    checked. The existing lines are checked once, the first time."""
+    cursor = conn.cursor()
+    existed = _table_exists(cursor, 'anomaly_progress')
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS anomaly_stats (
+            product_id INTEGER NOT NULL,
+            quantity_type TEXT NOT NULL,
+            line_count INTEGER NOT NULL,
+            mean_log REAL NOT NULL,
+            var_log REAL NOT NULL,
+            last_day INTEGER,
+            interval_count INTEGER NOT NULL,
+            interval_mean REAL NOT NULL,
+            interval_var REAL NOT NULL,
+            PRIMARY KEY (product_id, quantity_type)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS expense_flags (
+            expense_id INTEGER NOT NULL REFERENCES expenses(id) ON DELETE CASCADE,
+            kind TEXT NOT NULL,
+            usual_bani INTEGER,
+            ratio REAL,
+            other_expense_id INTEGER,
+            PRIMARY KEY (expense_id, kind)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS anomaly_progress (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_expense_id INTEGER NOT NULL
+        )
+    """)
+    if not existed:
+        cursor.execute("INSERT INTO anomaly_progress (id, last_expense_id) VALUES (1, 0)")
+        anomalies.detect(conn)
+    _create_triggers(cursor, _ANOMALY_TRIGGERS)
+
+
+def ensure_all(conn):
+    ensure_integer_money(conn)
+    ensure_expense_discount_column(conn)
+    ensure_receipts_schema(conn)
+    ensure_product_categories(conn)
+    ensure_line_total(conn)
+    ensure_dates(conn)
+    ensure_report_changes(conn)
+    ensure_store_stats(conn)
+    ensure_receipt_totals(conn)
+    ensure_category_stats(conn)
+    ensure_budgets(conn)
+    ensure_receipt_images(conn)
+    ensure_search(conn)
+    ensure_product_prices(conn)
+    ensure_basket_rules(conn)
+    ensure_anomalies(conn)
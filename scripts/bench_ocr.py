@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Per-image OCR latency: the persistent engine (ocr.py, tesserocr) against the
+old one-process-per-image pytesseract path, on the sample receipts.
+
+Every image is read into memory once; each backend then gets one warm-up
+pass (for tesserocr that is where the ron+eng models are loaded, reported
+separately as "first image") and --repeat timed passes over all images.
+
+Usage:
+  python scripts/bench_ocr.py                          # bonuri/processed/*.jpg, both backends
+  python scripts/bench_ocr.py --repeat 10 --preprocess
+  python scripts/bench_ocr.py --backend tesserocr path/to/receipt.jpg ...
+
+Prints median / p95 / mean milliseconds per image for each backend, the
+words found and their mean confidence, and the pytesseract/tesserocr ratio.
+"""
+
+import argparse
+import glob
+import os
+import statistics
+import sys
+import time
+
+BASE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE)
+
+import ocr  # noqa: E402
+
+SAMPLES = os.path.join(BASE, 'bonuri', 'processed', '*.jpg')
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def run_backend(name, images, repeat):
+    started = time.perf_counter()
+    words = []
+    for _, image in images:
+        words.append(ocr.recognize(image, backend=name)['words'])
+    first = time.perf_counter() - started
+    timings = []
+    for _ in range(repeat):
+        for _, image in images:
+            timings.append(ocr.recognize(image, backend=name)['seconds'])
+    ocr.close_engines()
+    confs = [w['conf'] for page in words for w in page]
+    return {
+        'first_pass': first,
+        'median': statistics.median(timings),
+        'p95': percentile(timings, 95),
+        'mean': statistics.fmean(timings),
+        'words': sum(len(page) for page in words),
+        'conf': statistics.fmean(confs) if confs else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare OCR backends on the sample receipts')
+    parser.add_argument('images', nargs='*', help=f'Images to read (default: {SAMPLES})')
+    parser.add_argument('--backend', choices=['all', *ocr.BACKENDS], default='all')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed passes over all images (default 5)')
+    parser.add_argument('--preprocess', action='store_true', help='Run ocr.preprocess() on each image first')
+    args = parser.parse_args()
+
+    paths = args.images or sorted(glob.glob(SAMPLES))
+    if not paths:
+        print('No images found')
+        return 1
+    images = []
+    for path in paths:
+        image = ocr.load_image(path)
+        images.append((path, ocr.preprocess(image) if args.preprocess else image))
+    print(f'{len(images)} images, {args.repeat} timed passes, lang {ocr.LANG}, psm {ocr.PSM}')
+
+    names = list(ocr.BACKENDS) if args.backend == 'all' else [args.backend]
+    results = {}
+    for name in names:
+        try:
+            results[name] = r = run_backend(name, images, args.repeat)
+        except RuntimeError as e:
+            print(f'{name:>11}: skipped ({e})')
+            continue
+        print(f"{name:>11}: first pass {r['first_pass'] * 1000:.0f} ms, per image median "
+              f"{r['median'] * 1000:.1f} ms, p95 {r['p95'] * 1000:.1f} ms, mean {r['mean'] * 1000:.1f} ms; "
+              f"{r['words']} words, mean conf {r['conf']:.1f}")
+    if len(results) == 2:
+        print(f"pytesseract / tesserocr median latency: "
+              f"{results['pytesseract']['median'] / results['tesserocr']['median']:.2f}x")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Speed and accuracy benchmark of the whole receipt scan (ocr.scan_image:
+load, preprocess, OCR, receipt_parser) over the labelled sample receipts.
+
+The corpus is bonuri/labels.json: every labelled image as it is, plus
+synthetic degraded copies of it (blur, noise, low resolution, skew, heavy
+JPEG, low contrast; --variants), written to a temporary folder so that the
+load stage is measured for them too. Each --workers count runs the corpus
+--repeat times on that many worker processes, every one with its own
+persistent OCR engine (as the web workers would), after a warm-up that
+loads the models.
+
+Recorded per run:
+  - seconds per stage (load / preprocess / ocr / extract): mean, median, p95
+  - images per second at each worker count
+  - peak resident memory of the benchmark and of its worker processes
+  - field accuracy against the labels: total, date and nr_bon (share of
+    images read exactly) and line items (F1; a line counts when its amount
+    matches and the name is close enough)
+
+Results go to a JSON file (--out, default benchmarks/scan_<timestamp>.json);
+--compare OLD.json prints the differences to an earlier run, so a change to
+preprocess() or receipt_parser can be judged on the same corpus.
+
+Usage:
+  python scripts/bench_scan.py
+  python scripts/bench_scan.py --workers 1,2,4 --repeat 3 --backend tesserocr
+  python scripts/bench_scan.py --variants none --compare benchmarks/scan_20251020_101500.json
+"""
+
+import argparse
+import datetime
+import difflib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+BASE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE)
+
+import money  # noqa: E402
+import ocr  # noqa: E402
+
+LABELS = os.path.join(BASE, 'bonuri', 'labels.json')
+STAGES = ('load', 'preprocess', 'ocr', 'extract')
+FIELDS = ('total', 'date', 'nr_bon', 'lines')
+VARIANTS = ('blur', 'noise', 'lowres', 'skew', 'jpeg', 'contrast')
+NAME_SIMILARITY = 0.6
+
+
+# --- corpus ---
+def degrade(image, variant):
+    """A synthetic degraded copy of a grayscale receipt image."""
+    import cv2
+    import numpy as np
+    if variant == 'blur':
+        return cv2.GaussianBlur(image, (5, 5), 0)
+    if variant == 'noise':
+        rng = np.random.default_rng(42)
+        return np.clip(image + rng.normal(0, 25, image.shape), 0, 255).astype(np.uint8)
+    if variant == 'lowres':
+        height, width = image.shape[:2]
+        return cv2.resize(image, (width // 2, height // 2), interpolation=cv2.INTER_AREA)
+    if variant == 'skew':
+        height, width = image.shape[:2]
+        matrix = cv2.getRotationMatrix2D((width / 2, height / 2), 2.5, 1.0)
+        return cv2.warpAffine(image, matrix, (width, height), borderValue=255)
+    if variant == 'contrast':
+        return (image * 0.4 + 90).astype(np.uint8)
+    raise ValueError(f'unknown variant {variant!r}')
+
+
+def build_corpus(labels, variants, folder):
+    """[(name, path, expected)]: the labelled images, then their degraded copies in `folder`."""
+    import cv2
+    corpus = []
+    for name, expected in labels.items():
+        if name.startswith('_'):
+            continue
+        path = os.path.join(os.path.dirname(LABELS), name)
+        corpus.append((name, path, expected))
+        if not variants:
+            continue
+        image = ocr.load_image(path)
+        stem = os.path.splitext(os.path.basename(name))[0]
+        for variant in variants:
+            if variant == 'jpeg':
+                out = os.path.join(folder, f'{stem}_jpeg.jpg')
+                cv2.imwrite(out, image, [cv2.IMWRITE_JPEG_QUALITY, 15])
+            else:
+                out = os.path.join(folder, f'{stem}_{variant}.png')
+                cv2.imwrite(out, degrade(image, variant))
+            corpus.append((f'{name}#{variant}', out, expected))
+    return corpus
+
+
+# --- workers ---
+def peak_rss():
+    """Peak resident memory of this process in bytes (None when unknown)."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        try:
+            import psutil
+        except ImportError:
+            return None
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def warm_up(backend):
+    ocr.get_engine(backend)
+
+
+def scan_one(task):
+    name, path, backend, clean = task
+    result = ocr.scan_image(path, clean=clean, backend=backend)
+    return {'name': name, 'fields': result['fields'], 'timings': result['timings'],
+            'words': len(result['words']), 'pid': os.getpid(), 'peak_rss': peak_rss()}
+
+
+def run(corpus, workers, repeat, backend, clean):
+    tasks = [(name, path, backend, clean) for name, path, _ in corpus] * repeat
+    with ProcessPoolExecutor(max_workers=workers, initializer=warm_up, initargs=(backend,)) as pool:
+        # one task per worker first, so that every engine is loaded before the clock starts
+        list(pool.map(scan_one, tasks[:workers]))
+        started = time.perf_counter()
+        results = list(pool.map(scan_one, tasks))
+        elapsed = time.perf_counter() - started
+    peaks = {}
+    for r in results:
+        if r['peak_rss'] is not None:
+            peaks[r['pid']] = max(peaks.get(r['pid'], 0), r['peak_rss'])
+    return results, {
+        'workers': workers,
+        'images': len(results),
+        'seconds': elapsed,
+        'images_per_second': len(results) / elapsed if elapsed else None,
+        'peak_rss_worker': max(peaks.values()) if peaks else None,
+        'peak_rss_workers_total': sum(peaks.values()) if peaks else None,
+    }
+
+
+# --- accuracy ---
+def _line_matches(found, expected):
+    if found['total_bani'] != money.to_bani(expected['total']):
+        return False
+    ratio = difflib.SequenceMatcher(None, found['name'].casefold(), expected['name'].casefold()).ratio()
+    return ratio >= NAME_SIMILARITY
+
+
+def lines_f1(found, expected):
+    """F1 of the parsed lines against the labelled ones (each label matched once)."""
+    if not found and not expected:
+        return 1.0
+    unmatched = list(expected)
+    hits = 0
+    for line in found:
+        for i, label in enumerate(unmatched):
+            if _line_matches(line, label):
+                hits += 1
+                del unmatched[i]
+                break
+    if not hits:
+        return 0.0
+    precision, recall = hits / len(found), hits / len(expected)
+    return 2 * precision * recall / (precision + recall)
+
+
+def score(fields, expected):
+    return {
+        'total': float(fields['total_bani'] == money.to_bani(expected['total'])),
+        'date': float(fields['date'] == expected['date']),
+        'nr_bon': float(fields['nr_bon'] == expected['nr_bon']),
+        'lines': lines_f1(fields['lines'], expected['lines']),
+    }
+
+
+# --- summary ---
+def summarize(values):
+    ordered = sorted(values)
+    return {'mean': statistics.fmean(ordered), 'median': statistics.median(ordered),
+            'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(report, old):
+    print(f"compared with {old.get('created')} (commit {old.get('commit')}):")
+    for field in FIELDS:
+        a, b = old['accuracy']['overall'].get(field), report['accuracy']['overall'][field]
+        if a is not None:
+            print(f'  accuracy {field:<7} {a:.3f} -> {b:.3f} ({b - a:+.3f})')
+    for stage in STAGES:
+        a, b = old['stages'].get(stage, {}).get('mean'), report['stages'][stage]['mean']
+        if a:
+            print(f'  {stage:<10} mean {a * 1000:.1f} -> {b * 1000:.1f} ms ({(b - a) / a:+.0%})')
+    old_runs = {r['workers']: r for r in old['runs']}
+    for r in report['runs']:
+        prev = old_runs.get(r['workers'])
+        if prev and prev['images_per_second']:
+            print(f"  {r['workers']} workers: {prev['images_per_second']:.2f} -> {r['images_per_second']:.2f} "
+                  f"images/s ({r['images_per_second'] / prev['images_per_second'] - 1:+.0%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the receipt scan pipeline on the labelled samples')
+    parser.add_argument('--labels', default=LABELS, help='Labels file (default: bonuri/labels.json)')
+    parser.add_argument('--workers', default='1,2', help='Worker counts to run, comma separated (default 1,2)')
+    parser.add_argument('--repeat', type=int, default=2, help='Passes over the corpus per worker count (default 2)')
+    parser.add_argument('--backend', choices=['auto', *ocr.BACKENDS], default='auto')
+    parser.add_argument('--variants', default=','.join(VARIANTS),
+                        help=f"Degraded copies to add, comma separated, or 'none' (default {','.join(VARIANTS)})")
+    parser.add_argument('--no-preprocess', action='store_true', help='Skip ocr.preprocess()')
+    parser.add_argument('--out', help='JSON file to write (default benchmarks/scan_<timestamp>.json)')
+    parser.add_argument('--compare', help='Earlier JSON result to compare with')
+    args = parser.parse_args()
+
+    with open(args.labels, encoding='utf-8') as f:
+        labels = json.load(f)
+    variants = [] if args.variants == 'none' else [v for v in args.variants.split(',') if v]
+    for variant in variants:
+        if variant not in VARIANTS:
+            parser.error(f'unknown variant {variant!r} (choose from {", ".join(VARIANTS)})')
+    worker_counts = [int(n) for n in args.workers.split(',')]
+    backend = ocr.backend_name(args.backend)
+    created = datetime.datetime.now()
+
+    folder = tempfile.mkdtemp(prefix='bench_scan_')
+    try:
+        corpus = build_corpus(labels, variants, folder)
+        print(f'{len(corpus)} images ({len(variants)} variants), backend {backend}, '
+              f'workers {args.workers}, {args.repeat} passes')
+        runs = []
+        first = None
+        for workers in worker_counts:
+            results, summary = run(corpus, workers, args.repeat, backend, not args.no_preprocess)
+            runs.append(summary)
+            first = first or results
+            rss = summary['peak_rss_worker']
+            print(f"{workers:>3} workers: {summary['images_per_second']:.2f} images/s"
+                  + (f", peak {rss / 2**20:.0f} MiB per worker" if rss else ''))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    expected = {name: exp for name, _, exp in corpus}
+    per_image = {}
+    for r in first[:len(corpus)]:
+        per_image[r['name']] = {'scores': score(r['fields'], expected[r['name']]), 'words': r['words'],
+                                'timings': r['timings'], 'fields': r['fields']}
+    stages = {stage: summarize([r['timings'][stage] for r in first]) for stage in STAGES}
+    overall = {field: statistics.fmean(img['scores'][field] for img in per_image.values()) for field in FIELDS}
+    by_variant = {}
+    for name, img in per_image.items():
+        variant = name.split('#', 1)[1] if '#' in name else 'original'
+        by_variant.setdefault(variant, []).append(img['scores'])
+    by_variant = {v: {field: statistics.fmean(s[field] for s in scores) for field in FIELDS}
+                  for v, scores in by_variant.items()}
+
+    report = {
+        'created': created.isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count(), 'backend': backend, 'lang': ocr.LANG, 'psm': ocr.PSM,
+                        'preprocess': not args.no_preprocess},
+        'corpus': {'labels': os.path.relpath(args.labels, BASE), 'images': len(corpus), 'variants': variants},
+        'repeat': args.repeat,
+        'stages': stages,
+        'runs': runs,
+        'peak_rss_main': peak_rss(),
+        'accuracy': {'overall': overall, 'by_variant': by_variant},
+        'images': per_image,
+    }
+
+    for stage in STAGES:
+        s = stages[stage]
+        print(f"  {stage:<10} mean {s['mean'] * 1000:.1f} ms, median {s['median'] * 1000:.1f} ms, "
+              f"p95 {s['p95'] * 1000:.1f} ms")
+    print('accuracy: ' + ', '.join(f'{field} {overall[field]:.3f}' for field in FIELDS))
+
+    out = args.out or os.path.join(BASE, 'benchmarks', f"scan_{created.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print('Results written to', out)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(report, json.load(f))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Run the anomaly / recurring-purchase job (anomalies.py) over the expenses
+added since its last run, and list what it flagged.
+
+/cheltuieli and the importers already run the job before they show or after
+they add lines; this script is for cron, for a look at the flags from the
+shell, and for --reset after the thresholds in anomalies.py were changed
+(every line is checked again, in id order).
+
+Usage:
+  python scripts/detect_anomalies.py
+  python scripts/detect_anomalies.py --list
+  python scripts/detect_anomalies.py --db path/to/expenses.db --reset
+
+Exit code: 0 done, 1 no database.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+BASE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE)
+
+from db import EXPENSES_DB, bump_data_version, get_db  # noqa: E402
+import anomalies  # noqa: E402
+import schema  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Flag unusual expense lines and find recurring purchases')
+    parser.add_argument('--db', default=EXPENSES_DB, help='Database (default: expenses.db / EXPENSES_DB)')
+    parser.add_argument('--reset', action='store_true', help='Forget the state and check every line again')
+    parser.add_argument('--list', action='store_true', help='Print the flagged lines and recurring purchases')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print('No database found at', args.db)
+        return 1
+
+    conn = get_db(args.db)
+    conn.isolation_level = None
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        schema.ensure_all(conn)
+        if args.reset:
+            anomalies.reset(conn)
+        started = time.perf_counter()
+        checked, flagged = anomalies.detect(conn)
+        conn.execute('COMMIT')
+        print(f"{checked} new lines checked in {time.perf_counter() - started:.2f}s, {flagged} flagged")
+        if checked:
+            bump_data_version(args.db)
+        if args.list:
+            cursor = conn.cursor()
+            for expense_id, flags in anomalies.flags(cursor).items():
+                for f in flags:
+                    if f['kind'] == 'price':
+                        print(f"  line {expense_id}: price x{f['ratio']} the usual {f['usual']:.2f} lei/unit")
+                    else:
+                        print(f"  line {expense_id}: duplicate of line {f['other_expense_id']}")
+            for p in anomalies.recurring(cursor):
+                print(f"  recurring: {p['name']} every ~{p['interval_days']:.0f} days, "
+                      f"last {p['last_date']}, next {p['next_date']}")
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
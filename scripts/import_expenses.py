@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Bulk import of historical expenses (CSV, JSON array or JSON Lines) into expenses.db.
+
+See importer.py for the accepted columns/keys. Missing stores, products and
+categories are created; each chunk of lines is committed as one transaction,
+so an interrupted import keeps the chunks already committed.
+
+Usage:
+  python scripts/import_expenses.py istoric.csv --dry-run     # validate only, nothing written
+  python scripts/import_expenses.py istoric.csv
+  python scripts/import_expenses.py bonuri.jsonl --db path/to/expenses.db --chunk-size 20000
+  python scripts/import_expenses.py export.txt --format json --json   # summary as JSON
+
+Run with --dry-run first: invalid lines are skipped (and listed), not fatal.
+The app may keep running; it sees the new data on the next request.
+"""
+
+import argparse
+import functools
+import io
+import json
+import os
+import sys
+
+BASE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE)
+
+from db import EXPENSES_DB, bump_data_version, get_db  # noqa: E402
+from importer import CHUNK_LINES, ImportFormatError, Importer, detect_format, import_stream  # noqa: E402
+import anomalies  # noqa: E402
+import schema  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk import expenses from CSV/JSON')
+    parser.add_argument('path', help='CSV, JSON or JSON Lines file ("-" for stdin)')
+    parser.add_argument('--db', default=EXPENSES_DB, help='Target database (default: expenses.db / EXPENSES_DB)')
+    parser.add_argument('--format', choices=('auto', 'csv', 'json'), default='auto')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_LINES, help='Lines per transaction')
+    parser.add_argument('--dry-run', action='store_true', help='Validate and count, write nothing')
+    parser.add_argument('--json', action='store_true', help='Print the summary as JSON')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print('No database found at', args.db)
+        return 1
+    fmt = args.format if args.format != 'auto' else detect_format(args.path)
+
+    conn = get_db(args.db)
+    # explicit BEGIN/COMMIT per chunk
+    conn.isolation_level = None
+    if not args.dry_run:
+        conn.execute('BEGIN IMMEDIATE')
+        schema.ensure_all(conn)
+        conn.execute('COMMIT')
+    importer = Importer(conn)
+
+    def write_chunk(lines):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            counts = importer.import_chunk(conn, lines)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        if not args.json:
+            print(f"  committed {counts['lines']} lines")
+        return counts
+
+    def write_indexes(op):
+        conn.execute('BEGIN IMMEDIATE')
+        op(conn)
+        conn.execute('COMMIT')
+
+    if args.path == '-':
+        f = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8-sig')
+    else:
+        f = open(args.path, encoding='utf-8-sig', newline='')
+    try:
+        if args.dry_run:
+            summary = import_stream(f, fmt, importer, None, args.chunk_size)
+        else:
+            # the report indexes are built once after the last chunk, not updated by every chunk
+            write_indexes(schema.drop_import_indexes)
+            summary = import_stream(f, fmt, importer, write_chunk, args.chunk_size,
+                                    finish=functools.partial(write_indexes, schema.create_import_indexes))
+        if not args.dry_run:
+            # index the new receipts for /search now rather than on the first search
+            conn.execute('BEGIN IMMEDIATE')
+            schema.refresh_search_index(conn)
+            anomalies.detect(conn)
+            conn.execute('COMMIT')
+    except ImportFormatError as e:
+        print('ERROR:', e)
+        return 2
+    finally:
+        f.close()
+        conn.close()
+        if not args.dry_run:
+            bump_data_version(args.db)
+
+    if args.json:
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+    else:
+        label = 'DRY RUN - would import' if summary['dry_run'] else 'Imported'
+        print(f"{label} {summary['lines']} lines in {summary['seconds']}s ({summary['lines_per_second']} lines/s)")
+        print(f"  new receipts: {summary['receipts']}, stores: {summary['stores']}, "
+              f"products: {summary['products']}, categories: {summary['categories']}")
+        print(f"  skipped (invalid): {summary['errors']}")
+        for sample in summary['error_samples']:
+            print('   -', sample)
+    return 0 if not summary['errors'] else 3
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
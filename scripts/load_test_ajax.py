@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Load test for the AJAX endpoints used by record_expense.html, comparing the
+synchronous Flask handlers (serve.py, gunicorn/waitress) with the async
+variants (serve.py --async, app_async.py).
+
+Each server is started on a scratch copy of the database. Every client thread
+keeps one HTTP connection open and repeats a typing-like sequence:
+4 x GET /products/search, POST /add_line_item, POST /update_expense,
+POST /delete_expense (the line it just added), so the database ends up where
+it started apart from the receipt created for the run.
+
+Usage:
+  python scripts/load_test_ajax.py                       # both modes, repo expenses.db
+  python scripts/load_test_ajax.py --db path/to/copy.db --clients 64 --duration 15
+  python scripts/load_test_ajax.py --mode async --workers 2 --db-threads 16
+
+Prints requests/second and latency percentiles per mode and the async/sync ratio.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+BASE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVE = os.path.join(BASE, 'serve.py')
+FORM_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+
+def wait_for_port(port, timeout=20.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def start_server(mode, db_path, port, args):
+    cmd = [sys.executable, SERVE, '--host', '127.0.0.1', '--port', str(port),
+           '--workers', str(args.workers), '--threads', str(args.threads)]
+    if mode == 'async':
+        cmd += ['--async', '--db-threads', str(args.db_threads)]
+    env = dict(os.environ, EXPENSES_DB=db_path)
+    proc = subprocess.Popen(cmd, cwd=BASE, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if not wait_for_port(port):
+        proc.terminate()
+        raise RuntimeError(f'{mode} server did not start on port {port}')
+    return proc
+
+
+def request(conn, method, path, form=None):
+    body = urlencode(form) if form is not None else None
+    start = time.perf_counter()
+    conn.request(method, path, body=body, headers=FORM_HEADERS if form is not None else {})
+    resp = conn.getresponse()
+    data = resp.read()
+    return resp.status, data, time.perf_counter() - start
+
+
+def client_loop(port, receipt_nr, product_ids, prefixes, stop_at, results, lock):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    latencies = []
+    errors = 0
+    rnd = random.Random()
+    while time.time() < stop_at:
+        try:
+            for _ in range(4):
+                status, _, dt = request(conn, 'GET', '/products/search?q=' + rnd.choice(prefixes))
+                latencies.append(dt)
+                errors += status != 200
+            status, data, dt = request(conn, 'POST', '/add_line_item', {
+                'receipt_id': receipt_nr, 'product_id': rnd.choice(product_ids),
+                'price': f'{rnd.uniform(1, 40):.2f}', 'quantity': '1', 'quantity_type': 'buc', 'discount': '0'})
+            latencies.append(dt)
+            if status != 200:
+                errors += 1
+                continue
+            expense_id = json.loads(data)['expense_id']
+            status, _, dt = request(conn, 'POST', '/update_expense', {'expense_id': expense_id, 'quantity': '2'})
+            latencies.append(dt)
+            errors += status != 200
+            status, _, dt = request(conn, 'POST', '/delete_expense', {'expense_id': expense_id})
+            latencies.append(dt)
+            errors += status != 200
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    conn.close()
+    with lock:
+        results['latencies'].extend(latencies)
+        results['errors'] += errors
+
+
+def run_mode(mode, src_db, args):
+    tmpdir = tempfile.mkdtemp(prefix=f'loadtest_{mode}_')
+    db_path = os.path.join(tmpdir, 'expenses.db')
+    shutil.copy2(src_db, db_path)
+    proc = start_server(mode, db_path, args.port, args)
+    try:
+        conn = http.client.HTTPConnection('127.0.0.1', args.port, timeout=30)
+        _, data, _ = request(conn, 'GET', '/products/search?q=')
+        product_ids = [p['id'] for p in json.loads(data)] or [1]
+        prefixes = sorted({p['name'][:2] for p in json.loads(data)}) or ['a']
+        _, data, _ = request(conn, 'POST', '/create_receipt', {
+            'store_id': args.store_id, 'nr_bon': f'LOADTEST-{mode}-{int(time.time())}', 'date': time.strftime('%Y-%m-%d')})
+        receipt_nr = json.loads(data)['receipt_id']
+        conn.close()
+
+        results = {'latencies': [], 'errors': 0}
+        lock = threading.Lock()
+        stop_at = time.time() + args.duration
+        threads = [threading.Thread(target=client_loop,
+                                    args=(args.port, receipt_nr, product_ids, prefixes, stop_at, results, lock))
+                   for _ in range(args.clients)]
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    lat = sorted(results['latencies'])
+    n = len(lat)
+    pct = (lambda q: lat[min(n - 1, int(q * n))] * 1000) if n else (lambda q: 0.0)
+    summary = {'mode': mode, 'requests': n, 'errors': results['errors'], 'rps': n / elapsed if elapsed else 0.0,
+               'p50_ms': pct(0.50), 'p95_ms': pct(0.95), 'p99_ms': pct(0.99)}
+    print(f"{mode:>5}: {summary['requests']} requests in {elapsed:.1f}s -> {summary['rps']:.0f} req/s, "
+          f"p50 {summary['p50_ms']:.1f}ms, p95 {summary['p95_ms']:.1f}ms, p99 {summary['p99_ms']:.1f}ms, "
+          f"errors {summary['errors']}")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare sync vs async AJAX endpoint throughput')
+    parser.add_argument('--db', default=os.path.join(BASE, 'expenses.db'), help='Database to copy for the run')
+    parser.add_argument('--mode', choices=('both', 'sync', 'async'), default='both')
+    parser.add_argument('--clients', type=int, default=32, help='Concurrent client connections')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds per mode')
+    parser.add_argument('--workers', type=int, default=1, help='Server worker processes (same for both modes)')
+    parser.add_argument('--threads', type=int, default=4, help='Threads per worker for the sync server')
+    parser.add_argument('--db-threads', type=int, default=8, help='Executor threads for the async server')
+    parser.add_argument('--store-id', type=int, default=1, help='Store used for the load-test receipt')
+    parser.add_argument('--port', type=int, default=5099)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print('No database found at', args.db)
+        return 1
+
+    modes = ('sync', 'async') if args.mode == 'both' else (args.mode,)
+    summaries = {mode: run_mode(mode, args.db, args) for mode in modes}
+    if len(summaries) == 2 and summaries['sync']['rps']:
+        print(f"async / sync throughput: {summaries['async']['rps'] / summaries['sync']['rps']:.2f}x")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+Migration 0006: Declared foreign keys with ON DELETE CASCADE
+
+Changes:
+1. stores / products: make `id` an INTEGER PRIMARY KEY again where an earlier
+   CREATE TABLE ... AS SELECT rebuild (migration 0005) dropped it; a foreign
+   key needs a primary key (or unique) parent column
+2. receipts.store_id   REFERENCES stores(id)       ON DELETE CASCADE
+3. expenses.store_id   REFERENCES stores(id)       ON DELETE CASCADE
+   expenses.receipt_nr REFERENCES receipts(nr_bon) ON DELETE CASCADE ON UPDATE CASCADE
+   expenses.product_id REFERENCES products(id)     ON DELETE SET NULL
+4. Orphans left by the old delete_store are cleaned first:
+   - receipts of deleted stores are deleted together with their lines
+   - lines of deleted stores are deleted
+   - lines pointing at a missing receipt keep their data, receipt_nr -> NULL
+   - lines pointing at a missing product keep their data, product_id -> NULL
+
+SQLite cannot add constraints to an existing table, so each table is rebuilt
+(new table, copy, drop, rename) with its other columns, UNIQUE constraints,
+indexes and triggers preserved. Everything runs in one transaction; the
+result is checked with PRAGMA foreign_key_check before COMMIT. The
+per-store summary (store_stats) is recomputed afterwards.
+
+The app enables PRAGMA foreign_keys on every connection (db.get_db), so after
+this migration deleting a store or a receipt cascades in the database itself,
+and deleting a product keeps its lines with product_id NULL.
+
+Features:
+- --dry-run: show what will be changed without applying
+- --force: override running app guard
+- Creates a dated backup before applying changes
+"""
+
+import argparse
+import os
+import sqlite3
+import subprocess
+import sys
+
+BASE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE)
+
+from db import EXPENSES_DB, bump_data_version  # noqa: E402
+import schema  # noqa: E402
+
+BACKUP_PREFIX = "pre_mig0006"
+
+# table -> foreign key clauses (only added for columns the table has)
+FOREIGN_KEYS = {
+    'receipts': [('store_id', 'REFERENCES stores(id) ON DELETE CASCADE')],
+    'expenses': [
+        ('product_id', 'REFERENCES products(id) ON DELETE SET NULL'),
+        ('store_id', 'REFERENCES stores(id) ON DELETE CASCADE'),
+        ('receipt_nr', 'REFERENCES receipts(nr_bon) ON DELETE CASCADE ON UPDATE CASCADE'),
+    ],
+}
+
+ORPHAN_CHECKS = [
+    ("receipts of deleted stores (deleted, with their lines)",
+     "SELECT COUNT(*) FROM receipts WHERE store_id IS NOT NULL AND store_id NOT IN (SELECT id FROM stores)"),
+    ("lines of deleted stores (deleted)",
+     "SELECT COUNT(*) FROM expenses WHERE store_id IS NOT NULL AND store_id NOT IN (SELECT id FROM stores)"),
+    ("lines with a missing receipt (receipt_nr -> NULL)",
+     "SELECT COUNT(*) FROM expenses WHERE receipt_nr IS NOT NULL AND receipt_nr NOT IN (SELECT nr_bon FROM receipts)"),
+    ("lines with a missing product (product_id -> NULL)",
+     "SELECT COUNT(*) FROM expenses WHERE product_id IS NOT NULL AND product_id NOT IN (SELECT id FROM products)"),
+]
+
+
+def check_running_app(force=False):
+    """Check if the web app is running. Return True if running (and not forced)."""
+    if force:
+        return False
+
+    try:
+        import psutil
+        for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
+            try:
+                cmdline = proc.info['cmdline']
+                if cmdline and any('flask' in str(arg).lower() or 'app_web' in str(arg) or 'serve.py' in str(arg)
+                                   for arg in cmdline):
+                    print(f"[WARN] Web app appears to be running (PID {proc.info['pid']})")
+                    return True
+            except (psutil.NoSuchProcess, psutil.AccessDenied, TypeError):
+                pass
+    except ImportError:
+        pass
+
+    # Fallback: try connecting to port 5000
+    import socket
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(1)
+        result = s.connect_ex(('127.0.0.1', 5000))
+        s.close()
+        if result == 0:
+            print("[WARN] Port 5000 appears to be open (web app may be running)")
+            return True
+    except Exception:
+        pass
+
+    return False
+
+
+def backup_before_migration(db_path):
+    """Create a dated backup before applying migration using backup_db.py."""
+    script_path = os.path.join(os.path.dirname(__file__), "backup_db.py")
+    result = subprocess.run([sys.executable, script_path, "--db", db_path, "--prefix", BACKUP_PREFIX],
+                            capture_output=True, text=True, timeout=300)
+    if result.returncode != 0:
+        print(f"[ERROR] Backup failed: {result.stdout}{result.stderr}")
+        sys.exit(1)
+    print(f"[OK] {result.stdout.strip()}")
+
+
+def id_is_primary_key(cursor, table):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return any(col[1] == 'id' and col[5] == 1 for col in cursor.fetchall())
+
+
+def _on_delete(clause):
+    for action in ('CASCADE', 'SET NULL'):
+        if f'ON DELETE {action}' in clause:
+            return action
+    return 'NO ACTION'
+
+
+def has_foreign_keys(cursor, table):
+    """True when every wanted foreign key is declared with its ON DELETE action
+    (a key declared by an earlier run without the action is rebuilt)."""
+    cursor.execute(f"PRAGMA foreign_key_list({table})")
+    declared = {(row[3], row[6]) for row in cursor.fetchall()}
+    cursor.execute(f"PRAGMA table_info({table})")
+    present = {col[1] for col in cursor.fetchall()}
+    wanted = {(col, _on_delete(clause)) for col, clause in FOREIGN_KEYS.get(table, []) if col in present}
+    return wanted <= declared
+
+
+def rebuild_table(cursor, table, foreign_keys):
+    """Recreate `table` with an INTEGER PRIMARY KEY id (if it has an id column) and the
+    given foreign keys, keeping its other columns, UNIQUE constraints, indexes and triggers."""
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    original_sql = cursor.fetchone()[0] or ''
+    cursor.execute(f"PRAGMA table_info({table})")
+    columns = cursor.fetchall()  # cid, name, type, notnull, dflt_value, pk
+    names = [c[1] for c in columns]
+    pk_columns = [c[1] for c in sorted(columns, key=lambda c: c[5]) if c[5]]
+
+    defs = []
+    for _, name, col_type, notnull, default, pk in columns:
+        if name == 'id' and (not pk_columns or pk_columns == ['id']):
+            autoinc = ' AUTOINCREMENT' if 'AUTOINCREMENT' in original_sql.upper() or not pk_columns else ''
+            defs.append(f"id INTEGER PRIMARY KEY{autoinc}")
+            continue
+        col = f"{name} {col_type or ''}".strip()
+        if pk_columns == [name]:
+            col += " PRIMARY KEY"
+        if notnull:
+            col += " NOT NULL"
+        if default is not None:
+            col += f" DEFAULT {default}"
+        defs.append(col)
+    # table_info leaves out generated columns (expenses after migration 0007):
+    # they are declared again, not copied
+    cursor.execute(f"PRAGMA table_xinfo({table})")
+    defs.extend(schema.MONEY_COLUMNS[c[1]][1] for c in cursor.fetchall() if c[6] in (2, 3))
+    if len(pk_columns) > 1:
+        defs.append(f"PRIMARY KEY ({', '.join(pk_columns)})")
+
+    cursor.execute(f"PRAGMA index_list({table})")
+    for _, index_name, unique, origin, _ in cursor.fetchall():
+        if origin == 'u':
+            cursor.execute(f"PRAGMA index_info({index_name})")
+            defs.append(f"UNIQUE ({', '.join(r[2] for r in cursor.fetchall())})")
+    for column, clause in foreign_keys:
+        if column in names:
+            defs.append(f"FOREIGN KEY ({column}) {clause}")
+
+    # indexes and triggers go away with the old table: re-create them afterwards
+    cursor.execute("SELECT sql FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') "
+                   "AND sql IS NOT NULL ORDER BY type", (table,))
+    dependents = [r[0] for r in cursor.fetchall()]
+
+    column_list = ', '.join(names)
+    cursor.execute(f"CREATE TABLE {table}_mig0006 (\n    " + ',\n    '.join(defs) + "\n)")
+    cursor.execute(f"INSERT INTO {table}_mig0006 ({column_list}) SELECT {column_list} FROM {table}")
+    cursor.execute(f"DROP TABLE {table}")
+    cursor.execute(f"ALTER TABLE {table}_mig0006 RENAME TO {table}")
+    for sql in dependents:
+        cursor.execute(sql)
+
+
+def migrate_database(db_path, dry_run=False):
+    """Apply migration changes (rolled back at the end with --dry-run)."""
+    if not os.path.exists(db_path):
+        print(f"[ERROR] Database not found: {db_path}")
+        sys.exit(1)
+
+    conn = sqlite3.connect(db_path, timeout=30.0)
+    conn.isolation_level = None
+    conn.execute("PRAGMA busy_timeout=30000")
+    # must be set outside the transaction; the rebuild drops and renames parent tables
+    conn.execute("PRAGMA foreign_keys=OFF")
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+
+        print("\n[1] Orphaned rows")
+        for label, sql in ORPHAN_CHECKS:
+            cursor.execute(sql)
+            print(f"    {label}: {cursor.fetchone()[0]}")
+        cursor.execute("""
+            DELETE FROM expenses WHERE receipt_nr IN (
+                SELECT nr_bon FROM receipts
+                WHERE store_id IS NOT NULL AND store_id NOT IN (SELECT id FROM stores))
+        """)
+        cursor.execute("DELETE FROM receipts WHERE store_id IS NOT NULL AND store_id NOT IN (SELECT id FROM stores)")
+        cursor.execute("DELETE FROM expenses WHERE store_id IS NOT NULL AND store_id NOT IN (SELECT id FROM stores)")
+        cursor.execute("UPDATE expenses SET receipt_nr = NULL "
+                       "WHERE receipt_nr IS NOT NULL AND receipt_nr NOT IN (SELECT nr_bon FROM receipts)")
+        cursor.execute("UPDATE expenses SET product_id = NULL "
+                       "WHERE product_id IS NOT NULL AND product_id NOT IN (SELECT id FROM products)")
+
+        print("\n[2] Primary keys of parent tables")
+        for table in ('stores', 'products'):
+            if id_is_primary_key(cursor, table):
+                print(f"    {table}.id is already the primary key")
+                continue
+            cursor.execute(f"SELECT COUNT(*) - COUNT(DISTINCT id) FROM {table} WHERE id IS NOT NULL")
+            duplicates = cursor.fetchone()[0]
+            if duplicates:
+                raise RuntimeError(f"{table} has {duplicates} duplicate ids; fix them before migrating")
+            rebuild_table(cursor, table, [])
+            print(f"    rebuilt {table} with id INTEGER PRIMARY KEY")
+
+        print("\n[3] Foreign keys")
+        for table in ('receipts', 'expenses'):
+            if has_foreign_keys(cursor, table) and (table != 'expenses' or id_is_primary_key(cursor, table)):
+                print(f"    {table} already declares its foreign keys")
+                continue
+            rebuild_table(cursor, table, FOREIGN_KEYS[table])
+            cursor.execute(f"PRAGMA foreign_key_list({table})")
+            for row in cursor.fetchall():
+                print(f"    {table}.{row[3]} -> {row[2]}({row[4]}) ON DELETE {row[6]}")
+
+        print("\n[4] Indexes and maintained tables")
+        if schema.has_integer_money(conn) and schema.has_day_columns(conn):
+            schema.ensure_all(conn)
+            schema.rebuild_store_stats(conn)
+            print("    indexes/triggers ensured, store_stats recomputed")
+        elif not schema.has_integer_money(conn):
+            # the summary tables are kept in integer bani: migration 0007 re-creates them
+            print("    expenses still stores REAL prices: run migration 0007 next")
+        else:
+            print("    dates not normalized yet: run migration 0008 next")
+
+        cursor.execute("PRAGMA foreign_key_check")
+        violations = cursor.fetchall()
+        if violations:
+            raise RuntimeError(f"foreign key check failed: {violations[:10]}")
+
+        if dry_run:
+            print("\n[DRY-RUN] Rolling back changes...")
+            cursor.execute("ROLLBACK")
+            print("[OK] Dry-run complete. No changes applied.")
+        else:
+            cursor.execute("COMMIT")
+            bump_data_version(db_path)
+            print("\n[OK] Migration 0006 applied successfully")
+    except (sqlite3.Error, RuntimeError) as e:
+        print(f"[ERROR] {e}")
+        if conn.in_transaction:
+            cursor.execute("ROLLBACK")
+        conn.close()
+        sys.exit(1)
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Migration 0006: Declared foreign keys with ON DELETE CASCADE"
+    )
+    parser.add_argument("--db", default=EXPENSES_DB, help="Database to migrate (default: expenses.db)")
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Show what will be changed without applying"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Override running app guard"
+    )
+
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("Migration 0006: Foreign Keys with ON DELETE CASCADE")
+    print("=" * 60)
+
+    # Check for running app
+    if check_running_app(force=args.force):
+        print("\n[WARN] Web app is running. It's recommended to stop it before migrating.")
+        if not args.force:
+            print("       Use --force to override this check.")
+            sys.exit(1)
+
+    if not args.dry_run:
+        print("\n[BACKUP] Creating backup before migration...")
+        backup_before_migration(args.db)
+
+    migrate_database(args.db, dry_run=args.dry_run)
+
+    print("\n" + "=" * 60)
+    if args.dry_run:
+        print("Dry-run complete. Review changes and run again without --dry-run")
+    else:
+        print("Migration complete.")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
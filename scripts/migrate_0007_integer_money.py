@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Migration 0007: Integer money (bani) and quantities (milli-units)
+
+Changes:
+1. expenses.price    REAL -> price_bani     INTEGER (1 leu = 100 bani)
+   expenses.quantity REAL -> quantity_milli INTEGER (1 buc/kg/l = 1000)
+   expenses.discount REAL -> discount_bani  INTEGER NOT NULL DEFAULT 0
+2. price / quantity / discount stay as VIRTUAL generated columns
+   (price_bani / 100.0, ...), so reading queries and older scripts keep
+   working; writing them is an error from now on
+3. store_stats / store_product_stats are re-created with integer
+   spend_bani / quantity_milli and recomputed
+
+Stored REAL values are converted once with money.to_bani / to_milli from
+their shortest decimal form (1.005 is 101 bani, as if typed in the form),
+rounding half away from zero to the ban / to the thousandth. The report shows how many rows had more precision than that
+and compares the grand total before and after.
+
+SQLite cannot change a column's type in place, so expenses is rebuilt (new
+table, copy, drop, rename) keeping its other columns, foreign keys and
+indexes; the maintained-table triggers are re-created by schema.ensure_all.
+Everything runs in one transaction. Run migration 0006 first.
+
+Features:
+- --dry-run: show what will be changed without applying
+- --force: override running app guard
+- Creates a dated backup before applying changes
+"""
+
+import argparse
+import os
+import sqlite3
+import subprocess
+import sys
+
+BASE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE)
+
+from db import EXPENSES_DB, bump_data_version  # noqa: E402
+import money  # noqa: E402
+import schema  # noqa: E402
+
+BACKUP_PREFIX = "pre_mig0007"
+
+# legacy REAL column -> SQL converting its value (functions registered in migrate_database)
+CONVERT = {
+    'price': "to_bani(price)",
+    'quantity': "to_milli(quantity)",
+    'discount': "IFNULL(to_bani(discount), 0)",
+}
+
+PRECISION_CHECKS = [
+    ("price", "prices with fractions of a ban",
+     "SELECT COUNT(*) FROM expenses WHERE ABS(price * 100 - ROUND(price * 100)) > 1e-6"),
+    ("quantity", "quantities with more than 3 decimals",
+     "SELECT COUNT(*) FROM expenses WHERE ABS(quantity * 1000 - ROUND(quantity * 1000)) > 1e-6"),
+    ("discount", "discounts with fractions of a ban",
+     "SELECT COUNT(*) FROM expenses WHERE ABS(discount * 100 - ROUND(discount * 100)) > 1e-6"),
+]
+
+
+def check_running_app(force=False):
+    """Check if the web app is running. Return True if running (and not forced)."""
+    if force:
+        return False
+
+    try:
+        import psutil
+        for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
+            try:
+                cmdline = proc.info['cmdline']
+                if cmdline and any('flask' in str(arg).lower() or 'app_web' in str(arg) or 'serve.py' in str(arg)
+                                   for arg in cmdline):
+                    print(f"[WARN] Web app appears to be running (PID {proc.info['pid']})")
+                    return True
+            except (psutil.NoSuchProcess, psutil.AccessDenied, TypeError):
+                pass
+    except ImportError:
+        pass
+
+    # Fallback: try connecting to port 5000
+    import socket
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(1)
+        result = s.connect_ex(('127.0.0.1', 5000))
+        s.close()
+        if result == 0:
+            print("[WARN] Port 5000 appears to be open (web app may be running)")
+            return True
+    except Exception:
+        pass
+
+    return False
+
+
+def backup_before_migration(db_path):
+    """Create a dated backup before applying migration using backup_db.py."""
+    script_path = os.path.join(os.path.dirname(__file__), "backup_db.py")
+    result = subprocess.run([sys.executable, script_path, "--db", db_path, "--prefix", BACKUP_PREFIX],
+                            capture_output=True, text=True, timeout=300)
+    if result.returncode != 0:
+        print(f"[ERROR] Backup failed: {result.stdout}{result.stderr}")
+        sys.exit(1)
+    print(f"[OK] {result.stdout.strip()}")
+
+
+def rebuild_expenses(cursor):
+    """Recreate expenses with the integer money columns, converting the stored REAL values."""
+    cursor.execute("PRAGMA table_info(expenses)")
+    columns = cursor.fetchall()  # cid, name, type, notnull, dflt_value, pk
+    names = [c[1] for c in columns]
+    for required in ('price', 'quantity'):
+        if required not in names:
+            raise RuntimeError(f"expenses has no {required} column")
+
+    defs, targets, sources = [], [], []
+    for _, name, col_type, notnull, default, pk in columns:
+        if name in schema.MONEY_COLUMNS:
+            integer_column, _ = schema.MONEY_COLUMNS[name]
+            defs.append(f"{integer_column} INTEGER NOT NULL DEFAULT 0" if name == 'discount'
+                        else f"{integer_column} INTEGER")
+            targets.append(integer_column)
+            sources.append(CONVERT[name])
+            continue
+        if name == 'id':
+            defs.append("id INTEGER PRIMARY KEY AUTOINCREMENT")
+        else:
+            col = f"{name} {col_type or ''}".strip()
+            if notnull:
+                col += " NOT NULL"
+            if default is not None:
+                col += f" DEFAULT {default}"
+            defs.append(col)
+        targets.append(name)
+        sources.append(name)
+    if 'discount' not in names:
+        defs.append("discount_bani INTEGER NOT NULL DEFAULT 0")
+    # column definitions before table constraints
+    defs.extend(generated for _, generated in schema.MONEY_COLUMNS.values())
+
+    cursor.execute("PRAGMA foreign_key_list(expenses)")
+    for _, _, parent, column, parent_column, on_update, on_delete, _ in cursor.fetchall():
+        clause = f"FOREIGN KEY ({column}) REFERENCES {parent}({parent_column})"
+        if on_delete != 'NO ACTION':
+            clause += f" ON DELETE {on_delete}"
+        if on_update != 'NO ACTION':
+            clause += f" ON UPDATE {on_update}"
+        defs.append(clause)
+
+    # indexes go away with the old table; the schema.py triggers are re-created by
+    # ensure_all with the integer columns, any other trigger is kept as it was
+    cursor.execute("SELECT name, type, sql FROM sqlite_master WHERE tbl_name = 'expenses' "
+                   "AND type IN ('index', 'trigger') AND sql IS NOT NULL ORDER BY type")
+    dependents = [sql for name, kind, sql in cursor.fetchall()
+                  if kind == 'index' or name not in schema._ALL_TRIGGERS]
+
+    cursor.execute("CREATE TABLE expenses_mig0007 (\n    " + ',\n    '.join(defs) + "\n)")
+    cursor.execute(f"INSERT INTO expenses_mig0007 ({', '.join(targets)}) SELECT {', '.join(sources)} FROM expenses")
+    cursor.execute("DROP TABLE expenses")
+    cursor.execute("ALTER TABLE expenses_mig0007 RENAME TO expenses")
+    for sql in dependents:
+        cursor.execute(sql)
+
+
+def migrate_database(db_path, dry_run=False):
+    """Apply migration changes (rolled back at the end with --dry-run)."""
+    if not os.path.exists(db_path):
+        print(f"[ERROR] Database not found: {db_path}")
+        sys.exit(1)
+
+    conn = sqlite3.connect(db_path, timeout=30.0)
+    conn.isolation_level = None
+    conn.execute("PRAGMA busy_timeout=30000")
+    conn.execute("PRAGMA foreign_keys=OFF")
+    conn.create_function("to_bani", 1, lambda v: None if v is None else money.to_bani(v), deterministic=True)
+    conn.create_function("to_milli", 1, lambda v: None if v is None else money.to_milli(v), deterministic=True)
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+
+        if schema.has_integer_money(conn):
+            print("\n[1] expenses already stores integer bani / milli-units")
+        else:
+            print("\n[1] Values that will be rounded")
+            cursor.execute("PRAGMA table_info(expenses)")
+            present = {r[1] for r in cursor.fetchall()}
+            if 'discount' not in present:
+                schema.ensure_expense_discount_column(conn)
+            for column, label, sql in PRECISION_CHECKS:
+                if column not in present and column != 'discount':
+                    continue
+                cursor.execute(sql)
+                print(f"    {label}: {cursor.fetchone()[0]}")
+            cursor.execute("SELECT COUNT(*), TOTAL(price * quantity - IFNULL(discount, 0)) FROM expenses")
+            rows, total_before = cursor.fetchone()
+
+            print("\n[2] Rebuilding expenses")
+            rebuild_expenses(cursor)
+            cursor.execute(f"SELECT COUNT(*), IFNULL(SUM({money.line_total_sql()}), 0) FROM expenses")
+            rows_after, total_after = cursor.fetchone()
+            if rows_after != rows:
+                raise RuntimeError(f"row count changed: {rows} -> {rows_after}")
+            print(f"    {rows} rows converted")
+            print(f"    total before (REAL):  {total_before:.6f} lei")
+            print(f"    total after (bani):   {money.lei(total_after):.2f} lei ({total_after} bani)")
+
+            # derived tables, re-created with integer columns by ensure_all
+            cursor.execute("DROP TABLE IF EXISTS store_stats")
+            cursor.execute("DROP TABLE IF EXISTS store_product_stats")
+
+        print("\n[3] Indexes and maintained tables")
+        if schema.has_day_columns(conn):
+            schema.ensure_all(conn)
+            print("    indexes/triggers ensured, store_stats recomputed")
+        else:
+            # ensure_all needs the day columns; migration 0008 re-creates the maintained tables
+            print("    dates not normalized yet: run migration 0008 next")
+
+        cursor.execute("PRAGMA foreign_key_check")
+        violations = cursor.fetchall()
+        if violations:
+            raise RuntimeError(f"foreign key check failed: {violations[:10]}")
+
+        if dry_run:
+            print("\n[DRY-RUN] Rolling back changes...")
+            cursor.execute("ROLLBACK")
+            print("[OK] Dry-run complete. No changes applied.")
+        else:
+            cursor.execute("COMMIT")
+            bump_data_version(db_path)
+            print("\n[OK] Migration 0007 applied successfully")
+    except (sqlite3.Error, RuntimeError) as e:
+        print(f"[ERROR] {e}")
+        if conn.in_transaction:
+            cursor.execute("ROLLBACK")
+        conn.close()
+        sys.exit(1)
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Migration 0007: Integer money (bani) and quantities (milli-units)"
+    )
+    parser.add_argument("--db", default=EXPENSES_DB, help="Database to migrate (default: expenses.db)")
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Show what will be changed without applying"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Override running app guard"
+    )
+
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("Migration 0007: Integer Money (bani) and Quantities")
+    print("=" * 60)
+
+    # Check for running app
+    if check_running_app(force=args.force):
+        print("\n[WARN] Web app is running. It's recommended to stop it before migrating.")
+        if not args.force:
+            print("       Use --force to override this check.")
+            sys.exit(1)
+
+    if not args.dry_run:
+        print("\n[BACKUP] Creating backup before migration...")
+        backup_before_migration(args.db)
+
+    migrate_database(args.db, dry_run=args.dry_run)
+
+    print("\n" + "=" * 60)
+    if args.dry_run:
+        print("Dry-run complete. Review changes and run again without --dry-run")
+    else:
+        print("Migration complete.")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Migration 0008: Normalized dates and integer day numbers
+
+Changes:
+1. expenses.date and receipts.date are rewritten to 'YYYY-MM-DD'
+   (dd.mm.yyyy / dd/mm/yyyy as written by the OCR scripts, ISO with a time
+   part); empty strings become NULL
+2. expenses.day / receipts.day INTEGER: the date as days since 1970-01-01
+   (dates.py), filled for every row
+3. idx_expenses_day_total (day, line_total_bani, store_id, product_id)
+   replaces idx_expenses_date_total; date-range reports filter on day
+4. triggers (schema.ensure_dates) reject any other date text on every
+   write and keep day in step with date
+5. store_stats and the monthly category/product rollups are recomputed,
+   since first/last visit and month keys come from the dates
+
+Dates that cannot be read stop the migration and are listed; run again
+with --null-invalid to store them as NULL (undated) instead.
+Everything runs in one transaction. Run migration 0007 first.
+
+Features:
+- --dry-run: show what will be changed without applying
+- --force: override running app guard
+- Creates a dated backup before applying changes
+"""
+
+import argparse
+import os
+import sqlite3
+import subprocess
+import sys
+
+BASE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE)
+
+from db import EXPENSES_DB, bump_data_version  # noqa: E402
+import dates  # noqa: E402
+import schema  # noqa: E402
+
+BACKUP_PREFIX = "pre_mig0008"
+TABLES = ('expenses', 'receipts')
+MAX_SHOWN = 20
+
+
+def check_running_app(force=False):
+    """Check if the web app is running. Return True if running (and not forced)."""
+    if force:
+        return False
+
+    try:
+        import psutil
+        for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
+            try:
+                cmdline = proc.info['cmdline']
+                if cmdline and any('flask' in str(arg).lower() or 'app_web' in str(arg) or 'serve.py' in str(arg)
+                                   for arg in cmdline):
+                    print(f"[WARN] Web app appears to be running (PID {proc.info['pid']})")
+                    return True
+            except (psutil.NoSuchProcess, psutil.AccessDenied, TypeError):
+                pass
+    except ImportError:
+        pass
+
+    # Fallback: try connecting to port 5000
+    import socket
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(1)
+        result = s.connect_ex(('127.0.0.1', 5000))
+        s.close()
+        if result == 0:
+            print("[WARN] Port 5000 appears to be open (web app may be running)")
+            return True
+    except Exception:
+        pass
+
+    return False
+
+
+def backup_before_migration(db_path):
+    """Create a dated backup before applying migration using backup_db.py."""
+    script_path = os.path.join(os.path.dirname(__file__), "backup_db.py")
+    result = subprocess.run([sys.executable, script_path, "--db", db_path, "--prefix", BACKUP_PREFIX],
+                            capture_output=True, text=True, timeout=300)
+    if result.returncode != 0:
+        print(f"[ERROR] Backup failed: {result.stdout}{result.stderr}")
+        sys.exit(1)
+    print(f"[OK] {result.stdout.strip()}")
+
+
+def normalize_dates(cursor, null_invalid):
+    """Rewrite every date that is not canonical 'YYYY-MM-DD'. Returns (changed, invalid) counts."""
+    cursor.execute("CREATE TEMP TABLE date_map (old TEXT PRIMARY KEY, new TEXT) WITHOUT ROWID")
+    invalid = []
+    for table in TABLES:
+        cursor.execute(f"SELECT DISTINCT date FROM {table} WHERE {dates.invalid_sql('date')}")
+        for (old,) in cursor.fetchall():
+            if str(old).strip() == '':
+                new = None
+            else:
+                try:
+                    new = dates.to_iso(old)
+                except ValueError:
+                    invalid.append((table, old))
+                    new = None
+            cursor.execute("INSERT OR IGNORE INTO date_map (old, new) VALUES (?, ?)", (old, new))
+
+    if invalid:
+        print(f"    {len(invalid)} unreadable dates:")
+        for table, old in invalid[:MAX_SHOWN]:
+            cursor.execute(f"SELECT COUNT(*) FROM {table} WHERE date = ?", (old,))
+            print(f"      {table}: {old!r} ({cursor.fetchone()[0]} rows)")
+        if len(invalid) > MAX_SHOWN:
+            print(f"      ... and {len(invalid) - MAX_SHOWN} more")
+        if not null_invalid:
+            raise RuntimeError("fix these dates or run again with --null-invalid to store them as NULL")
+
+    changed = 0
+    for table in TABLES:
+        # one pass per table, each row looks its date up in date_map
+        cursor.execute(f"UPDATE {table} SET date = m.new FROM date_map m WHERE {table}.date = m.old")
+        print(f"    {table}: {cursor.rowcount} dates rewritten")
+        changed += cursor.rowcount
+    cursor.execute("DROP TABLE date_map")
+    return changed, len(invalid)
+
+
+def add_day_columns(cursor):
+    for table in TABLES:
+        cursor.execute(f"PRAGMA table_info({table})")
+        if 'day' not in {r[1] for r in cursor.fetchall()}:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN day INTEGER")
+        cursor.execute(f"UPDATE {table} SET day = {dates.day_sql('date')}")
+        print(f"    {table}: day filled for {cursor.rowcount} rows")
+
+
+def migrate_database(db_path, dry_run=False, null_invalid=False):
+    """Apply migration changes (rolled back at the end with --dry-run)."""
+    if not os.path.exists(db_path):
+        print(f"[ERROR] Database not found: {db_path}")
+        sys.exit(1)
+
+    conn = sqlite3.connect(db_path, timeout=30.0)
+    conn.isolation_level = None
+    conn.execute("PRAGMA busy_timeout=30000")
+    conn.execute("PRAGMA foreign_keys=OFF")
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        if not schema.has_integer_money(conn):
+            raise RuntimeError("run scripts/migrate_0007_integer_money.py first")
+
+        # the maintained tables are recomputed at the end: no row triggers while dates are rewritten
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")
+        for (name,) in cursor.fetchall():
+            if name in schema._ALL_TRIGGERS:
+                cursor.execute(f"DROP TRIGGER {name}")
+
+        print("\n[1] Normalizing dates")
+        changed, invalid = normalize_dates(cursor, null_invalid)
+
+        print("\n[2] Day numbers")
+        add_day_columns(cursor)
+
+        print("\n[3] Indexes, triggers and maintained tables")
+        schema.ensure_all(conn)
+        schema.rebuild_store_stats(conn)
+        schema.rebuild_category_stats(conn)
+        # every cached report range may have changed
+        cursor.execute("DELETE FROM report_changes WHERE date = ''")
+        cursor.execute("INSERT INTO report_changes (date) VALUES ('')")
+        print("    idx_expenses_day_total, date triggers, store_stats and monthly rollups done")
+
+        cursor.execute("SELECT COUNT(*) FROM expenses WHERE date IS NOT NULL AND day IS NULL")
+        missing = cursor.fetchone()[0]
+        if missing:
+            raise RuntimeError(f"{missing} dated expenses without a day number")
+
+        cursor.execute("PRAGMA foreign_key_check")
+        violations = cursor.fetchall()
+        if violations:
+            raise RuntimeError(f"foreign key check failed: {violations[:10]}")
+
+        if dry_run:
+            print("\n[DRY-RUN] Rolling back changes...")
+            cursor.execute("ROLLBACK")
+            print("[OK] Dry-run complete. No changes applied.")
+        else:
+            cursor.execute("COMMIT")
+            bump_data_version(db_path)
+            print(f"\n[OK] Migration 0008 applied successfully ({changed} dates rewritten, {invalid} set to NULL)")
+    except (sqlite3.Error, RuntimeError) as e:
+        print(f"[ERROR] {e}")
+        if conn.in_transaction:
+            cursor.execute("ROLLBACK")
+        conn.close()
+        sys.exit(1)
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Migration 0008: Normalized dates and integer day numbers"
+    )
+    parser.add_argument("--db", default=EXPENSES_DB, help="Database to migrate (default: expenses.db)")
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Show what will be changed without applying"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Override running app guard"
+    )
+    parser.add_argument(
+        "--null-invalid",
+        action="store_true",
+        help="Store unreadable dates as NULL instead of stopping"
+    )
+
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("Migration 0008: Normalized Dates and Day Numbers")
+    print("=" * 60)
+
+    # Check for running app
+    if check_running_app(force=args.force):
+        print("\n[WARN] Web app is running. It's recommended to stop it before migrating.")
+        if not args.force:
+            print("       Use --force to override this check.")
+            sys.exit(1)
+
+    if not args.dry_run:
+        print("\n[BACKUP] Creating backup before migration...")
+        backup_before_migration(args.db)
+
+    migrate_database(args.db, dry_run=args.dry_run, null_invalid=args.null_invalid)
+
+    print("\n" + "=" * 60)
+    if args.dry_run:
+        print("Dry-run complete. Review changes and run again without --dry-run")
+    else:
+        print("Migration complete.")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
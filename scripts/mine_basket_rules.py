@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Mine "usually bought with" rules from the receipts (basket_rules.py) and
+replace the basket_rules table the record_expense page reads its
+suggestions from.
+
+The receipts are read first, outside any write transaction; only the
+replacement of the rules holds the write lock, for a moment. Run it after
+an import or from cron (nightly is plenty: rules change slowly).
+
+Usage:
+  python scripts/mine_basket_rules.py
+  python scripts/mine_basket_rules.py --min-support 0.001 --min-confidence 0.3
+  python scripts/mine_basket_rules.py --db path/to/expenses.db --dry-run
+
+Exit code: 0 done, 1 no database.
+"""
+
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+
+BASE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE)
+
+from db import EXPENSES_DB, bump_data_version, get_db  # noqa: E402
+import basket_rules  # noqa: E402
+import schema  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mine association rules from receipt baskets')
+    parser.add_argument('--db', default=EXPENSES_DB, help='Database (default: expenses.db / EXPENSES_DB)')
+    parser.add_argument('--min-support', type=float, default=basket_rules.MIN_SUPPORT,
+                        help='Share of receipts a product set must appear on (default 0.002)')
+    parser.add_argument('--min-count', type=int, default=basket_rules.MIN_COUNT,
+                        help='...and at least this many receipts (default 2)')
+    parser.add_argument('--min-confidence', type=float, default=basket_rules.MIN_CONFIDENCE,
+                        help='Minimum confidence of a rule (default 0.2)')
+    parser.add_argument('--max-per-product', type=int, default=basket_rules.MAX_PER_ANTECEDENT,
+                        help='Rules kept per antecedent (default 10)')
+    parser.add_argument('--dry-run', action='store_true', help='Mine and report, leave basket_rules alone')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print('No database found at', args.db)
+        return 1
+
+    conn = get_db(args.db)
+    conn.isolation_level = None
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        schema.ensure_all(conn)
+        conn.execute('COMMIT')
+
+        started = time.perf_counter()
+        baskets = basket_rules.read_baskets(conn)
+        read_seconds = time.perf_counter() - started
+        min_count = basket_rules.min_count_for(len(baskets), args.min_support, args.min_count)
+        started = time.perf_counter()
+        itemsets, total = basket_rules.mine(baskets, min_count)
+        mined = basket_rules.rules(itemsets, total, args.min_confidence, args.max_per_product)
+        mine_seconds = time.perf_counter() - started
+
+        sizes = Counter(len(itemset) for itemset in itemsets)
+        print(f"{total} receipts read in {read_seconds:.2f}s; product sets on at least {min_count} receipts: "
+              + ', '.join(f"{sizes[n]} of {n}" for n in sorted(sizes)))
+        print(f"{len(mined)} rules (confidence >= {args.min_confidence}, lift > 1) mined in {mine_seconds:.2f}s")
+        if args.dry_run:
+            return 0
+
+        conn.execute('BEGIN IMMEDIATE')
+        basket_rules.replace_rules(conn, mined)
+        conn.execute('COMMIT')
+        bump_data_version(args.db)
+        print('basket_rules replaced')
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Manage the receipt photo store (image_store.py) from the command line.
+
+  add   store image files and link them to a receipt (nr_bon); a file whose
+        content is already stored is only linked, never copied again
+  gc    delete the images no receipt links to any more (receipt deleted,
+        photo removed) and files left behind by interrupted uploads
+
+Usage:
+  python scripts/receipt_images.py add --nr-bon 00116 bonuri/processed/bon_mega.jpg
+  python scripts/receipt_images.py gc --dry-run
+  python scripts/receipt_images.py gc --db path/to/expenses.db --store path/to/receipt_images
+
+Exit code: 0 done, 1 a receipt or file was not found / not an image.
+"""
+
+import argparse
+import os
+import sys
+
+BASE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE)
+
+from db import EXPENSES_DB, bump_data_version, get_db  # noqa: E402
+import image_store  # noqa: E402
+import schema  # noqa: E402
+
+
+def add(conn, args):
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM receipts WHERE nr_bon = ?", (args.nr_bon,))
+    if not cursor.fetchone():
+        print('No receipt with nr_bon', args.nr_bon)
+        return 1
+    failed = 0
+    for path in args.files:
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            image_hash = image_store.digest(data)
+            image = image_store.find(conn, image_hash) or image_store.save(data, args.store, image_hash)
+        except (OSError, ValueError) as e:
+            print(f'  {path}: {e}')
+            failed += 1
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        linked = image_store.link(conn, args.nr_bon, image)
+        conn.execute('COMMIT')
+        state = 'linked' if linked else 'already linked'
+        print(f"  {path}: {image_hash[:12]} {state}, {image['size_bytes']} bytes stored "
+              f"({image['original_bytes']} uploaded)")
+    bump_data_version(args.db)
+    return 1 if failed else 0
+
+
+def gc(conn, args):
+    conn.execute('BEGIN IMMEDIATE')
+    counts = image_store.collect_garbage(conn, args.store, args.grace, dry_run=args.dry_run)
+    conn.execute('ROLLBACK' if args.dry_run else 'COMMIT')
+    verb = 'Would remove' if args.dry_run else 'Removed'
+    print(f"{verb} {counts['rows']} unlinked images and {counts['files']} files "
+          f"({counts['bytes'] / 2**20:.1f} MiB)")
+    if not args.dry_run:
+        bump_data_version(args.db)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Add receipt photos to the image store or clean it up')
+    parser.add_argument('--db', default=EXPENSES_DB, help='Database (default: expenses.db / EXPENSES_DB)')
+    parser.add_argument('--store', default=image_store.ROOT,
+                        help='Image store folder (default: receipt_images/ / EXPENSES_IMAGE_STORE)')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_add = sub.add_parser('add', help='Store images and link them to a receipt')
+    p_add.add_argument('--nr-bon', required=True, help='Receipt to link the images to')
+    p_add.add_argument('files', nargs='+')
+    p_gc = sub.add_parser('gc', help='Delete unlinked images and leftover files')
+    p_gc.add_argument('--dry-run', action='store_true', help='Only count what would go')
+    p_gc.add_argument('--grace', type=float, default=image_store.GC_GRACE_SECONDS,
+                      help='Keep files younger than this many seconds (uploads in progress; default 3600)')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print('No database found at', args.db)
+        return 1
+
+    conn = get_db(args.db)
+    conn.isolation_level = None
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        schema.ensure_all(conn)
+        conn.execute('COMMIT')
+        return add(conn, args) if args.command == 'add' else gc(conn, args)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
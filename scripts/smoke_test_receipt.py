@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 """
 Simple smoke test for receipts migration and basic DB inserts.
-Run after migration to verify receipts and discount columns exist and basic insert works.
+Run after migration 0007 to verify receipts and the integer money columns exist and basic insert works.
 
 Usage: python scripts/smoke_test_receipt.py
 """
@@ -28,29 +28,32 @@ else:
     print('receipts table exists')
 
 print('Checking expenses columns...')
-cur.execute('PRAGMA table_info(expenses)')
+cur.execute('PRAGMA table_xinfo(expenses)')
 cols = [r[1] for r in cur.fetchall()]
 print('expenses columns:', cols)
-if 'discount' not in cols or 'receipt_id' not in cols:
-    print('Expected columns not present')
+if not {'receipt_nr', 'price_bani', 'quantity_milli', 'discount_bani', 'price'} <= set(cols):
+    print('Expected columns not present (run migration 0007)')
     sys.exit(1)
 
 print('Inserting test receipt and line...')
 cur.execute('INSERT INTO receipts (store_id, nr_bon, date) VALUES (?, ?, ?)', (1, 'TEST123', '2025-11-19'))
-rid = cur.lastrowid
-cur.execute('INSERT INTO expenses (product_id, store_id, price, quantity, date, receipt_id, discount) VALUES (?, ?, ?, ?, ?, ?, ?)',
-            (1, 1, 10.0, 2, '2025-11-19', rid, 1.5))
+# 10.00 lei x 2 buc, 1.50 lei discount
+cur.execute('INSERT INTO expenses (product_id, store_id, price_bani, quantity_milli, date, receipt_nr, discount_bani) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)', (1, 1, 1000, 2000, '2025-11-19', 'TEST123', 150))
 conn.commit()
 
-cur.execute('SELECT e.price, e.quantity, e.discount FROM expenses WHERE receipt_id = ?', (rid,))
+cur.execute('SELECT price, quantity, discount, price_bani * quantity_milli / 1000 - discount_bani '
+            'FROM expenses WHERE receipt_nr = ?', ('TEST123',))
 row = cur.fetchone()
-print('Inserted line:', row)
-expected_total = row[0]*row[1] - row[2]
-print('Computed total:', expected_total)
+print('Inserted line:', row[:3])
+print('Computed total (bani):', row[3])
+if row[3] != 1850:
+    print('Unexpected total')
+    sys.exit(1)
 
 print('Cleaning up test rows...')
-cur.execute('DELETE FROM expenses WHERE receipt_id = ?', (rid,))
-cur.execute('DELETE FROM receipts WHERE id = ?', (rid,))
+cur.execute('DELETE FROM expenses WHERE receipt_nr = ?', ('TEST123',))
+cur.execute('DELETE FROM receipts WHERE nr_bon = ?', ('TEST123',))
 conn.commit()
 conn.close()
 
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Check that the maintained receipt header totals (receipts.total_bani,
+line_count, discount_total_bani) match the receipts' lines.
+
+The triggers from schema.ensure_receipt_totals keep them in step with every
+write; a mismatch means something wrote with the triggers missing (an old
+copy of the database, a manual edit). --fix recomputes every header from its
+lines in one transaction.
+
+Usage:
+  python scripts/verify_receipt_totals.py
+  python scripts/verify_receipt_totals.py --db path/to/expenses.db --fix
+
+Exit code: 0 all consistent (or fixed), 1 mismatches found.
+"""
+
+import argparse
+import os
+import sys
+
+BASE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE)
+
+from db import EXPENSES_DB, bump_data_version, get_db  # noqa: E402
+import money  # noqa: E402
+import schema  # noqa: E402
+
+MAX_SHOWN = 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Verify receipt header totals against their lines')
+    parser.add_argument('--db', default=EXPENSES_DB, help='Database to check (default: expenses.db / EXPENSES_DB)')
+    parser.add_argument('--fix', action='store_true', help='Recompute all header totals from the lines')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print('No database found at', args.db)
+        return 1
+
+    conn = get_db(args.db)
+    conn.isolation_level = None
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        schema.ensure_all(conn)
+        conn.execute('COMMIT')
+
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM receipts')
+        receipts = cursor.fetchone()[0]
+        mismatches = schema.verify_receipt_totals(conn)
+        print(f'{receipts} receipts checked, {len(mismatches)} inconsistent')
+        for nr_bon, stored, actual in mismatches[:MAX_SHOWN]:
+            print(f'  {nr_bon}: header total {money.lei(stored[0]):.2f} lei / {stored[1]} lines / '
+                  f'discount {money.lei(stored[2]):.2f}; lines give {money.lei(actual[0]):.2f} lei / '
+                  f'{actual[1]} lines / discount {money.lei(actual[2]):.2f}')
+        if len(mismatches) > MAX_SHOWN:
+            print(f'  ... and {len(mismatches) - MAX_SHOWN} more')
+        if not mismatches:
+            return 0
+        if not args.fix:
+            print('Run with --fix to recompute them.')
+            return 1
+
+        conn.execute('BEGIN IMMEDIATE')
+        schema.recompute_receipt_totals(conn)
+        conn.execute('COMMIT')
+        bump_data_version(args.db)
+        left = schema.verify_receipt_totals(conn)
+        print(f'Recomputed; {len(left)} inconsistent now')
+        return 0 if not left else 1
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
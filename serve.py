@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Run the expenses web app.
+
+Production (default) runs app_web:app under a multi-worker WSGI server:
+  - gunicorn (Linux/macOS): N worker processes x M threads each.
+    Graceful reload: kill -HUP $(cat expenses_web.pid)  -- new workers are
+    started with the new code, old ones finish their requests and exit.
+  - waitress (Windows, or when gunicorn is not installed): one process with
+    M threads. No in-place reload; restart the process instead.
+
+With --async the app is served by uvicorn through app_async.py: the AJAX
+endpoints used by record_expense.html run on the event loop with their SQLite
+work on a bounded thread pool (--db-threads); all other pages go to Flask.
+
+Development keeps Flask's debug server (reloader + debugger) behind --dev.
+
+Usage:
+  python serve.py                              # production, host = local WiFi IP, port 5000
+  python serve.py --threads 16                 # gunicorn: 1 process x 16 threads
+  python serve.py --host 0.0.0.0 --port 8000
+  python serve.py --async --db-threads 16
+  python serve.py --dev                        # Flask debug server (never expose this)
+
+Defaults can also come from the environment: EXPENSES_HOST, EXPENSES_PORT,
+EXPENSES_WORKERS, EXPENSES_THREADS, EXPENSES_DB_THREADS; EXPENSES_DB selects
+the database file.
+
+One worker process by default: every write goes through the single writer of
+db_writer.py, which is one thread per process, so a single process is what
+keeps it the only write connection. --workers N > 1 still works (the database
+is switched to WAL mode before the workers start, every connection has a busy
+timeout, db.BUSY_TIMEOUT, and connections are opened per request, so nothing is
+shared across forked processes), but the N writers then wait on each other for
+SQLite's write lock.
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+
+from db import enable_wal
+
+DEFAULT_PORT = 5000
+PID_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'expenses_web.pid')
+
+
+def detect_local_ip():
+    """Return the local WiFi/LAN IP (not loopback), or 127.0.0.1 if unknown."""
+    try:
+        # Connect to a non-routable address to find the local IP
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.connect(("8.8.8.8", 80))
+        local_ip = s.getsockname()[0]
+        s.close()
+        return local_ip
+    except Exception:
+        # Fallback to localhost if unable to determine
+        return "127.0.0.1"
+
+
+def default_workers():
+    # one process = one db_writer thread = one write connection; scale with --threads
+    return 1
+
+
+def default_threads():
+    return min(16, multiprocessing.cpu_count() * 4 + 4)
+
+
+def run_dev(host, port):
+    from app_web import app
+    print(f"[DEV] Flask debug server on http://{host}:{port} (reloader + debugger enabled)")
+    app.run(host=host, port=port, debug=True)
+
+
+def run_gunicorn(host, port, workers, threads):
+    from gunicorn.app.base import BaseApplication
+
+    class ExpensesApplication(BaseApplication):
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # imported in each worker so a HUP reload picks up new code
+            from app_web import app
+            return app
+
+    options = {
+        'bind': f'{host}:{port}',
+        'workers': workers,
+        'threads': threads,
+        'worker_class': 'gthread' if threads > 1 else 'sync',
+        'pidfile': PID_FILE,
+        'graceful_timeout': 30,
+        'timeout': 60,
+        'accesslog': '-',
+    }
+    print(f"[PROD] gunicorn on http://{host}:{port} ({workers} workers x {threads} threads)")
+    print(f"       graceful reload: kill -HUP $(cat {PID_FILE})")
+    ExpensesApplication(options).run()
+
+
+def run_waitress(host, port, threads):
+    from waitress import serve
+    from app_web import app
+    print(f"[PROD] waitress on http://{host}:{port} ({threads} threads)")
+    serve(app, host=host, port=port, threads=threads)
+
+
+def run_async(host, port, workers, db_threads):
+    import uvicorn
+    # read by app_async at import time, also in the worker processes
+    os.environ['EXPENSES_DB_THREADS'] = str(db_threads)
+    print(f"[PROD] uvicorn (async endpoints) on http://{host}:{port} "
+          f"({workers} workers, {db_threads} DB threads each)")
+    uvicorn.run('app_async:app', host=host, port=port, workers=workers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the expenses web app')
+    parser.add_argument('--dev', action='store_true', help='Run the Flask debug server (development only)')
+    parser.add_argument('--host', default=os.environ.get('EXPENSES_HOST'), help='Bind address (default: local WiFi IP)')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('EXPENSES_PORT', DEFAULT_PORT)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('EXPENSES_WORKERS', default_workers())),
+                        help='Worker processes (gunicorn and --async)')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('EXPENSES_THREADS', default_threads())),
+                        help='Threads per worker')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='Serve through app_async.py (uvicorn) with async AJAX endpoints')
+    parser.add_argument('--db-threads', type=int, default=int(os.environ.get('EXPENSES_DB_THREADS', 8)),
+                        help='Executor threads for SQLite work in --async mode')
+    parser.add_argument('--server', choices=('auto', 'gunicorn', 'waitress'), default='auto',
+                        help='WSGI server to use in production mode (default: gunicorn if available)')
+    args = parser.parse_args(argv)
+
+    if args.workers > 1 and not args.dev:
+        print(f"[INFO] {args.workers} worker processes: each has its own db_writer, so writes from "
+              f"different processes wait on SQLite's write lock (busy timeout) instead of sharing commits")
+
+    host = args.host or detect_local_ip()
+    print(f"Access from WiFi: http://{host}:{args.port}")
+
+    if args.dev:
+        run_dev(host, args.port)
+        return 0
+
+    try:
+        print(f"SQLite journal mode: {enable_wal()}")
+    except Exception as e:
+        print(f"[WARN] could not enable WAL mode: {e}")
+
+    if args.use_async:
+        run_async(host, args.port, args.workers, args.db_threads)
+        return 0
+
+    server = args.server
+    if server == 'auto':
+        server = 'waitress' if sys.platform == 'win32' else 'gunicorn'
+        if server == 'gunicorn':
+            try:
+                import gunicorn  # noqa: F401
+            except ImportError:
+                server = 'waitress'
+
+    if server == 'gunicorn':
+        run_gunicorn(host, args.port, args.workers, args.threads)
+    else:
+        if args.workers > 1:
+            print("[INFO] waitress runs a single process; --workers is ignored, use --threads")
+        run_waitress(host, args.port, args.threads)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,249 @@
+"""
+The trigger-maintained tables (schema.py) against a recompute from expenses.
+
+Every test starts from a database made by init_db.py plus schema.ensure_all,
+writes through SQL the way the app does (or through bulk_insert_expenses, the
+import path), and then checks each maintained table against its rebuild_* /
+recompute_* function run inside a savepoint that is rolled back. The search
+index is checked against a reindex of every receipt, and the anomaly job's
+state, which follows inserts only (see anomalies.py), against a recheck of
+every line.
+
+Run:  python -m pytest -q tests
+"""
+
+import os
+import runpy
+import sys
+
+import pytest
+
+BASE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE)
+
+from db import get_db  # noqa: E402
+import anomalies  # noqa: E402
+import dates  # noqa: E402
+import money  # noqa: E402
+import schema  # noqa: E402
+
+# maintained tables -> the function that recomputes them
+REBUILDS = [
+    (('store_stats', 'store_product_stats'), schema.rebuild_store_stats),
+    (('receipts',), schema.recompute_receipt_totals),
+    (('monthly_product_stats', 'monthly_category_stats'), schema.rebuild_category_stats),
+    (('monthly_store_type_stats',), schema.rebuild_store_type_stats),
+    (('product_prices',), schema.rebuild_product_prices),
+]
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    runpy.run_path(os.path.join(BASE, 'init_db.py'))
+    conn = get_db(str(tmp_path / 'expenses.db'))
+    conn.isolation_level = None
+    conn.execute('BEGIN IMMEDIATE')
+    schema.ensure_all(conn)
+    conn.execute('COMMIT')
+    _fill(conn)
+    yield conn
+    conn.close()
+
+
+def _fill(conn):
+    """Two categories, three stores (two types), products with and without a category,
+    receipts over three months and a few lines without a receipt."""
+    conn.executemany("INSERT INTO categorii (id, categorie) VALUES (?, ?)", [(1, 'Alimente'), (2, 'Bauturi')])
+    conn.executemany("INSERT INTO stores (id, name, store_type) VALUES (?, ?, ?)",
+                     [(1, 'LIDL', 'Supermarket'), (2, 'CATENA', 'Farmacie'), (3, 'PIATA', None)])
+    conn.executemany("INSERT INTO products (id, name, category_id) VALUES (?, ?, ?)",
+                     [(1, 'LAPTE', 1), (2, 'PAINE', 1), (3, 'APA', 2), (4, 'BERE', 2), (5, 'DIVERSE', None)])
+    receipts = [(f'B{n}', 1 + n % 3, f'2024-{1 + n % 3:02d}-{10 + n:02d}') for n in range(9)]
+    conn.executemany("INSERT INTO receipts (nr_bon, store_id, date) VALUES (?, ?, ?)", receipts)
+    for n, (nr_bon, store_id, date) in enumerate(receipts):
+        for product_id in (1, 2 + n % 4, 1 + (n * 3) % 5):
+            _add_line(conn, product_id, store_id, 150 + 37 * n + product_id, 1000 + 500 * (n % 2), date, nr_bon,
+                      discount_bani=10 if n % 4 == 0 else 0)
+    _add_line(conn, 3, 2, 399, 2000, '2024-02-20')
+    _add_line(conn, 5, 3, 1250, 1000, None)
+
+
+def _add_line(conn, product_id, store_id, price_bani, quantity_milli, date, receipt_nr=None, discount_bani=0):
+    conn.execute("""
+        INSERT INTO expenses (product_id, store_id, price_bani, quantity_milli, date, receipt_nr, discount_bani)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (product_id, store_id, price_bani, quantity_milli, date, receipt_nr, discount_bani))
+
+
+def _rows(conn, table):
+    return sorted(conn.execute(f"SELECT * FROM {table}").fetchall(), key=repr)
+
+
+def _recompute(conn, tables, rebuild):
+    conn.execute('SAVEPOINT recompute')
+    try:
+        rebuild(conn)
+        return {table: _rows(conn, table) for table in tables}
+    finally:
+        conn.execute('ROLLBACK TO recompute')
+        conn.execute('RELEASE recompute')
+
+
+def _reindex_all(conn):
+    conn.execute("INSERT OR IGNORE INTO search_dirty (nr_bon) SELECT nr_bon FROM receipts")
+    schema.refresh_search_index(conn)
+
+
+def _recheck_all(conn):
+    anomalies.reset(conn)
+    anomalies.detect(conn)
+
+
+def assert_consistent(conn):
+    for tables, rebuild in REBUILDS:
+        maintained = {table: _rows(conn, table) for table in tables}
+        recomputed = _recompute(conn, tables, rebuild)
+        for table in tables:
+            assert maintained[table] == recomputed[table], f'{table} differs from {rebuild.__name__}'
+    # search_dirty noted every receipt the writes touched: refreshing those gives the full reindex
+    schema.refresh_search_index(conn)
+    search = ('search_docs', 'receipt_search')
+    docs = conn.execute("SELECT nr_bon FROM search_docs").fetchall()
+    assert sorted(docs) == sorted(conn.execute("SELECT nr_bon FROM receipts").fetchall())
+    assert _rows(conn, 'receipt_search') == _recompute(conn, search, _reindex_all)['receipt_search']
+
+
+def assert_anomalies_consistent(conn, tables=('anomaly_stats', 'expense_flags')):
+    anomalies.detect(conn)
+    kept = {table: _rows(conn, table) for table in tables}
+    assert kept == _recompute(conn, tables, _recheck_all)
+
+
+def test_filled_database_is_consistent(conn):
+    assert_consistent(conn)
+    assert_anomalies_consistent(conn)
+
+
+def test_line_insert(conn):
+    anomalies.detect(conn)
+    conn.execute("INSERT INTO receipts (nr_bon, store_id, date) VALUES ('N1', 3, '2024-04-02')")
+    for n in range(6):
+        _add_line(conn, 1 + n % 5, 3, 200 + 900 * (n == 5), 1000, '2024-04-02', 'N1')
+    _add_line(conn, 1, 3, 200, 1000, '2024-04-02', 'N1')      # same as the first line: a duplicate
+    _add_line(conn, 2, 1, 310, 1500, '2024-01-11', 'B0', discount_bani=25)
+    _add_line(conn, 4, 2, 899, 500, '2024-05-01')
+    _add_line(conn, None, 2, 100, 1000, None)
+    assert_consistent(conn)
+    assert_anomalies_consistent(conn)
+
+
+@pytest.mark.parametrize('column, value', [
+    ('price_bani', 777),
+    ('quantity_milli', 2500),
+    ('discount_bani', 40),
+    ('date', '2023-12-31'),                # another month and year
+    ('date', None),
+    ('product_id', 4),                     # another category
+    ('product_id', 5),                     # no category
+    ('product_id', None),
+    ('store_id', 2),                       # another store type
+    ('store_id', 3),                       # no store type
+    ('receipt_nr', 'B7'),
+    ('receipt_nr', None),
+])
+def test_line_update(conn, column, value):
+    for eid, in conn.execute("SELECT id FROM expenses WHERE receipt_nr = 'B1' OR receipt_nr IS NULL").fetchall():
+        conn.execute(f"UPDATE expenses SET {column} = ? WHERE id = ?", (value, eid))
+    assert_consistent(conn)
+
+
+def test_line_delete(conn):
+    conn.execute("DELETE FROM expenses WHERE receipt_nr = 'B4' AND product_id = 1")
+    conn.execute("DELETE FROM expenses WHERE receipt_nr IS NULL")
+    assert_consistent(conn)
+
+
+def _triggers(conn):
+    return conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' ORDER BY name").fetchall()
+
+
+def test_bulk_insert(conn):
+    anomalies.detect(conn)
+    schema.refresh_search_index(conn)
+    triggers = _triggers(conn)
+    conn.execute('SAVEPOINT import')
+    conn.executemany("INSERT INTO receipts (nr_bon, store_id, date, day) VALUES (?, ?, ?, ?)",
+                     [(nr, 1 + n, day, dates.to_day(day)) for n, (nr, day) in
+                      enumerate([('I1', '2024-03-05'), ('I2', '2024-06-30')])])
+    rows = []
+    for n in range(40):
+        # new receipts, one already indexed for search, and lines without a receipt
+        nr_bon, day = [('I1', '2024-03-05'), ('I2', '2024-06-30'), ('B0', '2024-01-10'), (None, '2024-02-14')][n % 4]
+        product_id = [1, 2, 3, 4, 5, None][n % 6]
+        price, quantity, discount = 120 + 13 * n, 1000 + 250 * (n % 3), 5 * (n % 2)
+        # the importer computes line_total_bani; a missing one is filled by the replay
+        total = money.line_total_bani(price, quantity, discount) if n % 7 else None
+        rows.append((product_id, 1 + n % 3, price, quantity, day, nr_bon, discount, None, total, dates.to_day(day)))
+    assert schema.bulk_insert_expenses(conn, rows) == len(rows)
+    conn.execute('RELEASE import')
+    assert _triggers(conn) == triggers
+    assert conn.execute("SELECT COUNT(*) FROM expenses WHERE line_total_bani IS NULL").fetchone()[0] == 0
+    assert_consistent(conn)
+    assert_anomalies_consistent(conn)
+
+
+def test_receipt_delete_cascades(conn):
+    # expenses.receipt_nr is ON DELETE CASCADE: deleting the header deletes its lines
+    conn.execute("DELETE FROM receipts WHERE nr_bon IN ('B2', 'B5')")
+    assert conn.execute("SELECT COUNT(*) FROM expenses WHERE receipt_nr IN ('B2', 'B5')").fetchone()[0] == 0
+    assert_consistent(conn)
+
+
+def test_receipt_renumber_cascades(conn):
+    conn.execute("UPDATE receipts SET nr_bon = 'B3X' WHERE nr_bon = 'B3'")
+    assert conn.execute("SELECT COUNT(*) FROM expenses WHERE receipt_nr = 'B3X'").fetchone()[0] == 3
+    assert_consistent(conn)
+
+
+@pytest.mark.parametrize('store_id', [1, 3])
+def test_store_delete_cascades(conn, store_id):
+    # receipts.store_id and expenses.store_id are ON DELETE CASCADE
+    conn.execute("DELETE FROM stores WHERE id = ?", (store_id,))
+    assert conn.execute("SELECT COUNT(*) FROM expenses WHERE store_id = ?", (store_id,)).fetchone()[0] == 0
+    assert_consistent(conn)
+
+
+@pytest.mark.parametrize('store_id, store_type', [(1, 'Farmacie'), (2, None), (3, 'Piata')])
+def test_store_type_change(conn, store_id, store_type):
+    conn.execute("UPDATE stores SET name = name || ' NOU', store_type = ? WHERE id = ?", (store_type, store_id))
+    assert_consistent(conn)
+
+
+@pytest.mark.parametrize('product_id, category_id', [(1, 2), (3, None), (5, 1)])
+def test_product_category_change(conn, product_id, category_id):
+    conn.execute("UPDATE products SET name = name || ' NOU', category_id = ? WHERE id = ?",
+                 (category_id, product_id))
+    assert_consistent(conn)
+
+
+def _search_products(conn, nr_bon):
+    schema.refresh_search_index(conn)
+    return conn.execute("SELECT products FROM receipt_search WHERE nr_bon = ?", (nr_bon,)).fetchone()[0] or ''
+
+
+@pytest.mark.parametrize('product_id', [1, 3, 5])
+def test_product_delete(conn, product_id):
+    # expenses.product_id is ON DELETE SET NULL: the lines stay, without a product
+    name, = conn.execute("SELECT name FROM products WHERE id = ?", (product_id,)).fetchone()
+    nr_bon, = conn.execute("SELECT receipt_nr FROM expenses WHERE product_id = ? AND receipt_nr IS NOT NULL",
+                           (product_id,)).fetchone()
+    assert name in _search_products(conn, nr_bon)
+    anomalies.detect(conn)
+    conn.execute("DELETE FROM products WHERE id = ?", (product_id,))
+    assert conn.execute("SELECT COUNT(*) FROM expenses WHERE product_id = ?", (product_id,)).fetchone()[0] == 0
+    assert conn.execute("SELECT COUNT(*) FROM expenses WHERE product_id IS NULL").fetchone()[0]
+    assert_consistent(conn)
+    assert name not in _search_products(conn, nr_bon)
+    # the product's statistics go; the flags of its lines stay, like those of an edited line
+    assert_anomalies_consistent(conn, tables=('anomaly_stats',))